@@ -1,11 +1,15 @@
+import asyncio
+import json
+import queue
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, HTTPException, UploadFile, File, WebSocket, WebSocketDisconnect, Request, BackgroundTasks
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, WebSocket, WebSocketDisconnect, Request
 from fastapi.responses import StreamingResponse
 from typing import Optional
 from contextlib import asynccontextmanager
-from app.storage import init_db
-from app.services import stream_audio_from_list, get_llm_response, get_deepgram_transcription, stream_deepgram_transcription, ingest_pdf, summarise_history, find_pdf_links, ingest_pdf_from_url
+from app.storage import init_db, check_user_id
+from app.upstream import get_upstream_stats
+from app.services import stream_audio_from_list, stream_audio_from_deltas, get_tts_stats, take_acknowledgement, warm_ack_bank, get_ack_bank_stats, ACK_BANK_ENABLED, get_llm_response, retrieve_knowledge, get_deepgram_transcription, stream_deepgram_transcription, PDFDownloadError, spool_upload, start_pdf_ingest, wait_pdf_ingest, get_pdf_ingest, summarise_history, schedule_pdf_link_ingestion, close_http_client, get_prefix_stats, get_tool_cache_stats, get_rag_queue_stats, enqueue_rag_save, start_rag_writer, stop_rag_writer, get_python_sandbox_stats, start_python_sandbox, stop_python_sandbox, get_python_memo_stats, get_transcription_stats, start_speculation, take_speculation, get_speculation_stats, SPECULATE_ENABLED, CancelToken, TurnCancelled, run_cancellable, begin_turn, end_turn, cancel_turn, get_cancellation_stats
 from app.routes_knowledge import router as knowledge_router
 
 @asynccontextmanager
@@ -13,11 +17,19 @@ async def lifespan(app: FastAPI):
     # Startup
     init_db()
     print("Database initialized")
+    start_rag_writer()
+    start_python_sandbox()
+    if ACK_BANK_ENABLED:
+        # synthesized in the background; turns before it's ready just skip the filler
+        app.state.ack_warmup = asyncio.create_task(asyncio.to_thread(warm_ack_bank, DEFAULT_USER_CONFIG))
 
     yield  # App runs here
 
     # Shutdown
     print("App shutting down...")
+    stop_rag_writer()
+    stop_python_sandbox()
+    await close_http_client()
 
 app = FastAPI(
     title="Murf Voice Agent API",
@@ -31,6 +43,17 @@ app.include_router(knowledge_router)
 chat_mem = {}
 user_configs = {}
 convo_summaries = {}
+chat_turns = {}   # user_id -> number of chat turns, guards speculative replies against stale history
+
+MAX_MESSAGES = 20  # 10 user + 10 agent, tweak as you like
+
+DEFAULT_USER_CONFIG = {
+    "rate": 0,
+    "pitch": 0,
+    "style": "Conversational",
+    "temperature": 0.5,
+    "accent_color": "brand-blue",
+}
 
 origins = [
     "http://localhost:5173",
@@ -51,59 +74,207 @@ class ChatRequest(BaseModel):
     user_message: str
     user_id: Optional[str] = "default_user"
 
+class CancelRequest(BaseModel):
+    user_id: Optional[str] = "default_user"
+
 class ChatResponse(BaseModel):
     agent_text: str
     audio_base64: Optional[str] = None  # base64 murf audio
     status: str
 
+def _require_user_id(user_id: Optional[str]) -> None:
+    """400 for user ids reserved by the knowledge store (e.g. "shared")."""
+    try:
+        check_user_id(user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 # for basic server data
 @app.get("/")
 async def health_check():
     """Simple health check to verify backend is running."""
     return {"status": "active", "service": "Murf Voice Agent"}
 
+@app.get("/api/metrics")
+async def metrics():
+    """Process-local performance counters."""
+    return {
+        "prompt_prefix": get_prefix_stats(),
+        "tool_cache": get_tool_cache_stats(),
+        "rag_queue": get_rag_queue_stats(),
+        "python_sandbox": get_python_sandbox_stats(),
+        "python_memo": get_python_memo_stats(),
+        "transcription": get_transcription_stats(),
+        "speculation": get_speculation_stats(),
+        "cancellation": get_cancellation_stats(),
+        "upstream": get_upstream_stats(),
+        "tts": get_tts_stats(),
+        "acknowledgements": get_ack_bank_stats(),
+    }
+
 # the avtual chat
 @app.post("/api/chat")
-async def chat_endpoint(request: Request, body: ChatRequest, background_tasks: BackgroundTasks,):
+async def chat_endpoint(request: Request, body: ChatRequest):
     """
     Main conversational loop
     """
 
-    pdf_urls = await find_pdf_links(body.user_message)
-    for url in pdf_urls:
-        background_tasks.add_task(ingest_pdf_from_url, url)
-
     # def users
     user_id = body.user_id
     user_text = body.user_message
+    _require_user_id(user_id)
+
+    # One active turn per user: a new message (or a barge-in / disconnect)
+    # cancels the LLM, tool and TTS work of the turn before it.
+    cancel = begin_turn(user_id)
+    watcher = asyncio.create_task(_watch_disconnect(request, cancel))
+
+    # the LLM thread reports the chosen tool here before running it, and
+    # the reply text as the completion streams in
+    loop = asyncio.get_running_loop()
+    tool_known = loop.create_future()
+    text_started = loop.create_future()
+    text_deltas = queue.Queue()
+
+    def on_tool(tool: str):
+        loop.call_soon_threadsafe(lambda: tool_known.done() or tool_known.set_result(tool))
+
+    def on_text(delta: Optional[str]):
+        text_deltas.put(delta)
+        if delta:
+            loop.call_soon_threadsafe(lambda: text_started.done() or text_started.set_result(True))
+
+    llm_task = asyncio.create_task(_run_llm_stage(user_id, user_text, cancel, on_tool=on_tool, on_text=on_text))
+    # ends the text if the stage fails (or is replaced by a speculative reply) first
+    llm_task.add_done_callback(lambda _: text_deltas.put(None))
+    ack = None
+    streamed = False
+    try:
+        await asyncio.wait({llm_task, tool_known, text_started}, return_when=asyncio.FIRST_COMPLETED)
+        if text_started.done():
+            # speak the reply as it is written; that covers any acknowledgement
+            streamed = True
+        elif not llm_task.done():
+            # a tool is running: start the reply with a banked acknowledgement
+            ack = take_acknowledgement(tool_known.result(), user_configs[user_id])
+        if ack is None and not streamed:
+            await llm_task
+    except TurnCancelled as e:
+        watcher.cancel()
+        end_turn(user_id, cancel)
+        print(f"⏹️ Turn for {user_id} cancelled before reply ({e})")
+        return StreamingResponse(
+            iter([json.dumps({"status": "cancelled"}) + "\n"]),
+            media_type="application/x-ndjson",
+        )
+    except BaseException:
+        # the LLM thread doesn't see task cancellation; the token stops it
+        cancel.cancel("client disconnected")
+        llm_task.cancel()
+        watcher.cancel()
+        end_turn(user_id, cancel)
+        raise
 
-    if user_id not in chat_mem:
-        chat_mem[user_id] = []
-        convo_summaries[user_id] = ""
-        user_configs[user_id] = {
-            "rate": 0,
-            "pitch": 0,
-            "style": "Conversational",
-            "temperature": 0.5,
-            "accent_color": "brand-blue",
-        }
-
-    MAX_MESSAGES = 20  # 10 user + 10 agent, tweak as you like
-    msg_history_for_llm = []
+    async def event_stream():
+        chunks = None
+        speech = None
+        finished = False
+        next_index = 1 if ack is not None else 0
+        try:
+            if streamed:
+                speech = stream_audio_from_deltas(text_deltas, user_configs[user_id], cancel=cancel)
+                while True:
+                    chunk, end = await run_cancellable(cancel, asyncio.to_thread(_advance, speech))
+                    if chunk is None:
+                        next_index = end
+                        break
+                    yield chunk
+            if ack is not None:
+                yield json.dumps({
+                    "audio_chunk": ack["audio_chunk"],
+                    "text_chunk": ack["text"],
+                    "index": 0,
+                    "status": "playing",
+                    "ack": True,
+                }) + "\n"
+                print(f"🗣️ Acknowledgement for {user_id}: {ack['text']}")
+            try:
+                llm_response = await llm_task
+            except TurnCancelled:
+                raise
+            except Exception as e:
+                # the response has already started, so report it in-stream
+                print(f"❌ Chat turn failed for {user_id}: {e}")
+                finished = True
+                yield json.dumps({"error": str(e), "status": "done"}) + "\n"
+                return
+
+            agent_text_response, spoken_text = _record_reply(
+                user_id, llm_response, acked=ack is not None, streamed=streamed)
+            chunks = stream_audio_from_list(
+                agent_text_response,
+                user_configs[user_id],
+                cancel=cancel,
+                start_index=next_index,
+                spoken_text=spoken_text,
+            )
+
+            result_data = llm_response.get("data")
+            if result_data:
+                # structured tool output (e.g. plot arrays), kept out of the spoken text
+                try:
+                    yield json.dumps({"status": "data", "data": result_data}, allow_nan=False) + "\n"
+                except ValueError as e:
+                    print(f"⚠️ Dropping non-JSON tool data for {user_id}: {e}")
+
+            while True:
+                # Murf calls are blocking; run them off the loop so the
+                # disconnect watcher and barge-in can interrupt them
+                chunk = await run_cancellable(cancel, asyncio.to_thread(next, chunks, None))
+                if chunk is None:
+                    break
+                yield chunk
+            finished = True
+
+        except TurnCancelled as e:
+            print(f"⏹️ Stopped streaming to {user_id} ({e})")
+            if cancel.reason != "client disconnected":
+                yield json.dumps({"status": "cancelled"}) + "\n"
+
+        finally:
+            if not finished:
+                # also covers the server cancelling us on disconnect
+                cancel.cancel("client disconnected")
+                llm_task.cancel()
+            watcher.cancel()
+            end_turn(user_id, cancel)
+            for gen in (speech, chunks):
+                if gen is not None:
+                    try:
+                        gen.close()
+                    except ValueError:
+                        pass   # still running in its thread; it stops at the next cancel check
 
-    chat_mem[user_id].append({"role": "user", "content": user_text})
-    short_history = chat_mem[user_id][-MAX_MESSAGES:]
+    return StreamingResponse(
+        event_stream(),
+        media_type="application/x-ndjson",
+    )
 
-    if convo_summaries[user_id]:
-        msg_history_for_llm.append({
-            "role": "system",
-            "content": f"Conversation so far (summary): {convo_summaries[user_id]}"
-        })
 
-    msg_history_for_llm.extend(short_history)
+def _advance(gen):
+    """(next item, None) from a generator, or (None, its return value) once it is done."""
+    try:
+        return next(gen), None
+    except StopIteration as stop:
+        return None, stop.value
 
-    llm_response = get_llm_response(msg_history_for_llm, user_configs[user_id])
 
+def _record_reply(user_id: str, llm_response: dict, acked: bool = False, streamed: bool = False):
+    """
+    Apply config changes and store the reply; returns (text, text to speak
+    or None for all of it). After a streamed reply only the tool's output
+    is left to speak.
+    """
     agent_text_response = llm_response.get("text", "Sorry, I broke.")
     new_config = llm_response.get("config", {})
 
@@ -113,27 +284,140 @@ async def chat_endpoint(request: Request, body: ChatRequest, background_tasks: B
     chat_mem[user_id].append({"role": "assistant", "content": agent_text_response})
 
     if len(chat_mem[user_id]) % 5 == 0:
-        convo_summaries[user_id] = summarise_history(
-            chat_mem[user_id],
-            existing_summary=convo_summaries[user_id]
-        )
+        # background lane: may queue behind live turns, so keep it off the reply path
+        _schedule_summary(user_id)
 
     chat_mem[user_id] = chat_mem[user_id][-MAX_MESSAGES:]
-    
-    async def event_stream():
-        for chunk in stream_audio_from_list(
-            agent_text_response,
-            user_configs[user_id]
-        ):
-            if await request.is_disconnected():
-                print(f"Client {user_id} disconnected, stopping stream")
-                break
-            yield chunk
 
-    return StreamingResponse(
-        event_stream(),
-        media_type="application/x-ndjson",
-    )
+    # the banked acknowledgement already covered the model's own one
+    after_ack = llm_response.get("text_after_ack")
+    if (acked or streamed) and isinstance(after_ack, str):
+        return agent_text_response, after_ack
+    if streamed:
+        return agent_text_response, ""
+    return agent_text_response, None
+
+
+_summary_tasks = set()
+
+def _schedule_summary(user_id: str):
+    async def run():
+        try:
+            convo_summaries[user_id] = await asyncio.to_thread(
+                summarise_history,
+                list(chat_mem[user_id]),
+                existing_summary=convo_summaries[user_id],
+            )
+        except Exception as e:
+            print(f"⚠️ Summary failed for {user_id}: {e}")
+
+    task = asyncio.create_task(run())
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_tasks.discard)
+
+
+async def _run_llm_stage(user_id: str, user_text: str, cancel: CancelToken, on_tool=None, on_text=None):
+    """Retrieval + LLM (+ tool) part of a chat turn; records the user message."""
+
+    # A reply may already be in flight, started from stable interim
+    # transcripts on /ws/transcribe
+    spec_task = take_speculation(user_id, user_text, context=chat_turns.get(user_id, 0))
+
+    # Start embedding + KB search right away so it overlaps with history
+    # assembly; the LLM stage awaits it below.
+    kb_task = None
+    if spec_task is None:
+        kb_task = asyncio.create_task(
+            asyncio.to_thread(retrieve_knowledge, user_text, user_id)
+        )
+
+    # PDF links are classified and ingested off the critical path
+    schedule_pdf_link_ingestion(user_text, user_id)
+
+    if user_id not in chat_mem:
+        chat_mem[user_id] = []
+        convo_summaries[user_id] = ""
+        user_configs[user_id] = dict(DEFAULT_USER_CONFIG)
+
+    chat_turns[user_id] = chat_turns.get(user_id, 0) + 1
+    chat_mem[user_id].append({"role": "user", "content": user_text})
+    short_history = chat_mem[user_id][-MAX_MESSAGES:]
+
+    if spec_task is not None:
+        try:
+            llm_response, rag_saves = await run_cancellable(cancel, spec_task)
+            print(f"🔮 Using speculative reply for {user_id}")
+            for key, fn, kwargs in rag_saves:
+                enqueue_rag_save(key, fn, **kwargs)
+            return llm_response
+        except TurnCancelled:
+            raise
+        except Exception as e:
+            print("Speculative reply failed, running normally:", e)
+            kb_task = asyncio.create_task(
+                asyncio.to_thread(retrieve_knowledge, user_text, user_id)
+            )
+
+    kb_results = await run_cancellable(cancel, kb_task)
+
+    # the summary and history are fitted into the token budget by get_llm_response
+    return await run_cancellable(cancel, asyncio.to_thread(
+        get_llm_response,
+        short_history,
+        user_configs[user_id],
+        user_id=user_id,
+        summary=convo_summaries[user_id],
+        kb_results=kb_results,
+        cancel=cancel,
+        on_tool=on_tool,
+        on_text=on_text,
+    ))
+
+
+async def _watch_disconnect(request: Request, cancel: CancelToken, interval: float = 0.25):
+    """Cancel the turn as soon as the HTTP client goes away."""
+    while not cancel.cancelled:
+        if await request.is_disconnected():
+            cancel.cancel("client disconnected")
+            return
+        await asyncio.sleep(interval)
+
+
+@app.post("/api/chat/cancel")
+async def cancel_chat(body: CancelRequest):
+    """Barge-in from the UI: stop the user's current reply (LLM, tools and TTS)."""
+    return {"cancelled": cancel_turn(body.user_id, "barge-in")}
+
+
+async def _speculative_reply(user_id: str, user_text: str):
+    """
+    Retrieval + LLM call for an utterance that is not final yet. Works on a
+    copy of the chat state; /api/chat applies the result if it claims it.
+    Returns (reply, rag_saves): tool results are only saved to RAG by the
+    turn that claims the reply, so discarded speculations leave no trace.
+    """
+    history = (chat_mem.get(user_id, []) + [{"role": "user", "content": user_text}])[-MAX_MESSAGES:]
+    configs = dict(user_configs.get(user_id) or DEFAULT_USER_CONFIG)
+
+    # asyncio cancellation can't stop the worker thread; the token can
+    cancel = CancelToken()
+    rag_saves = []
+    try:
+        kb_results = await asyncio.to_thread(retrieve_knowledge, user_text, user_id)
+        reply = await asyncio.to_thread(
+            get_llm_response,
+            history,
+            configs,
+            user_id=user_id,
+            summary=convo_summaries.get(user_id, ""),
+            kb_results=kb_results,
+            cancel=cancel,
+            rag_saves=rag_saves,
+        )
+        return reply, rag_saves
+    except asyncio.CancelledError:
+        cancel.cancel("speculation discarded")
+        raise
 
 
 @app.post("/api/transcribe")
@@ -144,7 +428,8 @@ async def transcribe_audio(file: UploadFile = File(...)):
     """
     audio_bytes = await file.read()
     
-    transcribed_text = get_deepgram_transcription(audio_bytes)
+    # blocking, and may queue behind the Deepgram limiter: keep it off the loop
+    transcribed_text = await asyncio.to_thread(get_deepgram_transcription, audio_bytes)
     
     if not transcribed_text:
         # Fallback if silence
@@ -153,29 +438,92 @@ async def transcribe_audio(file: UploadFile = File(...)):
     return {"transcription": transcribed_text}
 
 @app.websocket("/ws/transcribe")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, user_id: str = "default_user", speculate: bool = SPECULATE_ENABLED):
+    """
+    Live transcription. Speech from `user_id` cancels their in-progress
+    reply (barge-in). With speculate=true, stable interim transcripts
+    start the reply early; the following /api/chat call for the same
+    user_id picks it up if the final transcript matches.
+
+    Both only apply to clients that stream 48 kHz PCM here and send the
+    same user_id to /api/chat. The bundled UI records a clip and uses
+    /api/transcribe instead, so it gets neither.
+    """
+    try:
+        check_user_id(user_id)
+    except ValueError:
+        await websocket.close(code=1008)
+        return
     await websocket.accept()
+
+    def on_speech(started_at: float):
+        # the user started talking over the agent: barge-in. Results of the
+        # utterance the turn is answering (its trailing finals) don't count.
+        cancel_turn(user_id, "barge-in", started_before=started_at)
+
+    on_utterance = None
+    if speculate:
+        def on_utterance(text: str):
+            start_speculation(
+                user_id, text,
+                lambda: _speculative_reply(user_id, text),
+                context=chat_turns.get(user_id, 0),
+            )
+
     try:
-        await stream_deepgram_transcription(websocket)
+        await stream_deepgram_transcription(websocket, on_utterance=on_utterance, on_speech=on_speech)
     except WebSocketDisconnect:
         print("Client disconnected")
     except Exception as e:
         print(f"WS Error: {e}")
 
 @app.post("/api/upload_pdf")
-async def upload_pdf(file: UploadFile = File(...)):
+async def upload_pdf(
+    file: UploadFile = File(...),
+    user_id: Optional[str] = Form(None),
+    wait: bool = Form(False),
+):
+    """
+    Ingest an uploaded PDF. Without a user_id it goes into the shared
+    namespace and is searchable by everyone.
+
+    The upload is spooled to disk and ingested in the background; the
+    response carries an ingest_id to poll at /api/ingest/{ingest_id}.
+    Pass wait=true to block until ingestion has finished.
+    """
     if not file.filename.endswith(".pdf"):
         return {"error": "Only PDF files allowed"}
+    _require_user_id(user_id)
 
-    pdf_bytes = await file.read()
+    try:
+        path, sha256, size = await spool_upload(file)
+    except PDFDownloadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    result = ingest_pdf(
-        pdf_bytes=pdf_bytes,
+    job = start_pdf_ingest(
+        path,
         title=file.filename,
-        doc_id="pdf:" + file.filename
+        doc_id="pdf:" + file.filename,
+        sha256=sha256,
+        size=size,
+        user_id=user_id,
     )
 
-    return {"status": "ok", "stored": result}
+    if wait:
+        job = await wait_pdf_ingest(job["ingest_id"])
+        if job["status"] == "error":
+            raise HTTPException(status_code=500, detail=job["error"])
+        return {"status": "ok", "stored": job["stored"], "ingest_id": job["ingest_id"], "doc_id": job["doc_id"]}
+
+    return {"status": "accepted", "ingest_id": job["ingest_id"], "doc_id": job["doc_id"], "sha256": sha256}
+
+
+@app.get("/api/ingest/{ingest_id}")
+async def ingest_status(ingest_id: str):
+    job = get_pdf_ingest(ingest_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown ingest id")
+    return job
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,222 @@
+import base64
+import io
+import math
+import os
+import re
+import signal
+from contextlib import redirect_stdout
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# The Python sandbox's worker side: running a snippet, encoding its result
+# and the worker process loop. Sandbox workers are forked from a forkserver
+# that preloads only this module, so it must stay a leaf: stdlib, math and
+# numpy only (importing app.services would pull in the API clients and the
+# Chroma database into every worker).
+
+# Result encoding: arrays up to JSON_MAX_VALUES go out as JSON lists, bigger
+# ones as base64 bytes; anything over MAX_BYTES only gets a summary. Spoken /
+# RAG text never carries more than TEXT_CHARS characters.
+PYTHON_RESULT_INLINE_VALUES = int(os.getenv("PYTHON_RESULT_INLINE_VALUES", "20"))
+PYTHON_RESULT_JSON_MAX_VALUES = int(os.getenv("PYTHON_RESULT_JSON_MAX_VALUES", "5000"))
+PYTHON_RESULT_MAX_BYTES = int(os.getenv("PYTHON_RESULT_MAX_BYTES", str(8 * 1024 * 1024)))
+PYTHON_RESULT_TEXT_CHARS = int(os.getenv("PYTHON_RESULT_TEXT_CHARS", "2000"))
+
+
+def strip_imports(code: str) -> str:
+    code = re.sub(r'^\s*import\s+math\s*$', '', code, flags=re.MULTILINE | re.IGNORECASE)
+
+    code = re.sub(r'^\s*import\s+numpy\s+as\s+np\s*$', '', code, flags=re.MULTILINE | re.IGNORECASE)
+    code = re.sub(r'^\s*import\s+numpy\s*$', '', code, flags=re.MULTILINE | re.IGNORECASE)
+
+    return re.sub(r'\n{2,}', '\n', code).strip()
+
+
+def exec_sandboxed(code: str) -> dict:
+    code = strip_imports(code)
+
+    allowed_modules = {
+        'math': math,
+        'np': np,       # Whitelisting NumPy
+        'numpy': np     # Allowing both 'np' and 'numpy' access
+    }
+
+    restricted_builtins = __builtins__.copy()
+    if isinstance(restricted_builtins, dict):
+        restricted_builtins.pop('__import__', None)
+        restricted_builtins.pop('open', None)
+        restricted_builtins.pop('exit', None)
+        restricted_builtins.pop('quit', None)
+
+    sandbox_globals = {
+        **allowed_modules,
+        '__builtins__': restricted_builtins,
+        'result': None
+    }
+
+    output_buffer = io.StringIO()
+
+    try:
+        with redirect_stdout(output_buffer):
+            # The 'result' variable must be explicitly set by the user's code
+            # for the final answer.
+            exec(code, sandbox_globals)
+
+        # Check for the final result or captured print output
+        final_result = sandbox_globals.get('result')
+        captured_output = output_buffer.getvalue().strip()
+
+        if final_result is not None:
+            return encode_result(final_result)
+        elif captured_output:
+            return {"kind": "text", "text": _clip(captured_output)}
+        else:
+            return {"kind": "text", "text": "Code executed, but no explicit 'result' variable was set and no output was printed."}
+
+    except MemoryError:
+        # let the worker report it and get recycled
+        raise
+    except Exception as e:
+        return error_result(f"Code execution failed due to an error: {type(e).__name__}: {str(e)}")
+
+
+# ----------------------------
+# Typed results
+# ----------------------------
+
+def error_result(text: str) -> dict:
+    return {"kind": "error", "text": text}
+
+
+def _clip(text: str, limit: int = None) -> str:
+    limit = limit or PYTHON_RESULT_TEXT_CHARS
+    if len(text) <= limit:
+        return text
+    return text[:limit] + f"... [{len(text) - limit} more characters]"
+
+
+def _fmt(x) -> str:
+    return f"{x:.6g}" if isinstance(x, float) else str(x)
+
+
+def summarize_array(arr: np.ndarray) -> str:
+    """Short, speakable description of an array (full values only if tiny)."""
+    if arr.size <= PYTHON_RESULT_INLINE_VALUES:
+        return np.array2string(arr, precision=6, separator=", ")
+
+    flat = arr.ravel()
+    head = ", ".join(_fmt(v) for v in flat[:5].tolist())
+    text = f"array of shape {arr.shape} ({arr.dtype}), first values: {head}, ..."
+    if arr.dtype.kind in "biuf":
+        finite = flat[np.isfinite(flat)] if arr.dtype.kind == "f" else flat
+        if finite.size:
+            text += (
+                f" min {_fmt(finite.min().item())}, max {_fmt(finite.max().item())},"
+                f" mean {_fmt(float(finite.mean()))}"
+            )
+    return text
+
+
+def _json_safe(values):
+    """NaN / ±Infinity aren't valid JSON; send them as null."""
+    if isinstance(values, list):
+        return [_json_safe(v) for v in values]
+    if isinstance(values, float) and not math.isfinite(values):
+        return None
+    return values
+
+
+def encode_result(value) -> dict:
+    """
+    Turn the sandbox's `result` into a typed, compact payload:
+        {"kind": "scalar", "text": ..., "value": ...}
+        {"kind": "array", "text": <summary>, "data": {"shape", "dtype", "encoding", "values"}}
+        {"kind": "text", "text": ...}
+    `text` is always short enough to speak and store; array data travels
+    separately, as JSON for small arrays (non-finite floats as null) and
+    base64 little-endian bytes for big ones.
+    """
+    if isinstance(value, (bool, int, float, np.generic)) and not isinstance(value, np.ndarray):
+        scalar = value.item() if isinstance(value, np.generic) else value
+        if isinstance(scalar, (bool, int, float)):
+            return {"kind": "scalar", "text": str(scalar), "value": _json_safe(scalar)}
+        return {"kind": "text", "text": _clip(str(scalar))}
+
+    arr = None
+    if isinstance(value, np.ndarray):
+        arr = value
+    elif isinstance(value, (list, tuple)) and value:
+        try:
+            candidate = np.asarray(value)
+            if candidate.dtype.kind in "biuf":
+                arr = candidate
+        except (ValueError, TypeError):
+            arr = None
+
+    if arr is None or arr.dtype.kind not in "biuf":
+        return {"kind": "text", "text": _clip(str(value))}
+
+    if arr.nbytes > PYTHON_RESULT_MAX_BYTES:
+        return {"kind": "text", "text": summarize_array(arr) + " (too large to send)"}
+
+    if arr.size <= PYTHON_RESULT_JSON_MAX_VALUES:
+        data = {"encoding": "json", "values": _json_safe(arr.tolist())}
+    else:
+        le = arr.astype(arr.dtype.newbyteorder("<"), copy=False)
+        data = {"encoding": "base64", "values": base64.b64encode(np.ascontiguousarray(le).tobytes()).decode("ascii")}
+
+    data.update({"shape": list(arr.shape), "dtype": arr.dtype.newbyteorder("<").str})
+    return {"kind": "array", "text": summarize_array(arr), "data": data}
+
+
+# ----------------------------
+# Worker process
+# ----------------------------
+
+MEMORY_ERROR = "Code execution failed due to an error: MemoryError: memory limit exceeded"
+
+
+def _vm_size_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def worker_main(conn, memory_mb: int) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # A forked worker starts with the parent's whole address space mapped,
+    # so the cap is relative to what is already there.
+    limit = _vm_size_bytes() + memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    while True:
+        try:
+            code, cpu_seconds = conn.recv()
+        except (EOFError, OSError):
+            return
+
+        # RLIMIT_CPU counts the whole process lifetime; allow cpu_seconds more
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = int(usage.ru_utime + usage.ru_stime) + 1
+        resource.setrlimit(resource.RLIMIT_CPU, (used + cpu_seconds, used + cpu_seconds + 1))
+
+        try:
+            output = exec_sandboxed(code)
+        except MemoryError:
+            output = error_result(MEMORY_ERROR)
+
+        try:
+            conn.send(output)
+        except (BrokenPipeError, OSError):
+            return
+        if output["text"] == MEMORY_ERROR:
+            # heap may be fragmented/huge now; let the parent replace us
+            return
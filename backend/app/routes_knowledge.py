@@ -4,6 +4,7 @@ from typing import Any, List, Optional
 import json
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 
 from app.storage import SessionLocal, Document, Chunk, delete_document_and_chunks, delete_chunk as storage_delete_chunk, collection
@@ -21,6 +22,7 @@ class DocumentOut(BaseModel):
     id: str
     title: str
     source: str
+    user_id: Optional[str] = None
     extra_meta: Optional[dict] = None
     created_at: datetime
 
@@ -65,6 +67,7 @@ def serialize_document(doc: Document) -> DocumentOut:
         id=doc.id,
         title=doc.title,
         source=doc.source,
+        user_id=doc.user_id,
         extra_meta=_parse_json_field(doc.extra_meta),
         created_at=doc.created_at,
     )
@@ -80,12 +83,17 @@ def serialize_chunk(chunk: Chunk) -> ChunkOut:
     )
 
 @router.get("/documents", response_model=List[DocumentOut])
-def list_documents(db: Session = Depends(get_db)):
+def list_documents(user_id: Optional[str] = None, db: Session = Depends(get_db)):
     """
     List all documents in the knowledge_db.
+    If user_id is provided, only that user's and shared documents are listed.
     Newest first.
     """
-    docs = db.query(Document).order_by(Document.created_at.desc()).all()
+    query = db.query(Document)
+    if user_id:
+        query = query.filter(or_(Document.user_id == user_id, Document.user_id.is_(None)))
+
+    docs = query.order_by(Document.created_at.desc()).all()
     return [serialize_document(d) for d in docs]
 
 @router.get("/documents/{doc_id}", response_model=DocumentOut)
@@ -1,13 +1,25 @@
-from .llm import get_llm_response
-from .tts import stream_audio_from_list
+from .llm import get_llm_response, retrieve_knowledge
+from .tts import stream_audio_from_list, stream_audio_from_deltas, get_tts_stats
+from .acknowledgements import take_acknowledgement, warm_ack_bank, get_ack_bank_stats, ACK_BANK_ENABLED
 from .transcription import (
     get_deepgram_transcription,
     stream_deepgram_transcription,
+    get_transcription_stats,
 )
 from .tools_arxiv import search_arxiv_papers
 from .tools_utils import ingest_text_with_gemini
 from .tools_web_search import search_general_web, search_patents
 from .tools_utils import *
-from .pdf_ingest import ingest_pdf, ingest_pdf_from_url
+from .pdf_ingest import (
+    ingest_pdf, ingest_pdf_file, ingest_pdf_from_url, schedule_pdf_link_ingestion,
+    PDFDownloadError, spool_upload, start_pdf_ingest, wait_pdf_ingest, get_pdf_ingest,
+)
 from .text_format import summarise_history
-from .text_utils import find_pdf_links
\ No newline at end of file
+from .text_utils import find_pdf_links, close_http_client
+from .prompt_budget import get_prefix_stats
+from .tool_cache import get_tool_cache_stats
+from .rag_queue import enqueue_rag_save, get_rag_queue_stats, start_rag_writer, stop_rag_writer
+from .tool_python import get_python_sandbox_stats, start_python_sandbox, stop_python_sandbox
+from .python_memo import get_python_memo_stats
+from .speculation import start_speculation, take_speculation, cancel_speculation, get_speculation_stats, SPECULATE_ENABLED
+from .cancellation import CancelToken, TurnCancelled, run_cancellable, begin_turn, end_turn, cancel_turn, get_cancellation_stats
@@ -0,0 +1,113 @@
+import os
+import random
+import threading
+from typing import Dict, List, Optional, Tuple
+from .tts import generate_murf_speech
+from app.upstream import upstream_lane
+
+# Short spoken fillers for tool turns, synthesized ahead of time so the
+# reply stream can start (as index 0) while the tool is still running.
+ACK_BANK_ENABLED = os.getenv("ACK_BANK_ENABLED", "1") == "1"
+# Murf styles warmed at startup; other styles / rates / pitches fill on first use
+ACK_BANK_STYLES = [s.strip() for s in os.getenv("ACK_BANK_STYLES", "Conversational").split(",") if s.strip()]
+
+ACK_PHRASES = {
+    "SEARCH_ARXIV": [
+        "Let me check arXiv for that.",
+        "One moment, I'm looking through recent papers.",
+        "Searching arXiv now.",
+    ],
+    "SEARCH_WEB": [
+        "Let me look that up.",
+        "Give me a second, I'm searching the web.",
+        "Checking the web for you.",
+    ],
+    "SEARCH_PATENTS": [
+        "Let me search the patent databases.",
+        "One moment, I'm looking through patents.",
+        "Checking patent records now.",
+    ],
+    "EXECUTE_CODE": [
+        "Let me work that out.",
+        "Give me a moment to calculate that.",
+        "Running the numbers now.",
+    ],
+}
+
+_bank: Dict[Tuple, List[Tuple[str, str]]] = {}   # (tool, style, rate, pitch) -> [(phrase, audio b64)]
+_filling: set = set()
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "clips": 0, "failures": 0}
+
+
+def _voice(settings: dict) -> Tuple:
+    # the only settings that change Murf's output
+    return (settings.get("style", "Conversational"), settings.get("rate", 0), settings.get("pitch", 0))
+
+
+def _fill(tool: str, settings: dict) -> None:
+    key = (tool, *_voice(settings))
+    entries = []
+    for phrase in ACK_PHRASES[tool]:
+        try:
+            entries.append((phrase, generate_murf_speech(phrase, settings)))
+        except Exception as e:
+            print(f"⚠️ Acknowledgement synthesis failed ({tool}): {e}")
+            with _lock:
+                _stats["failures"] += 1
+
+    with _lock:
+        _filling.discard(key)
+        if entries:
+            _bank[key] = entries
+            _stats["clips"] += len(entries)
+
+
+def _fill_background(tool: str, settings: dict) -> None:
+    with upstream_lane("background"):
+        _fill(tool, settings)
+
+
+def warm_ack_bank(settings: dict) -> None:
+    """Synthesize every phrase for each ACK_BANK_STYLES style (blocking; run off the event loop)."""
+    jobs = [(tool, {**settings, "style": style}) for style in ACK_BANK_STYLES for tool in ACK_PHRASES]
+    with _lock:
+        # turns that arrive mid-warmup shouldn't start duplicate fills
+        _filling.update((tool, *_voice(s)) for tool, s in jobs)
+    with upstream_lane("background"):
+        for tool, s in jobs:
+            _fill(tool, s)
+    print(f"🗣️ Acknowledgement bank ready ({_stats['clips']} clips)")
+
+
+def take_acknowledgement(tool: str, settings: dict) -> Optional[dict]:
+    """
+    A pre-synthesized {"text", "audio_chunk"} filler for `tool` in the
+    user's voice settings, or None. Never calls Murf on the request path: a
+    miss queues synthesis in the background so the next turn has one.
+    """
+    if not ACK_BANK_ENABLED or tool not in ACK_PHRASES:
+        return None
+
+    key = (tool, *_voice(settings))
+    with _lock:
+        entries = _bank.get(key)
+        if entries:
+            _stats["hits"] += 1
+        else:
+            _stats["misses"] += 1
+            start = key not in _filling
+            _filling.add(key)
+
+    if not entries:
+        if start:
+            threading.Thread(target=_fill_background, args=(tool, dict(settings)), daemon=True).start()
+        return None
+
+    phrase, audio_b64 = random.choice(entries)
+    return {"text": phrase, "audio_chunk": audio_b64}
+
+
+def get_ack_bank_stats() -> dict:
+    with _lock:
+        return {**_stats, "enabled": ACK_BANK_ENABLED, "voices": len({k[1:] for k in _bank})}
@@ -0,0 +1,188 @@
+import os
+import sys
+import wave
+from collections import deque
+from math import gcd
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+# Upstream audio stage for live transcription: resampling to 16 kHz
+# and an energy / zero-crossing voice activity gate that drops long silences.
+STT_VAD_ENABLED = os.getenv("STT_VAD_ENABLED", "1") == "1"
+STT_VAD_MIN_DB = float(os.getenv("STT_VAD_MIN_DB", "-50"))          # dBFS, never speech below this
+STT_VAD_MARGIN_DB = float(os.getenv("STT_VAD_MARGIN_DB", "10"))     # above the tracked noise floor
+STT_VAD_MAX_ZCR = float(os.getenv("STT_VAD_MAX_ZCR", "0.35"))       # crossings per sample
+STT_VAD_HANGOVER_MS = int(os.getenv("STT_VAD_HANGOVER_MS", "500"))  # keep sending after speech
+STT_VAD_PREROLL_MS = int(os.getenv("STT_VAD_PREROLL_MS", "200"))    # resent before speech onset
+
+RESAMPLER_TAPS = 48
+
+
+class Resampler:
+    """
+    Streaming rational-ratio resampler for 16-bit mono PCM (48 kHz → 16 kHz,
+    44.1 kHz → 16 kHz, ...): polyphase windowed-sinc low-pass with
+    `taps` coefficients per phase. Filter history and output phase carry
+    over between calls, so frames can be any length.
+    """
+
+    def __init__(self, in_rate: int, out_rate: int, taps: int = RESAMPLER_TAPS):
+        if in_rate <= 0 or out_rate <= 0:
+            raise ValueError(f"unsupported resampling ratio {in_rate}->{out_rate}")
+        g = gcd(in_rate, out_rate)
+        self.up, self.down = out_rate // g, in_rate // g
+        self._t = 0    # next output, in upsampled samples from the start of the next frame
+
+        if self.up == self.down:
+            self._bank = None
+            return
+
+        # designed at the upsampled rate, a little under the lower Nyquist
+        cutoff = 0.45 / max(self.up, self.down)
+        n = np.arange(taps * self.up) - (taps * self.up - 1) / 2
+        h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps * self.up)
+        h *= self.up / h.sum()     # zero-stuffing loses a factor of `up`
+        # phase p, reversed so row p lines up with a window of inputs:
+        # y[q*up + p] = sum_j h[j*up + p] * x[q - j]
+        self._bank = h.reshape(taps, self.up).T[:, ::-1].astype(np.float32)
+        self._hist = np.zeros(taps - 1, dtype=np.float32)
+
+    def process(self, pcm: bytes) -> bytes:
+        if self._bank is None or not pcm:
+            return pcm
+
+        x = np.frombuffer(pcm, dtype="<i2").astype(np.float32)
+        taps = self._bank.shape[1]
+        buf = np.concatenate([self._hist, x])
+        self._hist = buf[-(taps - 1):]
+
+        # outputs whose newest input sample is in this frame
+        total = len(x) * self.up
+        count = max(0, -(-(total - self._t) // self.down))
+        t = self._t + self.down * np.arange(count)
+        self._t += count * self.down - total
+
+        windows = np.lib.stride_tricks.sliding_window_view(buf, taps)[t // self.up]
+        out = np.einsum("ij,ij->i", windows, self._bank[t % self.up])
+        return np.clip(np.rint(out), -32768, 32767).astype("<i2").tobytes()
+
+
+def frame_features(pcm: bytes) -> Tuple[float, float]:
+    """(level in dBFS, zero-crossing rate) of a 16-bit mono frame."""
+    x = np.frombuffer(pcm, dtype="<i2").astype(np.float32)
+    if x.size == 0:
+        return -120.0, 0.0
+    rms = float(np.sqrt(np.mean(x * x)))
+    db = 20 * np.log10(rms / 32768.0) if rms > 0 else -120.0
+    zcr = float(np.count_nonzero(np.diff(np.signbit(x)))) / max(1, x.size - 1)
+    return db, zcr
+
+
+class VoiceActivityGate:
+    """
+    Lightweight VAD for the live bridge. A frame counts as speech when it is
+    STT_VAD_MARGIN_DB above the tracked noise floor (and above STT_VAD_MIN_DB);
+    marginal frames with a noise-like zero-crossing rate are rejected.
+
+    The gate stays open for STT_VAD_HANGOVER_MS after speech so Deepgram
+    still sees the trailing silence it needs for endpointing, and replays
+    STT_VAD_PREROLL_MS of audio when it opens so word onsets aren't clipped.
+    """
+
+    def __init__(self, sample_rate: int, frame_ms: int):
+        self.frame_ms = frame_ms
+        self._hangover = max(1, STT_VAD_HANGOVER_MS // frame_ms)
+        self._preroll: deque = deque(maxlen=max(0, STT_VAD_PREROLL_MS // frame_ms))
+        self._noise_db = STT_VAD_MIN_DB - STT_VAD_MARGIN_DB
+        self._quiet_frames = self._hangover   # start closed
+        self.is_open = False
+
+    def is_speech(self, pcm: bytes) -> bool:
+        db, zcr = frame_features(pcm)
+        threshold = max(STT_VAD_MIN_DB, self._noise_db + STT_VAD_MARGIN_DB)
+
+        speech = db >= threshold and (zcr <= STT_VAD_MAX_ZCR or db >= threshold + 6)
+        if not speech:
+            # noise floor follows quiet frames quickly downwards, slowly upwards
+            rate = 0.3 if db < self._noise_db else 0.02
+            self._noise_db += rate * (db - self._noise_db)
+        return speech
+
+    def process(self, pcm: bytes) -> Tuple[List[bytes], Optional[str]]:
+        """
+        Feed one frame. Returns (frames to send upstream, event) where event
+        is "start" when the gate opens, "end" when it closes, else None.
+        """
+        if self.is_speech(pcm):
+            self._quiet_frames = 0
+        else:
+            self._quiet_frames += 1
+
+        if self._quiet_frames < self._hangover:
+            if self.is_open:
+                return [pcm], None
+            self.is_open = True
+            frames = list(self._preroll) + [pcm]
+            self._preroll.clear()
+            return frames, "start"
+
+        if self._preroll.maxlen:
+            self._preroll.append(pcm)
+        if self.is_open:
+            self.is_open = False
+            return [], "end"
+        return [], None
+
+
+def process_wav(path: str, out_rate: int = 16000, frame_ms: int = 40, out_path: Optional[str] = None) -> dict:
+    """
+    Run a mono 16-bit WAV through the same resample + VAD stage as the live
+    bridge, offline. Optionally writes the audio that would be sent.
+    """
+    with wave.open(path, "rb") as wf:
+        if wf.getnchannels() != 1 or wf.getsampwidth() != 2:
+            raise ValueError("expected mono 16-bit PCM WAV")
+        in_rate = wf.getframerate()
+        pcm = wf.readframes(wf.getnframes())
+
+    resampler = Resampler(in_rate, out_rate)
+    gate = VoiceActivityGate(out_rate, frame_ms)
+    frame_bytes = in_rate * 2 * frame_ms // 1000
+
+    sent = []
+    segments = []
+    for i, start in enumerate(range(0, len(pcm), frame_bytes)):
+        frame = resampler.process(pcm[start:start + frame_bytes])
+        if not STT_VAD_ENABLED:
+            sent.append(frame)
+            continue
+        frames, event = gate.process(frame)
+        sent.extend(frames)
+        if event == "start":
+            segments.append([i * frame_ms, None])
+        elif event == "end":
+            segments[-1][1] = i * frame_ms
+
+    if segments and segments[-1][1] is None:
+        segments[-1][1] = len(pcm) * 1000 // (in_rate * 2)
+
+    out = b"".join(sent)
+    if out_path:
+        with wave.open(out_path, "wb") as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(out_rate)
+            wf.writeframes(out)
+
+    return {
+        "input_bytes": len(pcm),
+        "sent_bytes": len(out),
+        "reduction": round(len(pcm) / len(out), 2) if out else None,
+        "speech_segments_ms": [tuple(s) for s in segments],
+    }
+
+
+if __name__ == "__main__":
+    # python -m app.services.audio_dsp input.wav [gated_output.wav]
+    print(process_wav(sys.argv[1], out_path=sys.argv[2] if len(sys.argv) > 2 else None))
@@ -0,0 +1,126 @@
+import asyncio
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+_cancelled: Dict[str, int] = {}   # reason -> count
+
+
+class TurnCancelled(Exception):
+    """Raised inside a chat turn once it has been cancelled (barge-in, disconnect)."""
+
+
+class CancelToken:
+    """
+    Thread-safe cancellation flag shared by everything a chat turn runs:
+    the LLM call, tools and TTS. Work that holds an upstream connection
+    registers a callback with `on_cancel` to close it right away instead of
+    waiting for the next `check()`.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: list = []
+        self.reason: Optional[str] = None
+        self.started_at = time.monotonic()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled") -> bool:
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+            _cancelled[reason] = _cancelled.get(reason, 0) + 1
+
+        for cb in callbacks:
+            try:
+                cb()
+            except Exception as e:
+                print("Cancel callback error:", e)
+        return True
+
+    def check(self) -> None:
+        if self._event.is_set():
+            raise TurnCancelled(self.reason)
+
+    def wait(self, timeout: float) -> bool:
+        """Sleep up to `timeout` seconds, waking early on cancel. Returns True if cancelled."""
+        return self._event.wait(timeout)
+
+    def on_cancel(self, cb: Callable[[], None]) -> Callable[[], None]:
+        """Run `cb` when the token is cancelled (now, if it already is). Returns an unregister function."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(cb)
+                return lambda: self._discard(cb)
+        cb()
+        return lambda: None
+
+    def _discard(self, cb) -> None:
+        with self._lock:
+            if cb in self._callbacks:
+                self._callbacks.remove(cb)
+
+
+async def run_cancellable(token: CancelToken, aw: Awaitable[T]) -> T:
+    """Await `aw`, cancelling it as soon as `token` is cancelled (raises TurnCancelled)."""
+    task = asyncio.ensure_future(aw)
+    loop = asyncio.get_running_loop()
+    unregister = token.on_cancel(lambda: loop.call_soon_threadsafe(task.cancel))
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if token.cancelled and task.cancelled():
+            raise TurnCancelled(token.reason)
+        raise
+    finally:
+        unregister()
+
+
+# One active turn per user; starting a new one or barging in cancels it
+_turns: Dict[str, CancelToken] = {}
+_stats: Dict[str, int] = {"turns": 0, "completed": 0}
+
+
+def begin_turn(user_id: str) -> CancelToken:
+    cancel_turn(user_id, "superseded")
+    token = CancelToken()
+    _turns[user_id] = token
+    _stats["turns"] += 1
+    return token
+
+
+def end_turn(user_id: str, token: CancelToken) -> None:
+    if _turns.get(user_id) is token:
+        del _turns[user_id]
+    if not token.cancelled:
+        _stats["completed"] += 1
+
+
+def cancel_turn(user_id: str, reason: str = "barge-in", started_before: Optional[float] = None) -> bool:
+    """
+    Cancel the user's active turn, if any. With `started_before` (a
+    time.monotonic() value) only a turn that began before then is cancelled.
+    Returns True if one was cancelled.
+    """
+    token = _turns.get(user_id)
+    if token is None or (started_before is not None and token.started_at >= started_before):
+        return False
+    del _turns[user_id]
+    if not token.cancel(reason):
+        return False
+    print(f"⏹️ Cancelled turn for {user_id} ({reason})")
+    return True
+
+
+def get_cancellation_stats() -> Dict[str, int]:
+    return {**_stats, "active": len(_turns), "cancelled": dict(_cancelled)}
@@ -0,0 +1,423 @@
+import ast
+import json
+import re
+from typing import Any, Dict, List, Optional
+
+# The reply envelope the system prompt asks for
+ENVELOPE_KEYS = ("text", "config", "tool", "args")
+
+_ESCAPES = {
+    '"': '"', "'": "'", "\\": "\\", "/": "/",
+    "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t",
+}
+_SPECIAL = {
+    '"': re.compile(r'["\\]'),
+    "'": re.compile(r"['\\]"),
+}
+_WS = " \t\r\n"
+_BARE_KEY = re.compile(r"[A-Za-z_]\w*")
+
+# parser states
+_SEEK_OBJECT, _SEEK_KEY, _SEEK_COLON, _SEEK_VALUE, _IN_STRING, _IN_COMPOSITE, _IN_LITERAL, _DONE = range(8)
+
+
+class EnvelopeParser:
+    """
+    Tolerant, incremental parser for the LLM's {text, config, tool, args} reply.
+
+    Feed it the response as it arrives; `feed()` returns whatever new part of
+    the "text" value became available, `close()` returns the parsed envelope.
+
+    Unlike json.loads it survives the usual LLM mistakes: unescaped quotes
+    inside string values (a quote only ends a value if it is followed by
+    `, "<envelope key>":` or by the closing brace), single-quoted or bare keys and
+    values, prose or code fences around the object, and truncated output.
+    """
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._state = _SEEK_OBJECT
+        self._final = False
+
+        self._key: Optional[str] = None
+        self._quote = '"'
+        self._parts: List[str] = []     # decoded pieces of the current string
+        self._start = 0                 # start of the current composite/literal
+        self._depth = 0
+        self._in_str: Optional[str] = None
+
+        self._values: Dict[str, Any] = {}
+        self._delta: List[str] = []
+
+    # ------------------------------------------------------------------
+    # public API
+    # ------------------------------------------------------------------
+
+    def feed(self, chunk: str) -> str:
+        """Consume the next piece of the response; return new "text" content."""
+        if chunk:
+            self._buf += chunk
+            self._run()
+        return self._take_delta()
+
+    def close(self) -> Dict[str, Any]:
+        """Finish parsing and return the envelope with all four keys."""
+        self._final = True
+        self._run()
+
+        # truncated mid-value: keep what we have
+        if self._state == _IN_STRING:
+            self._store("".join(self._parts))
+        elif self._state in (_IN_COMPOSITE, _IN_LITERAL):
+            self._store(self._decode_raw(self._buf[self._start:]))
+
+        if not any(k in self._values for k in ENVELOPE_KEYS):
+            # Not an envelope at all; speak the raw response
+            text = self._buf.strip()
+            if text:
+                self._delta.append(text)
+            return {"text": text, "config": {}, "tool": "", "args": ""}
+
+        return self.result()
+
+    def result(self) -> Dict[str, Any]:
+        """The envelope as parsed so far."""
+        return _normalise(self._values)
+
+    # ------------------------------------------------------------------
+    # state machine
+    # ------------------------------------------------------------------
+
+    def _take_delta(self) -> str:
+        if not self._delta:
+            return ""
+        out = "".join(self._delta)
+        self._delta.clear()
+        return out
+
+    def _store(self, value: Any) -> None:
+        if self._key is not None:
+            self._values[self._key] = value
+        self._key = None
+        self._parts = []
+
+    def _compact(self) -> None:
+        # drop consumed input so the buffer doesn't keep growing; before the
+        # first envelope key we may still need all of it for the raw fallback
+        if self._pos > 4096 and self._state not in (_IN_COMPOSITE, _IN_LITERAL) \
+                and (self._values or self._key in ENVELOPE_KEYS):
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+
+    def _skip_ws(self) -> bool:
+        buf, n, i = self._buf, len(self._buf), self._pos
+        while i < n and buf[i] in _WS:
+            i += 1
+        self._pos = i
+        return i < n
+
+    def _run(self) -> None:
+        while True:
+            state = self._state
+            if state == _DONE:
+                return
+            if state == _SEEK_OBJECT:
+                i = self._buf.find("{", self._pos)
+                if i == -1:
+                    return
+                self._pos = i + 1
+                self._state = _SEEK_KEY
+            elif state == _SEEK_KEY:
+                if not self._seek_key():
+                    return
+            elif state == _SEEK_COLON:
+                if not self._skip_ws():
+                    return
+                if self._buf[self._pos] == ":":
+                    self._pos += 1
+                self._state = _SEEK_VALUE
+            elif state == _SEEK_VALUE:
+                if not self._seek_value():
+                    return
+            elif state == _IN_STRING:
+                if not self._scan_string():
+                    return
+            elif state == _IN_COMPOSITE:
+                if not self._scan_composite():
+                    return
+            elif state == _IN_LITERAL:
+                if not self._scan_literal():
+                    return
+            self._compact()
+
+    def _seek_key(self) -> bool:
+        buf = self._buf
+        while self._skip_ws():
+            ch = buf[self._pos]
+            if ch == ",":
+                self._pos += 1
+                continue
+            if ch == "}":
+                self._pos += 1
+                self._state = _DONE
+                return True
+            if ch in "\"'":
+                end = buf.find(ch, self._pos + 1)
+                if end == -1:
+                    return False
+                self._key = buf[self._pos + 1:end]
+                self._pos = end + 1
+                self._state = _SEEK_COLON
+                return True
+
+            m = _BARE_KEY.match(buf, self._pos)
+            if not m:
+                # junk between members, skip it
+                self._pos += 1
+                continue
+            if m.end() == len(buf) and not self._final:
+                return False
+            self._key = m.group(0)
+            self._pos = m.end()
+            self._state = _SEEK_COLON
+            return True
+        return False
+
+    def _seek_value(self) -> bool:
+        if not self._skip_ws():
+            return False
+        ch = self._buf[self._pos]
+        if ch in "\"'":
+            self._quote = ch
+            self._parts = []
+            self._pos += 1
+            self._state = _IN_STRING
+        elif ch in "{[":
+            self._start = self._pos
+            self._depth = 0
+            self._in_str = None
+            self._state = _IN_COMPOSITE
+        else:
+            self._start = self._pos
+            self._state = _IN_LITERAL
+        return True
+
+    def _emit(self, piece: str) -> None:
+        self._parts.append(piece)
+        if self._key == "text":
+            self._delta.append(piece)
+
+    def _scan_string(self) -> bool:
+        buf, q = self._buf, self._quote
+        special = _SPECIAL[q]
+        n = len(buf)
+
+        while True:
+            m = special.search(buf, self._pos)
+            if m is None:
+                if self._pos < n:
+                    self._emit(buf[self._pos:])
+                    self._pos = n
+                return False
+
+            i = m.start()
+            if i > self._pos:
+                self._emit(buf[self._pos:i])
+                self._pos = i
+
+            if buf[i] == "\\":
+                if i + 1 >= n:
+                    return False
+                esc = buf[i + 1]
+                if esc == "u":
+                    if i + 6 > n:
+                        if not self._final:
+                            return False
+                        self._emit(buf[i:])
+                        self._pos = n
+                        return False
+                    try:
+                        self._emit(chr(int(buf[i + 2:i + 6], 16)))
+                        self._pos = i + 6
+                    except ValueError:
+                        self._emit("\\u")
+                        self._pos = i + 2
+                    continue
+                # unknown escapes (e.g. "\_" in Mermaid labels) are kept verbatim
+                self._emit(_ESCAPES.get(esc, "\\" + esc))
+                self._pos = i + 2
+                continue
+
+            # a quote: is it the end of the value, or just a stray quote?
+            verdict = self._closes_value(i + 1)
+            if verdict is None:
+                return False
+            if verdict:
+                self._pos = i + 1
+                self._store("".join(self._parts))
+                self._state = _SEEK_KEY
+                return True
+            self._emit(q)
+            self._pos = i + 1
+
+    def _closes_value(self, j: int) -> Optional[bool]:
+        """
+        Decide whether a quote right before buf[j] terminates a string value.
+        Returns None if more input is needed to tell.
+        """
+        buf, n = self._buf, len(self._buf)
+        while j < n and buf[j] in _WS:
+            j += 1
+        if j >= n:
+            return True if self._final else None
+
+        ch = buf[j]
+        if ch == "}":
+            # the closing brace, unless more of this string value follows
+            k = j + 1
+            while k < n and buf[k] in _WS:
+                k += 1
+            if k >= n:
+                return True if self._final else None
+            return buf[k] == "`" or buf.find(self._quote, k) == -1
+        if ch != ",":
+            return False
+
+        j += 1
+        while j < n and buf[j] in _WS:
+            j += 1
+        if j >= n:
+            return True if self._final else None
+        # the next key may be quoted or bare
+        quote = buf[j] if buf[j] in "\"'" else ""
+        if quote:
+            j += 1
+
+        for key in ENVELOPE_KEYS:
+            end = j + len(key) + len(quote)
+            candidate = buf[j:end]
+            if len(candidate) < len(key) + len(quote):
+                if (key + quote).startswith(candidate) and not self._final:
+                    return None
+                continue
+            if candidate == key + quote:
+                k = end
+                while k < n and buf[k] in _WS:
+                    k += 1
+                if k >= n:
+                    return True if self._final else None
+                return buf[k] == ":"
+        return False
+
+    def _scan_composite(self) -> bool:
+        buf, n = self._buf, len(self._buf)
+        i = self._pos
+        while i < n:
+            ch = buf[i]
+            if self._in_str:
+                if ch == "\\":
+                    i += 2
+                    continue
+                if ch == self._in_str:
+                    self._in_str = None
+            elif ch in "\"'":
+                self._in_str = ch
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    raw = buf[self._start:i + 1]
+                    self._pos = i + 1
+                    value = _load_composite(raw)
+                    if self._key == "text" and isinstance(value, list):
+                        self._delta.append("".join(str(t) for t in value))
+                    self._store(value)
+                    self._state = _SEEK_KEY
+                    return True
+            i += 1
+        # may point one past the end if we stopped on a backslash
+        self._pos = i
+        return False
+
+    def _scan_literal(self) -> bool:
+        buf, n = self._buf, len(self._buf)
+        i = self._pos
+        while i < n and buf[i] not in ",}":
+            i += 1
+        if i >= n:
+            self._pos = n
+            return False
+        self._store(self._decode_raw(buf[self._start:i].strip()))
+        self._pos = i
+        self._state = _SEEK_KEY
+        return True
+
+    @staticmethod
+    def _decode_raw(raw: str) -> Any:
+        raw = raw.strip()
+        if not raw:
+            return ""
+        if raw[0] in "{[":
+            return _load_composite(raw)
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return raw
+
+
+def _normalise(values: Dict[str, Any]) -> Dict[str, Any]:
+    text = values.get("text", "")
+    if isinstance(text, list):
+        text = "".join(str(t) for t in text)
+    config = values.get("config", {})
+    if not isinstance(config, dict):
+        config = {}
+
+    return {
+        "text": text if isinstance(text, str) else str(text),
+        "config": config,
+        "tool": _as_str(values.get("tool", "")),
+        "args": _as_str(values.get("args", "")),
+    }
+
+
+def _load_composite(raw: str) -> Any:
+    try:
+        return json.loads(raw)
+    except ValueError:
+        pass
+    try:
+        # single-quoted / Python-style dicts
+        return ast.literal_eval(raw)
+    except (ValueError, SyntaxError):
+        return {} if raw.startswith("{") else []
+
+
+def _as_str(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list):
+        return "\n".join(str(v) for v in value)
+    return str(value)
+
+
+def parse_llm_envelope(response: str) -> Dict[str, Any]:
+    """
+    Parse a complete LLM reply into {text, config, tool, args}.
+    Well-formed JSON takes the json.loads fast path.
+    """
+    try:
+        parsed = json.loads(response)
+        if isinstance(parsed, dict):
+            return _normalise(parsed)
+    except (ValueError, TypeError):
+        pass
+
+    print("⚠️ JSON Error (likely unescaped quotes). Parsing tolerantly...")
+    parser = EnvelopeParser()
+    parser.feed(response)
+    return parser.close()
@@ -0,0 +1,70 @@
+# MPEG audio frame scanning, so streamed MP3 can be cut into pieces that
+# each decode on their own (the browser plays every audio_chunk separately).
+
+# bitrate tables (kbps) by [version is MPEG1][layer]
+_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def frame_length(header: bytes) -> int:
+    """Length in bytes of the MPEG audio frame starting with `header` (4 bytes), or 0 if invalid."""
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return 0
+    version = (header[1] >> 3) & 0x3          # 3 = MPEG1, 2 = MPEG2, 0 = MPEG2.5
+    layer = 4 - ((header[1] >> 1) & 0x3)      # 1..3
+    bitrate_idx = header[2] >> 4
+    rate_idx = (header[2] >> 2) & 0x3
+    padding = (header[2] >> 1) & 0x1
+    if version == 1 or layer == 4 or bitrate_idx in (0, 15) or rate_idx == 3:
+        return 0
+
+    mpeg1 = version == 3
+    bitrate = _BITRATES[(mpeg1, layer)][bitrate_idx] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_idx]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4
+    if layer == 3 and not mpeg1:
+        return 72 * bitrate // sample_rate + padding
+    return 144 * bitrate // sample_rate + padding
+
+
+def _id3_length(buf: bytes) -> int:
+    if len(buf) < 10 or buf[:3] != b"ID3":
+        return 0
+    size = 0
+    for b in buf[6:10]:
+        size = (size << 7) | (b & 0x7F)   # synchsafe integer
+    return 10 + size
+
+
+def complete_frames_end(buf: bytes, start: int = 0) -> int:
+    """
+    Offset just past the last complete MP3 frame in `buf` (scanning from
+    `start`, skipping a leading ID3 tag). Returns -1 if `buf` doesn't look
+    like MP3, so callers can fall back to plain byte-range cuts.
+    """
+    pos = start
+    if pos == 0:
+        id3 = _id3_length(buf)
+        if id3:
+            if id3 > len(buf):
+                return 0
+            pos = id3
+
+    end = pos
+    while pos + 4 <= len(buf):
+        length = frame_length(buf[pos:pos + 4])
+        if length == 0:
+            return -1 if end == start else end
+        if pos + length > len(buf):
+            break
+        pos += length
+        end = pos
+    return end
@@ -1,27 +1,236 @@
+import asyncio
 import fitz
+import hashlib
 import json
+import mmap
 import os
-import httpx
+import tempfile
+import time
 import uuid
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Union
 import google.generativeai as genai
 from app.storage import store_document_chunks
+from app.upstream import set_upstream_lane, upstream_call
+from .text_utils import GENERIC_URL_PATTERN, get_http_client, iter_pdf_links
 
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 gemini = genai.GenerativeModel("gemini-2.5-pro")
 
-async def ingest_pdf_from_url(url: str):
+# Downloads stream to a temp file on disk instead of being held in memory
+PDF_MAX_BYTES = int(os.getenv("PDF_MAX_BYTES", str(50 * 1024 * 1024)))
+PDF_DOWNLOAD_TIMEOUT = float(os.getenv("PDF_DOWNLOAD_TIMEOUT", "60"))
+PDF_DOWNLOAD_CHUNK = 64 * 1024
+PDF_CONTENT_TYPES = ("application/pdf", "application/x-pdf", "application/octet-stream", "binary/octet-stream")
+
+
+class PDFDownloadError(Exception):
+    pass
+
+
+async def download_pdf(url: str, max_bytes: int = PDF_MAX_BYTES) -> str:
+    """
+    Stream `url` into a temporary .pdf file and return its path.
+    Rejects non-PDF content types and anything larger than `max_bytes`
+    (checked against Content-Length up front and while streaming).
+    The caller owns the file and must delete it.
+    """
+    client = get_http_client()
+    fd, path = tempfile.mkstemp(suffix=".pdf", prefix="ingest-")
     try:
-        async with httpx.AsyncClient() as client:
-            pdf = await client.get(url)
-            pdf.raise_for_status()
+        async with client.stream("GET", url, timeout=PDF_DOWNLOAD_TIMEOUT) as resp:
+            resp.raise_for_status()
+
+            content_type = resp.headers.get("content-type", "").split(";")[0].strip().lower()
+            if content_type and content_type not in PDF_CONTENT_TYPES:
+                raise PDFDownloadError(f"not a PDF (content-type {content_type})")
+
+            length = resp.headers.get("content-length")
+            if length and length.isdigit() and int(length) > max_bytes:
+                raise PDFDownloadError(f"PDF too large ({int(length)} bytes > {max_bytes})")
+
+            size = 0
+            with os.fdopen(fd, "wb") as out:
+                fd = None
+                async for chunk in resp.aiter_bytes(PDF_DOWNLOAD_CHUNK):
+                    if size == 0 and not chunk.lstrip().startswith(b"%PDF"):
+                        raise PDFDownloadError("not a PDF (missing %PDF header)")
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise PDFDownloadError(f"PDF too large (> {max_bytes} bytes)")
+                    out.write(chunk)
+
+        return path
+
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        os.unlink(path)
+        raise
+
+
+async def ingest_pdf_from_url(url: str, user_id: Optional[str] = None):
+    set_upstream_lane("background")   # this task only
+    try:
+        path = await download_pdf(url)
+    except Exception as e:
+        print("PDF ingest error:", e)
+        return
 
+    try:
         title = url.split("/")[-1].replace(".pdf", "")
         doc_id = str(uuid.uuid4())
 
-        ingest_pdf(pdf.content, doc_id, title)
+        # extraction + chunking are blocking; keep them off the event loop
+        await asyncio.to_thread(ingest_pdf_file, path, doc_id, title, user_id)
 
     except Exception as e:
         print("PDF ingest error:", e)
+    finally:
+        os.unlink(path)
+
+
+# Uploads: spooled to disk in chunks and hashed while they stream, then
+# ingested in the background. Callers get an ingest id to poll.
+PDF_INGEST_JOBS_KEPT = int(os.getenv("PDF_INGEST_JOBS_KEPT", "200"))
+
+_ingest_jobs: "OrderedDict[str, dict]" = OrderedDict()   # ingest id -> job
+_ingest_tasks: Dict[str, asyncio.Task] = {}
+
+
+async def spool_upload(upload, max_bytes: int = PDF_MAX_BYTES) -> Tuple[str, str, int]:
+    """
+    Copy an UploadFile to a temporary .pdf file in PDF_DOWNLOAD_CHUNK pieces,
+    hashing as it goes. Returns (path, sha256 hex, size); the caller owns
+    the file. Raises PDFDownloadError for non-PDFs and oversized uploads.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    fd, path = tempfile.mkstemp(suffix=".pdf", prefix="upload-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = await upload.read(PDF_DOWNLOAD_CHUNK)
+                if not chunk:
+                    break
+                if size == 0 and not chunk.lstrip().startswith(b"%PDF"):
+                    raise PDFDownloadError("not a PDF (missing %PDF header)")
+                size += len(chunk)
+                if size > max_bytes:
+                    raise PDFDownloadError(f"PDF too large (> {max_bytes} bytes)")
+                digest.update(chunk)
+                out.write(chunk)
+
+        if size == 0:
+            raise PDFDownloadError("empty upload")
+        return path, digest.hexdigest(), size
+
+    except BaseException:
+        os.unlink(path)
+        raise
+
+
+def start_pdf_ingest(path: str, doc_id: str, title: str, sha256: str, size: int,
+                     user_id: Optional[str] = None) -> dict:
+    """
+    Ingest a spooled PDF in the background and return its job record.
+    The file is deleted once ingestion finishes. An identical upload
+    (same hash and user) that is still running or succeeded is reused.
+    """
+    for job in reversed(_ingest_jobs.values()):
+        if job["sha256"] == sha256 and job["user_id"] == user_id and job["status"] != "error":
+            os.unlink(path)
+            return job
+
+    ingest_id = str(uuid.uuid4())
+    job = {
+        "ingest_id": ingest_id,
+        "doc_id": doc_id,
+        "title": title,
+        "user_id": user_id,
+        "sha256": sha256,
+        "size": size,
+        "status": "pending",
+        "error": None,
+        "stored": None,
+        "created_at": time.time(),
+    }
+    _ingest_jobs[ingest_id] = job
+    _prune_ingest_jobs()
+
+    task = asyncio.create_task(_run_ingest_job(job, path))
+    _ingest_tasks[ingest_id] = task
+    task.add_done_callback(lambda _t: _ingest_tasks.pop(ingest_id, None))
+    return job
+
+
+async def wait_pdf_ingest(ingest_id: str) -> Optional[dict]:
+    task = _ingest_tasks.get(ingest_id)
+    if task is not None:
+        await asyncio.shield(task)
+    return _ingest_jobs.get(ingest_id)
+
+
+def get_pdf_ingest(ingest_id: str) -> Optional[dict]:
+    return _ingest_jobs.get(ingest_id)
+
+
+async def _run_ingest_job(job: dict, path: str) -> None:
+    set_upstream_lane("background")   # this task only
+    job["status"] = "running"
+    try:
+        stored = await asyncio.to_thread(
+            ingest_pdf_file, path, job["doc_id"], job["title"], job["user_id"],
+            {"sha256": job["sha256"], "bytes": job["size"]},
+        )
+        # store_document_chunks reports failures as {"error": ...}
+        if isinstance(stored, dict) and "error" in stored:
+            raise RuntimeError(stored["error"])
+        job["stored"] = stored
+        job["status"] = "done"
+    except Exception as e:
+        print("PDF ingest error:", e)
+        job["status"] = "error"
+        job["error"] = str(e)
+    finally:
+        job["finished_at"] = time.time()
+        os.unlink(path)
+
+
+def _prune_ingest_jobs() -> None:
+    while len(_ingest_jobs) > PDF_INGEST_JOBS_KEPT:
+        oldest = next(iter(_ingest_jobs))
+        if _ingest_jobs[oldest]["status"] in ("pending", "running"):
+            break
+        _ingest_jobs.popitem(last=False)
+
+
+_link_tasks: set = set()
+
+
+def schedule_pdf_link_ingestion(text: str, user_id: Optional[str] = None) -> None:
+    """
+    Find PDF links in a chat message and ingest them, entirely in the
+    background: the chat turn never waits for link classification, and each
+    ingest starts as soon as its URL is known to be a PDF.
+    """
+    if not GENERIC_URL_PATTERN.search(text):
+        return
+
+    task = asyncio.create_task(_ingest_pdf_links(text, user_id))
+    _link_tasks.add(task)
+    task.add_done_callback(_link_tasks.discard)
+
+
+async def _ingest_pdf_links(text: str, user_id: Optional[str]) -> None:
+    try:
+        async for url in iter_pdf_links(text):
+            print(f"📄 PDF link found, ingesting: {url}")
+            task = asyncio.create_task(ingest_pdf_from_url(url, user_id))
+            _link_tasks.add(task)
+            task.add_done_callback(_link_tasks.discard)
+    except Exception as e:
+        print("PDF link detection error:", e)
 
 
 def extract_between_first_and_last(text: str):
@@ -32,22 +241,43 @@ def extract_between_first_and_last(text: str):
     return text[start:end+1]
 
 
-def extract_pdf_text(pdf_bytes: bytes) -> str:
-    """Extract raw text using PyMuPDF."""
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    full_text = ""
-    for page in doc:
-        full_text += page.get_text()
-    return full_text
+def extract_pdf_text(pdf: Union[bytes, str]) -> str:
+    """
+    Extract raw text using PyMuPDF, from PDF bytes or a file path.
+    Files are memory-mapped rather than read into a bytes object.
+    """
+    if not isinstance(pdf, str):
+        with fitz.open(stream=pdf, filetype="pdf") as doc:
+            return "".join(page.get_text() for page in doc)
+
+    with open(pdf, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            with fitz.open(stream=view, filetype="pdf") as doc:
+                return "".join(page.get_text() for page in doc)
+        finally:
+            view.release()
 
-def ingest_pdf(pdf_bytes: bytes, doc_id: str, title: str):
+def ingest_pdf(pdf_bytes: bytes, doc_id: str, title: str, user_id: Optional[str] = None):
     print("Extracting...")
     raw_text = extract_pdf_text(pdf_bytes)
-    
+    return _chunk_and_store(raw_text, doc_id, title, user_id)
+
+def ingest_pdf_file(path: str, doc_id: str, title: str, user_id: Optional[str] = None,
+                    extra_meta: Optional[dict] = None):
+    """Like ingest_pdf, but reads the PDF from disk."""
+    print("Extracting...")
+    raw_text = extract_pdf_text(path)
+    return _chunk_and_store(raw_text, doc_id, title, user_id, extra_meta)
+
+def _chunk_and_store(raw_text: str, doc_id: str, title: str, user_id: Optional[str],
+                     extra_meta: Optional[dict] = None):
     print("Thinking...")
 
     # Ask Gemini for semantic chunking
-    response = gemini.generate_content(
+    response = upstream_call(
+        "gemini",
+        gemini.generate_content,
         """
         Convert the following document into JSON chunks.
 
@@ -82,5 +312,6 @@ def ingest_pdf(pdf_bytes: bytes, doc_id: str, title: str):
         title=title,
         source="pdf",
         chunks=chunks,
-        extra_meta={"length": len(raw_text)}
+        extra_meta={**(extra_meta or {}), "length": len(raw_text)},
+        user_id=user_id,
     )
@@ -0,0 +1,116 @@
+import ast
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# Memoization of deterministic EXECUTE_CODE snippets, keyed by a hash of the
+# normalized AST so formatting/comment differences still hit.
+PYTHON_MEMO_MAX_ENTRIES = int(os.getenv("PYTHON_MEMO_MAX_ENTRIES", "256"))
+PYTHON_MEMO_MAX_BYTES = int(os.getenv("PYTHON_MEMO_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Globals a cacheable snippet may read (besides names it assigns itself)
+_SAFE_GLOBALS = {
+    "math", "np", "numpy",
+    "abs", "all", "any", "bool", "complex", "dict", "divmod", "enumerate",
+    "filter", "float", "int", "len", "list", "map", "max", "min", "pow",
+    "print", "range", "reversed", "round", "set", "sorted", "str", "sum",
+    "tuple", "zip", "True", "False", "None",
+}
+
+# Attributes that make results vary between runs (or reach outside math/np)
+_UNSAFE_ATTRS = {"random", "empty", "empty_like", "datetime64", "load", "fromfile", "memmap"}
+
+_cache: "OrderedDict[str, tuple]" = OrderedDict()   # key -> (result, size)
+_lock = threading.Lock()
+_bytes = 0
+_stats = {"hits": 0, "misses": 0, "uncacheable": 0, "evictions": 0}
+
+
+def _assigned_names(tree: ast.AST) -> set:
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, ast.FunctionDef):
+            names.add(node.name)
+    return names
+
+
+def memo_key(code: str) -> Optional[str]:
+    """
+    Hash of the normalized AST if `code` is deterministic, i.e. it only uses
+    the whitelisted math/np namespace and plain builtins, with no randomness,
+    imports or dunder access. Returns None for code that must not be cached.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+
+    local = _assigned_names(tree)
+
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.Global, ast.Nonlocal, ast.AsyncFunctionDef, ast.Await)):
+            return None
+        if isinstance(node, ast.Attribute):
+            if node.attr.startswith("_") or node.attr in _UNSAFE_ATTRS:
+                return None
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            if node.id not in _SAFE_GLOBALS and node.id not in local:
+                return None
+
+    normalized = ast.dump(tree, annotate_fields=False, include_attributes=False)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def _size_of(result: dict) -> int:
+    try:
+        return len(json.dumps(result))
+    except (TypeError, ValueError):
+        return len(str(result))
+
+
+def memo_get(key: str) -> Optional[dict]:
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None:
+            _stats["misses"] += 1
+            return None
+        _cache.move_to_end(key)
+        _stats["hits"] += 1
+        return entry[0]
+
+
+def memo_put(key: str, result: dict) -> None:
+    global _bytes
+    size = _size_of(result)
+    if size > PYTHON_MEMO_MAX_BYTES:
+        return
+
+    with _lock:
+        old = _cache.pop(key, None)
+        if old is not None:
+            _bytes -= old[1]
+
+        _cache[key] = (result, size)
+        _bytes += size
+
+        while _cache and (len(_cache) > PYTHON_MEMO_MAX_ENTRIES or _bytes > PYTHON_MEMO_MAX_BYTES):
+            _, (_, evicted) = _cache.popitem(last=False)
+            _bytes -= evicted
+            _stats["evictions"] += 1
+
+
+def note_uncacheable() -> None:
+    with _lock:
+        _stats["uncacheable"] += 1
+
+
+def get_python_memo_stats() -> dict:
+    with _lock:
+        return {**_stats, "entries": len(_cache), "bytes": _bytes}
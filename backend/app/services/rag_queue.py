@@ -0,0 +1,198 @@
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from app.storage import deferred_indexing
+from app.upstream import set_upstream_lane
+
+# Write-behind persistence of tool results into RAG. Chat turns enqueue a
+# save and move on; a background worker does the chunking, rewriting,
+# embedding and Chroma writes. The jobs of one batch share batched embedding
+# calls and a single Chroma upsert.
+RAG_QUEUE_MAX_SIZE = int(os.getenv("RAG_QUEUE_MAX_SIZE", "1000"))
+RAG_FLUSH_INTERVAL = float(os.getenv("RAG_FLUSH_INTERVAL", "1.0"))     # seconds
+RAG_FLUSH_BATCH = int(os.getenv("RAG_FLUSH_BATCH", "16"))
+RAG_MAX_ATTEMPTS = int(os.getenv("RAG_MAX_ATTEMPTS", "3"))
+RAG_RETRY_BACKOFF = float(os.getenv("RAG_RETRY_BACKOFF", "2.0"))       # seconds, doubled per attempt
+RAG_DEDUPE_WINDOW = float(os.getenv("RAG_DEDUPE_WINDOW", "600"))       # seconds
+
+
+class _SaveJob:
+    __slots__ = ("key", "fn", "kwargs", "attempts", "not_before")
+
+    def __init__(self, key: str, fn: Callable[..., Any], kwargs: Dict[str, Any]):
+        self.key = key
+        self.fn = fn
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.not_before = 0.0
+
+
+_queue: "queue.Queue[_SaveJob]" = queue.Queue(maxsize=RAG_QUEUE_MAX_SIZE)
+# Retries waiting for their backoff, (not_before, seq, job). Only the worker
+# touches it: putting them back on the bounded queue could block the worker
+# on itself once the queue is full.
+_retry_heap: List[tuple] = []
+_retry_seq = itertools.count()
+_pending: Dict[str, _SaveJob] = {}      # key -> queued/retrying job
+_recent: Dict[str, float] = {}          # key -> time it was saved
+_lock = threading.Lock()
+_stop = threading.Event()
+_worker: Optional[threading.Thread] = None
+
+_stats = {"enqueued": 0, "deduped": 0, "saved": 0, "retried": 0, "failed": 0, "dropped": 0}
+
+
+def enqueue_rag_save(dedupe_key: str, fn: Callable[..., Any], **kwargs) -> bool:
+    """
+    Schedule `fn(**kwargs)` to run on the RAG writer.
+
+    Saves with the same `dedupe_key` are collapsed while one is pending and
+    for RAG_DEDUPE_WINDOW seconds after it succeeded. Returns False if the
+    save was deduped or the queue is full.
+    """
+    now = time.monotonic()
+    with _lock:
+        saved_at = _recent.get(dedupe_key)
+        if dedupe_key in _pending or (saved_at and now - saved_at < RAG_DEDUPE_WINDOW):
+            _stats["deduped"] += 1
+            return False
+
+        job = _SaveJob(dedupe_key, fn, kwargs)
+        try:
+            _queue.put_nowait(job)
+        except queue.Full:
+            _stats["dropped"] += 1
+            print(f"⚠️ RAG queue full, dropping save {dedupe_key[:80]}")
+            return False
+
+        _pending[dedupe_key] = job
+        _stats["enqueued"] += 1
+
+    _ensure_worker()
+    return True
+
+
+def get_rag_queue_stats() -> Dict[str, int]:
+    with _lock:
+        return {**_stats, "depth": _queue.qsize(), "retrying": len(_retry_heap), "pending": len(_pending)}
+
+
+def start_rag_writer() -> None:
+    _stop.clear()
+    _ensure_worker()
+
+
+def stop_rag_writer(timeout: float = 30.0) -> None:
+    """Flush whatever is queued, then stop the worker."""
+    _stop.set()
+    if _worker is not None:
+        _worker.join(timeout)
+
+
+def _ensure_worker() -> None:
+    global _worker
+    with _lock:
+        if _worker is not None and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_run, name="rag-writer", daemon=True)
+        _worker.start()
+
+
+def _is_failure(result: Any) -> bool:
+    return isinstance(result, dict) and "error" in result
+
+
+def _run_job(job: _SaveJob) -> Optional[Exception]:
+    job.attempts += 1
+    try:
+        result = job.fn(**job.kwargs)
+        if _is_failure(result):
+            raise RuntimeError(result["error"])
+    except Exception as e:
+        return e
+    return None
+
+
+def _finish(job: _SaveJob, error: Optional[Exception]) -> None:
+    if error is None:
+        with _lock:
+            _stats["saved"] += 1
+            _pending.pop(job.key, None)
+            _recent[job.key] = time.monotonic()
+        return
+
+    if job.attempts < RAG_MAX_ATTEMPTS and not _stop.is_set():
+        job.not_before = time.monotonic() + RAG_RETRY_BACKOFF * (2 ** (job.attempts - 1))
+        print(f"⚠️ RAG save failed ({job.key[:60]}), attempt {job.attempts}: {error}")
+        with _lock:
+            _stats["retried"] += 1
+        heapq.heappush(_retry_heap, (job.not_before, next(_retry_seq), job))
+        return
+
+    print(f"❌ RAG save gave up ({job.key[:60]}): {error}")
+    with _lock:
+        _stats["failed"] += 1
+        _pending.pop(job.key, None)
+
+
+def _process_batch(batch: List[_SaveJob]) -> None:
+    outcomes = []
+    try:
+        with deferred_indexing():
+            for job in batch:
+                outcomes.append((job, _run_job(job)))
+    except Exception as e:
+        # the batched embedding / Chroma write failed: retry every job in it
+        print(f"⚠️ RAG batch write failed ({len(outcomes)} saves): {e}")
+        outcomes = [(job, err or e) for job, err in outcomes]
+
+    for job, err in outcomes:
+        _finish(job, err)
+
+
+def _prune_recent() -> None:
+    cutoff = time.monotonic() - RAG_DEDUPE_WINDOW
+    with _lock:
+        for key in [k for k, t in _recent.items() if t < cutoff]:
+            del _recent[key]
+
+
+def _run() -> None:
+    set_upstream_lane("background")
+    while True:
+        # Retries that are due (all of them when stopping) go first
+        batch = []
+        now = time.monotonic()
+        while _retry_heap and len(batch) < RAG_FLUSH_BATCH and (_retry_heap[0][0] <= now or _stop.is_set()):
+            batch.append(heapq.heappop(_retry_heap)[2])
+
+        # Otherwise block for the first new job, waking up for the next retry
+        if not batch:
+            timeout = RAG_FLUSH_INTERVAL
+            if _retry_heap:
+                timeout = max(0.0, min(timeout, _retry_heap[0][0] - now))
+            try:
+                batch.append(_queue.get(timeout=timeout))
+            except queue.Empty:
+                if _stop.is_set() and not _retry_heap:
+                    return
+                _prune_recent()
+                continue
+
+        # then take whatever else arrives within the flush interval
+        deadline = time.monotonic() + RAG_FLUSH_INTERVAL
+        while len(batch) < RAG_FLUSH_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        _process_batch(batch)
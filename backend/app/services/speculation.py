@@ -0,0 +1,110 @@
+import asyncio
+import difflib
+import os
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# Speculative replies: start retrieval + the LLM call while the user is
+# still talking (on stable interim transcripts), and let /api/chat pick the
+# result up if the final transcript turns out to be the same.
+SPECULATE_ENABLED = os.getenv("SPECULATE_ENABLED", "0") == "1"
+SPECULATE_STABLE_MS = int(os.getenv("SPECULATE_STABLE_MS", "400"))
+SPECULATE_MATCH_RATIO = float(os.getenv("SPECULATE_MATCH_RATIO", "0.95"))
+SPECULATE_MAX_AGE = float(os.getenv("SPECULATE_MAX_AGE", "20"))   # seconds
+
+_NON_WORD = re.compile(r"[^\w\s]")
+
+
+class _Speculation:
+    __slots__ = ("text", "context", "task", "started_at")
+
+    def __init__(self, text: str, context: Any, task: asyncio.Task):
+        self.text = text
+        self.context = context
+        self.task = task
+        self.started_at = time.monotonic()
+
+
+_speculations: Dict[str, _Speculation] = {}
+_stats = {"started": 0, "kept": 0, "cancelled": 0, "hits": 0, "misses": 0, "expired": 0}
+
+
+def normalize_transcript(text: str) -> str:
+    return " ".join(_NON_WORD.sub(" ", text.lower()).split())
+
+
+def transcripts_match(a: str, b: str) -> bool:
+    """True unless the two transcripts differ materially (beyond case/punctuation/tiny edits)."""
+    a, b = normalize_transcript(a), normalize_transcript(b)
+    if a == b:
+        return True
+    return difflib.SequenceMatcher(None, a, b).ratio() >= SPECULATE_MATCH_RATIO
+
+
+def start_speculation(key: str, text: str, work: Callable[[], Awaitable[Any]], context: Any = None) -> None:
+    """
+    Run `work()` speculatively for `key` (a user id). A running speculation
+    for a matching transcript and the same `context` is kept; anything else
+    is cancelled and replaced.
+    """
+    if not normalize_transcript(text):
+        return
+
+    current = _speculations.get(key)
+    if current is not None:
+        if current.context == context and transcripts_match(current.text, text) and not current.task.cancelled():
+            _stats["kept"] += 1
+            return
+        _cancel(current)
+
+    print(f"🔮 Speculating for {key}: {text[:80]!r}")
+    task = asyncio.create_task(work())
+    task.add_done_callback(_consume_error)
+    _speculations[key] = _Speculation(text, context, task)
+    _stats["started"] += 1
+
+
+def take_speculation(key: str, text: str, context: Any = None) -> Optional[asyncio.Task]:
+    """
+    Claim the speculative task for `key` if it was started for a transcript
+    matching `text` under the same `context`; otherwise cancel it.
+    """
+    current = _speculations.pop(key, None)
+    if current is None:
+        return None
+
+    if time.monotonic() - current.started_at > SPECULATE_MAX_AGE:
+        _stats["expired"] += 1
+        _cancel(current)
+        return None
+
+    if current.context != context or not transcripts_match(current.text, text):
+        _stats["misses"] += 1
+        _cancel(current)
+        return None
+
+    _stats["hits"] += 1
+    return current.task
+
+
+def cancel_speculation(key: str) -> None:
+    current = _speculations.pop(key, None)
+    if current is not None:
+        _cancel(current)
+
+
+def get_speculation_stats() -> Dict[str, int]:
+    return {**_stats, "pending": len(_speculations)}
+
+
+def _consume_error(task: asyncio.Task) -> None:
+    # unclaimed speculations may fail; don't let asyncio warn about it
+    if not task.cancelled() and task.exception() is not None:
+        print("Speculation error:", task.exception())
+
+
+def _cancel(spec: _Speculation) -> None:
+    if not spec.task.done():
+        spec.task.cancel()
+        _stats["cancelled"] += 1
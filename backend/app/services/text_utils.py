@@ -1,36 +1,116 @@
+import os
 import re
+import time
+import asyncio
+from collections import OrderedDict
 from num2words import num2words
 from urllib.parse import urlparse
-from typing import List
+from typing import AsyncIterator, List, Optional
 import httpx
 
 PDF_URL_PATTERN = re.compile(r'https?://\S+\.pdf\b', re.IGNORECASE)
 GENERIC_URL_PATTERN = re.compile(r'https?://\S+', re.IGNORECASE)
 
-async def find_pdf_links(text: str) -> List[str]:
-    links: set[str] = set()
+# URL classification (is this link a PDF?). HEADs share one pooled client,
+# run concurrently under an overall deadline, and results are cached per URL.
+LINK_HEAD_TIMEOUT = float(os.getenv("LINK_HEAD_TIMEOUT", "5"))
+LINK_CLASSIFY_DEADLINE = float(os.getenv("LINK_CLASSIFY_DEADLINE", "6"))
+LINK_CLASSIFY_TTL = float(os.getenv("LINK_CLASSIFY_TTL", "3600"))
+LINK_CLASSIFY_CACHE_SIZE = 1024
+
+_http_client: Optional[httpx.AsyncClient] = None
+_link_cache: "OrderedDict[str, tuple[Optional[str], float]]" = OrderedDict()  # url -> (pdf url or None, expiry)
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Shared async HTTP client (connection pooling across requests)."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=LINK_HEAD_TIMEOUT,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        )
+    return _http_client
+
+
+async def close_http_client() -> None:
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def _cache_link(url: str, pdf_url: Optional[str]) -> None:
+    _link_cache[url] = (pdf_url, time.monotonic() + LINK_CLASSIFY_TTL)
+    _link_cache.move_to_end(url)
+    while len(_link_cache) > LINK_CLASSIFY_CACHE_SIZE:
+        _link_cache.popitem(last=False)
+
+
+async def _classify_url(url: str) -> Optional[str]:
+    """Return the final URL if `url` serves a PDF, else None."""
+    cached = _link_cache.get(url)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    pdf_url = None
+    try:
+        resp = await get_http_client().head(url)
+        content_type = resp.headers.get("content-type", "").lower()
+        if "application/pdf" in content_type:
+            pdf_url = str(resp.url)  # final resolved URL
+    except Exception:
+        # ignore failures; just means not a PDF or unreachable
+        pass
+
+    _cache_link(url, pdf_url)
+    return pdf_url
+
+
+async def iter_pdf_links(text: str) -> AsyncIterator[str]:
+    """
+    Yield PDF links found in `text` as soon as each one is known: direct
+    .pdf links first, then other URLs as their HEAD requests come back.
+    URLs still unresolved at LINK_CLASSIFY_DEADLINE are skipped.
+    """
+    seen: set[str] = set()
 
     # 1) Direct .pdf links in the message
     for url in PDF_URL_PATTERN.findall(text):
-        links.add(url.strip(".,);]>'\""))
+        url = url.strip(".,);]>'\"")
+        if url not in seen:
+            seen.add(url)
+            yield url
 
     # 2) Other URLs – check if they are actually PDFs via HEAD
+    candidates = []
     for url in GENERIC_URL_PATTERN.findall(text):
         url = url.strip(".,);]>'\"")
-        if url in links:
-            continue
+        if url not in seen and url not in candidates:
+            candidates.append(url)
 
-        try:
-            async with httpx.AsyncClient(follow_redirects=True, timeout=5) as client:
-                resp = await client.head(url)
-            content_type = resp.headers.get("content-type", "").lower()
-            if "application/pdf" in content_type:
-                links.add(str(resp.url))  # final resolved URL
-        except Exception:
-            # ignore failures; just means not a PDF or unreachable
-            continue
+    if not candidates:
+        return
 
-    return list(links)
+    tasks = [asyncio.create_task(_classify_url(u)) for u in candidates]
+    try:
+        for fut in asyncio.as_completed(tasks, timeout=LINK_CLASSIFY_DEADLINE):
+            try:
+                pdf_url = await fut
+            except asyncio.TimeoutError:
+                print("⚠️ Link classification deadline hit, skipping remaining URLs")
+                break
+            if pdf_url and pdf_url not in seen:
+                seen.add(pdf_url)
+                yield pdf_url
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+async def find_pdf_links(text: str) -> List[str]:
+    return [url async for url in iter_pdf_links(text)]
 
 def url_to_text(text: str) -> str:
     URL_PATTERN = re.compile(r'(https?://\S+|www\.\S+)', re.IGNORECASE)
@@ -88,6 +168,63 @@ def smart_split(text: str):
 
     return lines
 
+# closing quotes / brackets that may follow a sentence end: 'He said "no."'
+_SENTENCE_CLOSERS = "\"')]}\u201d\u2019"
+
+def coalesce_segments(fragments: List[str], first_chars: int, max_chars: int, growth: float = 2.0) -> List[str]:
+    """
+    Pack smart_split fragments into fewer, longer segments for TTS. The
+    first segment is capped at `first_chars` (fast start); each later cap
+    is `growth` times the previous, up to `max_chars`. Segments end at the
+    last sentence end that fits when there is one, a fragment longer than
+    the cap stays whole, and an open $...$ span is never cut.
+    """
+    segments = []
+    curr: List[str] = []
+    size = 0
+    stop = 0          # fragments in `curr` up to its last sentence end
+    limit = first_chars
+
+    for frag in fragments:
+        frag = frag.strip()
+        if not frag:
+            continue
+        in_math = sum(f.count("$") for f in curr) % 2 == 1
+        if curr and not in_math and size + 1 + len(frag) > limit:
+            cut = stop or len(curr)
+            segments.append(" ".join(curr[:cut]))
+            curr = curr[cut:]
+            size = len(" ".join(curr))
+            stop = 0
+            limit = min(max_chars, int(limit * growth))
+
+        size += len(frag) + (1 if curr else 0)
+        curr.append(frag)
+        if frag.rstrip(_SENTENCE_CLOSERS)[-1:] in (".", "!", "?"):
+            stop = len(curr)
+
+    if curr:
+        segments.append(" ".join(curr))
+    return segments
+
+_SENTENCE_END = re.compile(r"[.!?][" + re.escape(_SENTENCE_CLOSERS) + r"]*(?=\s)")
+
+def complete_sentences_end(text: str, min_chars: int) -> int:
+    """
+    Length of the longest prefix of partly generated `text` that ends on a
+    sentence end, outside $...$ and ``` spans, or 0 if that prefix is
+    shorter than `min_chars`. A sentence end needs the following whitespace
+    to have arrived, so "3." is not mistaken for the end of "3.14".
+    """
+    end = pos = dollars = fences = 0
+    for m in _SENTENCE_END.finditer(text):
+        dollars += text.count("$", pos, m.end())
+        fences += text.count("```", pos, m.end())
+        pos = m.end()
+        if dollars % 2 == 0 and fences % 2 == 0:
+            end = pos
+    return end if end >= min_chars else 0
+
 def ignore_code_blocks(text: str) -> str:
     return re.sub(r"```[\s\S]*?```", "", text).strip()
 
@@ -0,0 +1,99 @@
+import os
+import re
+import threading
+from concurrent.futures import Future
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict
+
+from app.storage import get_tool_result, put_tool_result
+
+# Per-tool TTLs (seconds). Papers don't change, search results go stale.
+TOOL_CACHE_TTLS = {
+    "SEARCH_ARXIV": int(os.getenv("TOOL_CACHE_TTL_ARXIV", str(7 * 24 * 3600))),
+    "SEARCH_WEB": int(os.getenv("TOOL_CACHE_TTL_WEB", str(3600))),
+    "SEARCH_PATENTS": int(os.getenv("TOOL_CACHE_TTL_PATENTS", str(24 * 3600))),
+}
+
+_stats = {"hits": 0, "misses": 0, "coalesced": 0, "uncacheable": 0}
+_inflight: Dict[str, Future] = {}
+_lock = threading.Lock()
+_uncacheable: ContextVar[bool] = ContextVar("tool_result_uncacheable", default=False)
+
+_TRIM = " \t\n.,;:!?\"'"
+
+
+def normalize_query(query: str) -> str:
+    """Case/whitespace-insensitive form of a tool query, used as cache key."""
+    return re.sub(r"\s+", " ", (query or "").strip(_TRIM)).lower()
+
+
+def mark_uncacheable() -> None:
+    """Called from inside a cached tool: return this result, but don't cache it."""
+    _uncacheable.set(True)
+
+
+def get_tool_cache_stats() -> Dict[str, int]:
+    with _lock:
+        return {**_stats, "inflight": len(_inflight)}
+
+
+def cached_tool(tool: str, is_error: Callable[[str], bool] = lambda r: False):
+    """
+    Cache a `fn(query) -> str` tool in SQLite for TOOL_CACHE_TTLS[tool] and
+    collapse concurrent identical lookups into one call (single-flight).
+    Results for which `is_error` is true, or whose call used
+    mark_uncacheable(), are returned but never cached.
+    """
+    ttl = TOOL_CACHE_TTLS.get(tool, 3600)
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(query, *args, **kwargs):
+            norm = normalize_query(query)
+            if not norm or ttl <= 0:
+                return fn(query, *args, **kwargs)
+
+            key = f"{tool}:{norm}"
+
+            cached = get_tool_result(key)
+            if cached is not None:
+                with _lock:
+                    _stats["hits"] += 1
+                print(f"🗃️ Tool cache hit: {key[:80]}")
+                return cached
+
+            with _lock:
+                fut = _inflight.get(key)
+                leader = fut is None
+                if leader:
+                    fut = Future()
+                    _inflight[key] = fut
+                    _stats["misses"] += 1
+                else:
+                    _stats["coalesced"] += 1
+
+            if not leader:
+                return fut.result()
+
+            flag = _uncacheable.set(False)
+            try:
+                result = fn(query, *args, **kwargs)
+                if _uncacheable.get():
+                    with _lock:
+                        _stats["uncacheable"] += 1
+                elif isinstance(result, str) and not is_error(result):
+                    put_tool_result(key, tool, norm, result, ttl)
+                fut.set_result(result)
+                return result
+            except BaseException as e:
+                fut.set_exception(e)
+                raise
+            finally:
+                _uncacheable.reset(flag)
+                with _lock:
+                    _inflight.pop(key, None)
+
+        return wrapper
+
+    return decorator
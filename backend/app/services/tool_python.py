@@ -1,55 +1,191 @@
-import math
-import re
-import io
-import numpy as np
-from contextlib import redirect_stdout
-
-def execute_safe_python(code: str) -> str:            
-    code = re.sub(r'^\s*import\s+math\s*$', '', code, flags=re.MULTILINE | re.IGNORECASE)
-    
-    code = re.sub(r'^\s*import\s+numpy\s+as\s+np\s*$', '', code, flags=re.MULTILINE | re.IGNORECASE)
-    code = re.sub(r'^\s*import\s+numpy\s*$', '', code, flags=re.MULTILINE | re.IGNORECASE)
-    
-    code = re.sub(r'\n{2,}', '\n', code).strip()
-    
-    allowed_modules = {
-        'math': math,
-        'np': np,       # Whitelisting NumPy
-        'numpy': np     # Allowing both 'np' and 'numpy' access
-    }
-
-    restricted_builtins = __builtins__.copy()
-    if isinstance(restricted_builtins, dict):
-        restricted_builtins.pop('__import__', None)
-        restricted_builtins.pop('open', None)
-        restricted_builtins.pop('exit', None)
-        restricted_builtins.pop('quit', None)
-
-    sandbox_globals = {
-        **allowed_modules,
-        '__builtins__': restricted_builtins,
-        'result': None
-    }
-
-    output_buffer = io.StringIO()
-    
-    try:
-        with redirect_stdout(output_buffer):
-            # The 'result' variable must be explicitly set by the user's code 
-            # for the final answer.
-            exec(code, sandbox_globals)
-        
-        # Check for the final result or captured print output
-        final_result = sandbox_globals.get('result')
-        captured_output = output_buffer.getvalue().strip()
-        
-        if final_result is not None:
-            return f"{final_result}"
-        elif captured_output:
-            return f"{captured_output}"
-        else:
-            return "Code executed, but no explicit 'result' variable was set and no output was printed."
-
-    except Exception as e:
-        return f"Code execution failed due to an error: {type(e).__name__}: {str(e)}"
-    
+import os
+import queue
+import signal
+import threading
+import multiprocessing as mp
+from app.python_sandbox import resource, MEMORY_ERROR, error_result, exec_sandboxed, strip_imports, worker_main
+from .python_memo import memo_key, memo_get, memo_put, note_uncacheable
+
+# Sandbox pool settings. Each execution runs in a pre-started worker process
+# (math/numpy already imported) with a wall-clock timeout, a CPU-time limit
+# and an address-space cap; a worker that breaks a limit is killed and
+# replaced so one bad snippet can't take the API down.
+PYTHON_SANDBOX_WORKERS = int(os.getenv("PYTHON_SANDBOX_WORKERS", "2"))
+PYTHON_SANDBOX_MAX_QUEUE = int(os.getenv("PYTHON_SANDBOX_MAX_QUEUE", "8"))
+PYTHON_SANDBOX_WALL_SECONDS = float(os.getenv("PYTHON_SANDBOX_WALL_SECONDS", "5"))
+PYTHON_SANDBOX_CPU_SECONDS = int(os.getenv("PYTHON_SANDBOX_CPU_SECONDS", "3"))
+PYTHON_SANDBOX_MEMORY_MB = int(os.getenv("PYTHON_SANDBOX_MEMORY_MB", "256"))
+
+# Workers come from a forkserver: a clean single-threaded process that has
+# imported app.python_sandbox (math/numpy, nothing of the app) once, so
+# workers start warm without inheriting the server's threads, locks or
+# open database handles. Without forkserver (or
+# resource limits) we fall back to running in-process like before.
+_CAN_FORK = "forkserver" in mp.get_all_start_methods() and resource is not None
+
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.proc = ctx.Process(
+            target=worker_main,
+            args=(child_conn, PYTHON_SANDBOX_MEMORY_MB),
+            daemon=True,
+        )
+        self.proc.start()
+        child_conn.close()
+
+    def kill(self) -> None:
+        try:
+            self.proc.kill()
+            self.proc.join(1)
+        except Exception:
+            pass
+        self.conn.close()
+
+
+class _SandboxPool:
+    """Fixed-size pool of warm sandbox workers with a bounded wait queue."""
+
+    def __init__(self, size: int, max_queue: int):
+        self._ctx = mp.get_context("forkserver")
+        self._ctx.set_forkserver_preload(["app.python_sandbox"])
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self.max_queue = max_queue
+        self.stats = {"runs": 0, "timeouts": 0, "crashes": 0, "respawns": 0, "rejected": 0}
+
+        for _ in range(size):
+            self._idle.put(_Worker(self._ctx))
+
+    def run(self, code: str) -> dict:
+        with self._lock:
+            if self._idle.empty() and self._waiting >= self.max_queue:
+                self.stats["rejected"] += 1
+                return error_result("Code execution rejected: the Python sandbox is busy, please try again shortly.")
+            self._waiting += 1
+
+        try:
+            worker = self._idle.get()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+        if not worker.proc.is_alive():
+            worker.kill()
+            worker = _Worker(self._ctx)
+            with self._lock:
+                self.stats["respawns"] += 1
+
+        healthy = False
+        try:
+            worker.conn.send((code, PYTHON_SANDBOX_CPU_SECONDS))
+            if not worker.conn.poll(PYTHON_SANDBOX_WALL_SECONDS):
+                with self._lock:
+                    self.stats["timeouts"] += 1
+                return error_result(f"Code execution stopped: exceeded the {PYTHON_SANDBOX_WALL_SECONDS:g}s time limit.")
+
+            output = worker.conn.recv()
+            healthy = output["text"] != MEMORY_ERROR
+            with self._lock:
+                self.stats["runs"] += 1
+            return output
+
+        except (EOFError, OSError):
+            worker.proc.join(0.5)
+            with self._lock:
+                self.stats["crashes"] += 1
+            if worker.proc.exitcode == -signal.SIGXCPU:
+                return error_result(f"Code execution stopped: exceeded the {PYTHON_SANDBOX_CPU_SECONDS}s CPU limit.")
+            return error_result("Code execution failed: the sandbox process crashed (likely out of memory).")
+
+        finally:
+            if healthy and worker.proc.is_alive():
+                self._idle.put(worker)
+            else:
+                worker.kill()
+                if not self._closed:
+                    with self._lock:
+                        self.stats["respawns"] += 1
+                    self._idle.put(_Worker(self._ctx))
+
+    def close(self) -> None:
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().kill()
+            except queue.Empty:
+                return
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def start_python_sandbox() -> None:
+    """Start the sandbox workers (called at startup)."""
+    global _pool
+    if not _CAN_FORK:
+        print("⚠️ forkserver/resource unavailable, Python sandbox runs in-process")
+        return
+    with _pool_lock:
+        if _pool is None:
+            _pool = _SandboxPool(PYTHON_SANDBOX_WORKERS, PYTHON_SANDBOX_MAX_QUEUE)
+            print(f"🐍 Python sandbox ready ({PYTHON_SANDBOX_WORKERS} workers)")
+
+
+def stop_python_sandbox() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def get_python_sandbox_stats() -> dict:
+    if _pool is None:
+        return {"enabled": False}
+    with _pool._lock:
+        return {"enabled": True, "waiting": _pool._waiting, "idle": _pool._idle.qsize(), **_pool.stats}
+
+
+def execute_python(code: str) -> dict:
+    """
+    Run LLM-written code in the sandbox and return a typed result (see
+    app.python_sandbox.encode_result); errors come back as {"kind": "error", "text": ...}.
+
+    Deterministic snippets are memoized by normalized-AST hash, returned
+    as "memo_key"; a result served from the memo has "cached": True.
+    """
+    key = memo_key(strip_imports(code))
+    if key is None:
+        note_uncacheable()
+    else:
+        hit = memo_get(key)
+        if hit is not None:
+            return {**hit, "cached": True, "memo_key": key}
+
+    result = _run_sandboxed(code)
+
+    if key is not None and result["kind"] != "error":
+        memo_put(key, result)
+        return {**result, "memo_key": key}
+    return result
+
+
+def _run_sandboxed(code: str) -> dict:
+    if _CAN_FORK and _pool is None:
+        start_python_sandbox()
+    if _pool is None:
+        try:
+            return exec_sandboxed(code)
+        except MemoryError:
+            return error_result(MEMORY_ERROR)
+    return _pool.run(code)
+
+
+def execute_safe_python(code: str) -> str:
+    """Like execute_python, but only the short text form of the result."""
+    return execute_python(code)["text"]
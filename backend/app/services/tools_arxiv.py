@@ -1,8 +1,39 @@
 import arxiv
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
 from .text_format import conversationofy
+from .tool_cache import cached_tool, mark_uncacheable
+from app.upstream import upstream_call
 
 arxiv_client = arxiv.Client(page_size=10, delay_seconds=3.0, num_retries=3)
 
+def conversationofy_fields(fields: Dict[str, Optional[str]]) -> Dict[str, str]:
+    """
+    Rewrite several text fields with conversationofy concurrently.
+    Empty fields are not sent to the LLM and come back as "None". A field
+    whose rewrite failed keeps its raw text, and the result is marked
+    uncacheable so the tool cache doesn't keep the unrewritten version.
+    """
+    todo = {k: v for k, v in fields.items() if v and v.strip()}
+    out = {k: "None" for k in fields}
+    if not todo:
+        return out
+
+    with ThreadPoolExecutor(max_workers=len(todo)) as pool:
+        # copy_context so worker threads keep the caller's upstream lane
+        futures = {k: pool.submit(contextvars.copy_context().run, conversationofy, v, True) for k, v in todo.items()}
+        for k, fut in futures.items():
+            try:
+                out[k] = fut.result()
+            except Exception as e:
+                print(f"⚠️ Rewrite of arXiv {k} failed, using the raw text: {e}")
+                out[k] = todo[k]
+                mark_uncacheable()
+
+    return out
+
+@cached_tool("SEARCH_ARXIV", is_error=lambda r: r.startswith(("Arxiv Error", "No papers found")))
 def search_arxiv_papers(query: str):
     try:
         search = arxiv.Search(
@@ -10,7 +41,7 @@ def search_arxiv_papers(query: str):
             max_results=1,
             sort_by=arxiv.SortCriterion.Relevance
         )
-        results = list(arxiv_client.results(search))
+        results = upstream_call("arxiv", lambda: list(arxiv_client.results(search)))
 
         if not results:
             return "No papers found."
@@ -22,16 +53,20 @@ def search_arxiv_papers(query: str):
         published = paper.published.strftime("%Y-%m-%d") if paper.published else "Unknown"
         updated = paper.updated.strftime("%Y-%m-%d") if paper.updated else "Unknown"
         categories = ", ".join(paper.categories)
-        journal_ref = paper.journal_ref or "None"
         doi = paper.doi or "None"
-        comments = paper.comment or "None"
         pdf_url = paper.pdf_url or "None"
 
         # Convert text into conversational form
-        conv_title = conversationofy(paper.title)
-        conv_summary = conversationofy(paper.summary)
-        conv_comments = conversationofy(comments)
-        conv_journal = conversationofy(journal_ref)
+        conv = conversationofy_fields({
+            "title": paper.title,
+            "summary": paper.summary,
+            "comments": paper.comment,
+            "journal": paper.journal_ref,
+        })
+        conv_title = conv["title"]
+        conv_summary = conv["summary"]
+        conv_comments = conv["comments"]
+        conv_journal = conv["journal"]
 
         response = f"""
 Paper Found on arXiv
@@ -1,8 +1,10 @@
 import json
 import uuid
+from typing import Optional
 import google.generativeai as genai
-from app.storage import store_document_chunks
-from .text_format import conversationofy
+from app.storage import document_exists, namespace_for, store_document_chunks
+from app.upstream import upstream_call
+from .text_format import conversationofy_batch
 
 gemini_client = genai.GenerativeModel("gemini-1.5-pro")
 
@@ -41,7 +43,9 @@ Rules:
 - Do not invent anything that is not in the source.
 """
 
-    gemini_response = gemini_client.models.generate_content(
+    gemini_response = upstream_call(
+        "gemini",
+        gemini_client.models.generate_content,
         model="gemini-3-pro-preview",
         contents = prompt + "\n\nTEXT:\n" + raw_text
     )
@@ -87,31 +91,33 @@ def simple_semantic_chunk(text: str, max_chars: int = 1200):
 
     return chunks
 
-def save_arxiv_to_rag(raw_text: str, query: str):
+def save_arxiv_to_rag(raw_text: str, query: str, user_id: Optional[str] = None):
     doc_id = f"arxiv:{uuid.uuid4()}"
     title = f"arxiv result for: {query[:80]}"
 
     text_chunks = simple_semantic_chunk(raw_text, max_chars=1200)
+    conversational = conversationofy_batch(text_chunks)
 
     chunks = []
     for i, c in enumerate(text_chunks):
         chunks.append({
             "id": f"{doc_id}:chunk-{i}",
-            "conversational": conversationofy(c),  # or just c
+            "conversational": conversational[i],
             "key_details": [f"Tool: SEARCH_ARXIV", f"Query: {query}", f"Part: {i+1}/{len(text_chunks)}"],
             "source_extract": c,
             "faq": [],
         })
 
-    store_document_chunks(
+    return store_document_chunks(
         doc_id=doc_id,
         title=title,
         source="arxiv",
         chunks=chunks,
         extra_meta={"query": query},
+        user_id=user_id,
     )
 
-def save_web_result_to_rag(query: str, raw_text: str):
+def save_web_result_to_rag(query: str, raw_text: str, user_id: Optional[str] = None):
     """
     Save Tavily web search output into RAG as smaller semantic chunks.
     """
@@ -122,13 +128,14 @@ def save_web_result_to_rag(query: str, raw_text: str):
     title = f"Web search: {query[:80]}"
 
     text_chunks = chunk_text_paragraphs(raw_text, max_chars=1200)
+    conversational = conversationofy_batch(text_chunks)
 
     chunks = []
     total_parts = len(text_chunks)
     for i, chunk_text in enumerate(text_chunks):
         chunks.append({
             "id": f"{doc_id}:chunk-{i}",
-            "conversational": conversationofy(chunk_text),
+            "conversational": conversational[i],
             "key_details": [
                 "Tool: SEARCH_WEB",
                 f"Query: {query}",
@@ -138,15 +145,16 @@ def save_web_result_to_rag(query: str, raw_text: str):
             "faq": [],
         })
 
-    store_document_chunks(
+    return store_document_chunks(
         doc_id=doc_id,
         title=title,
         source="web",
         chunks=chunks,
         extra_meta={"tool": "SEARCH_WEB", "query": query},
+        user_id=user_id,
     )
 
-def save_patent_result_to_rag(query: str, raw_text: str):
+def save_patent_result_to_rag(query: str, raw_text: str, user_id: Optional[str] = None):
     """
     Save Google Patents (via Tavily) output into RAG.
     """
@@ -157,13 +165,14 @@ def save_patent_result_to_rag(query: str, raw_text: str):
     title = f"Patent search: {query[:80]}"
 
     text_chunks = chunk_text_paragraphs(raw_text, max_chars=1200)
+    conversational = conversationofy_batch(text_chunks)
 
     chunks = []
     total_parts = len(text_chunks)
     for i, chunk_text in enumerate(text_chunks):
         chunks.append({
             "id": f"{doc_id}:chunk-{i}",
-            "conversational": conversationofy(chunk_text),
+            "conversational": conversational[i],
             "key_details": [
                 "Tool: SEARCH_PATENTS",
                 f"Query: {query}",
@@ -173,22 +182,31 @@ def save_patent_result_to_rag(query: str, raw_text: str):
             "faq": [],
         })
 
-    store_document_chunks(
+    return store_document_chunks(
         doc_id=doc_id,
         title=title,
         source="patent",
         chunks=chunks,
         extra_meta={"tool": "SEARCH_PATENTS", "query": query},
+        user_id=user_id,
     )
 
-def save_code_result_to_rag(code: str, exec_result: str, user_query: str = ""):
+def save_code_result_to_rag(code: str, exec_result: str, user_query: str = "", user_id: Optional[str] = None,
+                            memo_key: Optional[str] = None):
     """
     Save a code run (code + result) into RAG so you can reuse the computation.
+    Deterministic code (with a `memo_key`) is stored once per user under a
+    stable doc id; later saves of the same computation are skipped.
     """
     if not code and not exec_result:
         return
 
-    doc_id = f"python:{uuid.uuid4()}"
+    if memo_key:
+        doc_id = f"python:{namespace_for(user_id)}:{memo_key}"
+        if document_exists(doc_id):
+            return {"status": "exists", "doc_id": doc_id}
+    else:
+        doc_id = f"python:{uuid.uuid4()}"
     title_snippet = code.replace("\n", " ")[:80]
     title = f"Python execution: {title_snippet}"
 
@@ -212,18 +230,20 @@ def save_code_result_to_rag(code: str, exec_result: str, user_query: str = ""):
             "faq": [],
         })
 
-    store_document_chunks(
+    return store_document_chunks(
         doc_id=doc_id,
         title=title,
         source="python",
         chunks=chunks,
         extra_meta={"tool": "EXECUTE_CODE", "query": user_query},
+        user_id=user_id,
     )
 
 def save_mermaid_diagram_to_rag(
     mermaid_code: str,
     user_query: str = "",
-    description: str = ""
+    description: str = "",
+    user_id: Optional[str] = None,
 ):
     """
     Save a Mermaid diagram (code + optional description) into RAG so you can
@@ -255,12 +275,13 @@ def save_mermaid_diagram_to_rag(
             "faq": [],
         })
 
-    store_document_chunks(
+    return store_document_chunks(
         doc_id=doc_id,
         title=title,
         source="mermaid",
         chunks=chunks,
         extra_meta={"tool": "RENDER_MERMAID", "query": user_query},
+        user_id=user_id,
     )
 
 def chunk_text_paragraphs(text: str, max_chars: int = 1200) -> list[str]:
@@ -2,11 +2,14 @@ import os
 import re
 from tavily import TavilyClient
 from dotenv import load_dotenv
+from .tool_cache import cached_tool
+from app.upstream import upstream_call
 
 load_dotenv()
 tavily = TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))    
 
 
+@cached_tool("SEARCH_WEB", is_error=lambda r: r.startswith("Web Search Error"))
 def search_general_web(query):
     """
     Searches the live web using Tavily.
@@ -14,7 +17,7 @@ def search_general_web(query):
     """
     try:
         # 'search_depth="advanced"' gives better answers for research
-        result = list(tavily.search(query=query, search_depth="advanced", max_results=1).get('results', []))[0]
+        result = list(upstream_call("tavily", tavily.search, query=query, search_depth="advanced", max_results=1).get('results', []))[0]
         
         output = f"Source: {result['title']}\nContent: {result['content']}"
         
@@ -22,13 +25,16 @@ def search_general_web(query):
     except Exception as e:
         return f"Web Search Error: {e}"
     
+@cached_tool("SEARCH_PATENTS", is_error=lambda r: r.startswith(("Patent Search Error", "No patents found")))
 def search_patents(query):
     """
     Searches Google Patents via Tavily by filtering domains.
     """
     print(f"📜 Searching Patents: {query}")
     try:
-        response = tavily.search(
+        response = upstream_call(
+            "tavily",
+            tavily.search,
             query=query,
             search_depth="advanced",
             include_domains=["patents.google.com"],
@@ -1,8 +1,14 @@
 import os
+import time
 import asyncio
+from collections import deque
+from typing import Callable, Optional
 from fastapi import WebSocket
 from deepgram import DeepgramClient, LiveOptions, LiveTranscriptionEvents
 from dotenv import load_dotenv
+from .audio_dsp import STT_VAD_ENABLED, Resampler, VoiceActivityGate
+from .speculation import SPECULATE_STABLE_MS
+from app.upstream import upstream_call
 
 load_dotenv()
 deepgram = DeepgramClient(os.getenv("DEEPGRAM_API_KEY"))
@@ -11,7 +17,9 @@ def get_deepgram_transcription(audio_bytes: bytes):
     try:
         source = {"buffer": audio_bytes}
 
-        response = deepgram.listen.prerecorded.v("1").transcribe_file(
+        response = upstream_call(
+            "deepgram",
+            deepgram.listen.prerecorded.v("1").transcribe_file,
             source,
             {
                 "model": "nova-2",
@@ -26,13 +34,161 @@ def get_deepgram_transcription(audio_bytes: bytes):
         print("Deepgram Transcription Error:", e)
         return ""
 
-async def stream_deepgram_transcription(websocket: WebSocket):
+# Live bridge tuning. The browser worklet posts 128-sample frames; we
+# coalesce them into STT_FRAME_MS chunks before sending to Deepgram.
+STT_INPUT_SAMPLE_RATE = 48000
+STT_SAMPLE_RATE = int(os.getenv("STT_SAMPLE_RATE", "16000"))             # what Deepgram gets
+STT_KEEPALIVE_INTERVAL = float(os.getenv("STT_KEEPALIVE_INTERVAL", "4"))  # seconds without audio
+STT_FRAME_MS = min(100, max(20, int(os.getenv("STT_FRAME_MS", "40"))))
+STT_AUDIO_QUEUE_FRAMES = int(os.getenv("STT_AUDIO_QUEUE_FRAMES", "50"))        # ~2s at 40ms
+STT_TRANSCRIPT_QUEUE_SIZE = int(os.getenv("STT_TRANSCRIPT_QUEUE_SIZE", "64"))
+
+_stats = {
+    "sessions": 0,
+    "ws_messages": 0,
+    "bytes_in": 0,
+    "frames_sent": 0,
+    "bytes_sent": 0,
+    "audio_stalls": 0,
+    "frames_gated": 0,
+    "keepalives": 0,
+    "finalizes": 0,
+    "transcripts_sent": 0,
+    "interims_coalesced": 0,
+    "transcripts_dropped": 0,
+}
+_active: set = set()   # live sessions, for queue depth gauges
+
+
+def get_transcription_stats() -> dict:
+    return {
+        **_stats,
+        "active_sessions": len(_active),
+        "audio_queue_depth": sum(s.audio.qsize() for s in _active),
+        "transcript_queue_depth": sum(len(s.transcripts) for s in _active),
+        "frame_ms": STT_FRAME_MS,
+    }
+
+
+_FINALIZE = object()   # audio queue marker: speech ended, flush the transcript
+
+
+class _TranscriptQueue:
+    """
+    Bounded transcript queue for one session. If the client falls behind,
+    a queued interim is replaced by whatever Deepgram sends next (interims
+    are superseded anyway); past the size limit the oldest entry is dropped.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items: deque = deque()
+        self._ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, msg: dict) -> None:
+        if self._items and not self._items[-1]["is_final"]:
+            self._items[-1] = msg
+            _stats["interims_coalesced"] += 1
+        else:
+            self._items.append(msg)
+            if len(self._items) > self.maxsize:
+                self._items.popleft()
+                _stats["transcripts_dropped"] += 1
+        self._ready.set()
+
+    async def get(self) -> dict:
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._items.popleft()
+
+
+class _BridgeSession:
+    def __init__(self):
+        self.audio: asyncio.Queue = asyncio.Queue(maxsize=STT_AUDIO_QUEUE_FRAMES)
+        self.transcripts = _TranscriptQueue(STT_TRANSCRIPT_QUEUE_SIZE)
+
+
+class _UtteranceTracker:
+    """
+    Assembles the current utterance from Deepgram's per-segment results and
+    calls `on_stable(text)` once it has stopped changing for
+    SPECULATE_STABLE_MS, and again when the utterance ends.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, on_stable: Callable[[str], None]):
+        self.loop = loop
+        self.on_stable = on_stable
+        self.committed: list = []    # final segments of the current utterance
+        self.pending = ""
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def update(self, text: str, is_final: bool, speech_final: bool) -> None:
+        candidate = " ".join(self.committed + ([text] if text else []))
+        if is_final and text:
+            self.committed.append(text)
+
+        if speech_final:
+            self.close()
+            self.committed = []
+            self.pending = ""
+            if candidate:
+                self._fire(candidate)
+            return
+
+        if candidate and candidate != self.pending:
+            self.pending = candidate
+            self.close()
+            self._timer = self.loop.call_later(SPECULATE_STABLE_MS / 1000, self._fire, candidate)
+
+    def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _fire(self, text: str) -> None:
+        self._timer = None
+        try:
+            self.on_stable(text)
+        except Exception as e:
+            print("Speculation start error:", e)
+
+
+async def stream_deepgram_transcription(
+    websocket: WebSocket,
+    on_utterance: Optional[Callable[[str], None]] = None,
+    on_speech: Optional[Callable[[float], None]] = None,
+):
     """
     Bridges browser → Deepgram Live → Browser
+
+    Incoming PCM is coalesced into STT_FRAME_MS frames, downsampled to
+    STT_SAMPLE_RATE and passed through a VAD gate; long silences are not
+    sent, Deepgram gets a KeepAlive instead and a Finalize when speech ends.
+    The audio queue to Deepgram is bounded, so a slow Deepgram connection
+    stops us reading the browser socket (TCP backpressure) instead of
+    buffering without limit.
+
+    If `on_utterance` is given it is called with the utterance text whenever
+    the interim transcript has been stable for SPECULATE_STABLE_MS and at
+    the end of each utterance (used to start speculative replies).
+    `on_speech(started_at)` is called whenever a non-empty transcript
+    arrives, with the time.monotonic() at which its utterance was first
+    heard, so callers can tell new speech (barge-in) from the trailing
+    results of an utterance that was already being answered.
     """
     
     loop = asyncio.get_running_loop()
-    queue = asyncio.Queue()
+    session = _BridgeSession()
+    frame_bytes = STT_INPUT_SAMPLE_RATE * 2 * STT_FRAME_MS // 1000   # 16-bit mono
+    resampler = Resampler(STT_INPUT_SAMPLE_RATE, STT_SAMPLE_RATE)
+    gate = VoiceActivityGate(STT_SAMPLE_RATE, STT_FRAME_MS) if STT_VAD_ENABLED else None
+    tracker = _UtteranceTracker(loop, on_utterance) if on_utterance else None
+    utterance_start: list = [None]   # first transcript of the current utterance
+    tasks = []
 
     try:
         deepgram_live = deepgram.listen.live.v("1")
@@ -44,14 +200,24 @@ async def stream_deepgram_transcription(websocket: WebSocket):
                 if not alts: return
 
                 text = alts[0].transcript
+                speech_final = bool(getattr(result, "speech_final", False) or getattr(result, "from_finalize", False))
+                if tracker is not None:
+                    loop.call_soon_threadsafe(tracker.update, text or "", bool(result.is_final), speech_final)
+                started_at = utterance_start[0]
+                if text and started_at is None:
+                    started_at = time.monotonic()
+                # the next transcript after the end of an utterance starts a new one
+                utterance_start[0] = None if speech_final else started_at
                 if not text: return
 
-                asyncio.run_coroutine_threadsafe(
-                    queue.put({
+                if on_speech is not None:
+                    loop.call_soon_threadsafe(on_speech, started_at)
+                loop.call_soon_threadsafe(
+                    session.transcripts.put,
+                    {
                         "transcript": text,
                         "is_final": result.is_final
-                    }),
-                    loop
+                    },
                 )
             except Exception as e:
                 print("Callback Error:", e)
@@ -63,7 +229,7 @@ async def stream_deepgram_transcription(websocket: WebSocket):
         options = LiveOptions(
             model="nova-2",
             encoding="linear16",
-            sample_rate=48000,
+            sample_rate=STT_SAMPLE_RATE,
             channels=1,
             interim_results=True,
             smart_format=True,
@@ -74,23 +240,93 @@ async def stream_deepgram_transcription(websocket: WebSocket):
             print("❌ Failed to start Deepgram session")
             return
 
+        _stats["sessions"] += 1
+        _active.add(session)
+
+        def process_frame(frame: bytes) -> list:
+            """Resample + gate one frame; returns queue items (audio or control)."""
+            frame = resampler.process(frame)
+            if gate is None:
+                return [frame]
+            frames, event = gate.process(frame)
+            if not frames:
+                _stats["frames_gated"] += 1
+            if event == "end":
+                frames.append(_FINALIZE)
+            return frames
+
         async def recv_audio():
+            buf = bytearray()
+            try:
+                while True:
+                    data = await websocket.receive_bytes()
+                    _stats["ws_messages"] += 1
+                    _stats["bytes_in"] += len(data)
+
+                    buf += data
+                    while len(buf) >= frame_bytes:
+                        for item in process_frame(bytes(buf[:frame_bytes])):
+                            if session.audio.full():
+                                _stats["audio_stalls"] += 1
+                            await session.audio.put(item)
+                        del buf[:frame_bytes]
+            finally:
+                # flush the partial frame; keep whole 16-bit samples only
+                tail = len(buf) - len(buf) % 2
+                items = process_frame(bytes(buf[:tail])) if tail else []
+                try:
+                    for item in items + [None]:
+                        session.audio.put_nowait(item)
+                except asyncio.QueueFull:
+                    pass
+
+        async def send_audio():
             while True:
-                data = await websocket.receive_bytes()
-                deepgram_live.send(data)
+                try:
+                    item = await asyncio.wait_for(session.audio.get(), STT_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    # gated silence: keep the Deepgram socket from timing out
+                    await asyncio.to_thread(deepgram_live.keep_alive)
+                    _stats["keepalives"] += 1
+                    continue
+
+                if item is None:
+                    return
+                if item is _FINALIZE:
+                    await asyncio.to_thread(deepgram_live.finalize)
+                    _stats["finalizes"] += 1
+                    continue
+                # the SDK's send is blocking socket I/O
+                await asyncio.to_thread(deepgram_live.send, item)
+                _stats["frames_sent"] += 1
+                _stats["bytes_sent"] += len(item)
 
         async def send_text():
             while True:
-                msg = await queue.get()
+                msg = await session.transcripts.get()
                 await websocket.send_json(msg)
+                _stats["transcripts_sent"] += 1
 
-        await asyncio.gather(recv_audio(), send_text())
+        tasks = [
+            asyncio.create_task(recv_audio()),
+            asyncio.create_task(send_audio()),
+            asyncio.create_task(send_text()),
+        ]
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for t in done:
+            if t.exception() is not None:
+                raise t.exception()
 
     except Exception as e:
         print("Deepgram streaming error:", e)
 
     finally:
+        for t in tasks:
+            t.cancel()
+        if tracker is not None:
+            tracker.close()
+        _active.discard(session)
         try:
             deepgram_live.finish()
         except:
-            pass
\ No newline at end of file
+            pass
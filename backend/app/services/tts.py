@@ -1,70 +1,421 @@
 import json
+import queue
 import requests
 import base64
+import contextvars
 import os
-from typing import List
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List, Optional
+import numpy as np
 from fastapi import HTTPException
-from .text_utils import process_speech, smart_split
+from .text_utils import coalesce_segments, complete_sentences_end, process_speech, smart_split
+from .mp3_frames import complete_frames_end
+from .cancellation import CancelToken, TurnCancelled
+from app.upstream import upstream_call
 
-def stream_audio_from_list(full_text: str, settings: dict):
+# Point this at a local stub (murf_stub.py) to test hedging / the breaker
+MURF_API_URL = os.getenv("MURF_API_URL", "https://global.api.murf.ai/v1/speech/stream")
+
+# "progressive" forwards the audio as Murf streams it (several chunks per
+# sentence index, numbered by "part"), cut at MP3 frame boundaries. Layer
+# III frames borrow bits from earlier ones, so the pieces only play back
+# cleanly when appended to one stream: the client feeds them to a
+# MediaSource SourceBuffer (or joins a sentence's pieces where it has none).
+# "buffered" waits for each sentence's whole clip and sends one chunk.
+MURF_STREAM_MODE = os.getenv("MURF_STREAM_MODE", "progressive")
+MURF_STREAM_FIRST_PART_BYTES = int(os.getenv("MURF_STREAM_FIRST_PART_BYTES", "2048"))   # small, so playback starts early
+MURF_STREAM_PART_BYTES = int(os.getenv("MURF_STREAM_PART_BYTES", "16384"))
+
+# Segments sent to Murf, as seconds of speech (~TTS_CHARS_PER_SECOND).
+# smart_split fragments are packed up to the window: the first segment stays
+# short so audio starts fast, later ones grow by TTS_SEGMENT_GROWTH.
+TTS_CHARS_PER_SECOND = float(os.getenv("TTS_CHARS_PER_SECOND", "15"))
+TTS_FIRST_SEGMENT_SECONDS = float(os.getenv("TTS_FIRST_SEGMENT_SECONDS", "4"))
+TTS_SEGMENT_SECONDS = float(os.getenv("TTS_SEGMENT_SECONDS", "15"))
+TTS_SEGMENT_GROWTH = float(os.getenv("TTS_SEGMENT_GROWTH", "2"))
+
+# Hedging: if a sentence hasn't come back within the MURF_HEDGE_PERCENTILE
+# of recent latencies, send a duplicate request and take the first reply.
+MURF_HEDGE_ENABLED = os.getenv("MURF_HEDGE_ENABLED", "1") == "1"
+MURF_HEDGE_PERCENTILE = float(os.getenv("MURF_HEDGE_PERCENTILE", "90"))
+MURF_HEDGE_DEFAULT_DELAY = float(os.getenv("MURF_HEDGE_DEFAULT_DELAY", "1.5"))  # seconds, until we have samples
+MURF_HEDGE_MIN_DELAY = float(os.getenv("MURF_HEDGE_MIN_DELAY", "0.25"))
+MURF_HEDGE_MIN_SAMPLES = 20
+MURF_LATENCY_WINDOW = 200
+
+# Circuit breaker: stop calling Murf for a while when most recent calls fail
+MURF_BREAKER_WINDOW = int(os.getenv("MURF_BREAKER_WINDOW", "20"))
+MURF_BREAKER_MIN_CALLS = int(os.getenv("MURF_BREAKER_MIN_CALLS", "5"))
+MURF_BREAKER_ERROR_RATE = float(os.getenv("MURF_BREAKER_ERROR_RATE", "0.5"))
+MURF_BREAKER_COOLDOWN = float(os.getenv("MURF_BREAKER_COOLDOWN", "15"))   # seconds open before a trial call
+
+
+class MurfUnavailable(Exception):
+    """The Murf circuit breaker is open; callers should fall back to text."""
+
+
+class _CircuitBreaker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._outcomes: deque = deque(maxlen=MURF_BREAKER_WINDOW)   # True = ok
+        self.state = "closed"
+        self._opened_at = 0.0
+        self._trial = False
+        self._trial_ticket = 0
+
+    def allow(self) -> Optional[int]:
+        """
+        None if the call should be short-circuited, else a ticket to hand to
+        release() once the call is over (non-zero for the half-open trial).
+        """
+        with self._lock:
+            if self.state == "closed":
+                return 0
+            if self.state == "open" and time.monotonic() - self._opened_at >= MURF_BREAKER_COOLDOWN:
+                self.state = "half_open"
+                self._trial = False
+            if self.state == "half_open" and not self._trial:
+                self._trial = True   # let exactly one call through
+                self._trial_ticket += 1
+                return self._trial_ticket
+            return None
+
+    def release(self, ticket: int) -> None:
+        """Free the half-open trial slot if its call ended without an outcome (cancelled, closed early)."""
+        with self._lock:
+            if ticket and ticket == self._trial_ticket and self.state == "half_open":
+                self._trial = False
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            if self.state == "half_open":
+                if ok:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                    print("✅ Murf circuit closed")
+                else:
+                    self._open()
+                return
+
+            self._outcomes.append(ok)
+            failures = self._outcomes.count(False)
+            if (self.state == "closed" and len(self._outcomes) >= MURF_BREAKER_MIN_CALLS
+                    and failures / len(self._outcomes) >= MURF_BREAKER_ERROR_RATE):
+                self._open()
+
+    def _open(self) -> None:
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self._trial = False
+        print(f"⛔ Murf circuit open for {MURF_BREAKER_COOLDOWN:.0f}s")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            n = len(self._outcomes)
+            return {"state": self.state, "error_rate": round(self._outcomes.count(False) / n, 2) if n else 0.0}
+
+
+_breaker = _CircuitBreaker()
+_latencies: deque = deque(maxlen=MURF_LATENCY_WINDOW)   # full clip (buffered)
+_ttfb: deque = deque(maxlen=MURF_LATENCY_WINDOW)        # time to first audio byte (progressive)
+_hedge_pool = ThreadPoolExecutor(max_workers=int(os.getenv("MURF_HEDGE_WORKERS", "16")), thread_name_prefix="murf")
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "failures": 0, "short_circuited": 0, "stream_parts": 0,
+          "fragments": 0, "segments": 0}
+
+
+def _bump(key: str) -> None:
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def hedge_delay(window: Optional[deque] = None) -> float:
+    """Seconds to wait for a request before hedging it (per the stream mode's latency window)."""
+    if window is None:
+        window = _ttfb if MURF_STREAM_MODE == "progressive" else _latencies
+    with _stats_lock:
+        samples = list(window)
+    if len(samples) < MURF_HEDGE_MIN_SAMPLES:
+        return MURF_HEDGE_DEFAULT_DELAY
+    return max(MURF_HEDGE_MIN_DELAY, float(np.percentile(samples, MURF_HEDGE_PERCENTILE)))
+
+
+def get_tts_stats() -> dict:
+    with _stats_lock:
+        samples = list(_latencies)
+        ttfb = list(_ttfb)
+        stats = dict(_stats)
+    return {
+        **stats,
+        "fragments_per_segment": round(stats["fragments"] / stats["segments"], 2) if stats["segments"] else None,
+        "stream_mode": MURF_STREAM_MODE,
+        "breaker": _breaker.snapshot(),
+        "hedge_delay": round(hedge_delay(), 3),
+        "latency_p50": round(float(np.percentile(samples, 50)), 3) if samples else None,
+        "latency_p90": round(float(np.percentile(samples, 90)), 3) if samples else None,
+        "ttfb_p50": round(float(np.percentile(ttfb, 50)), 3) if ttfb else None,
+        "ttfb_p90": round(float(np.percentile(ttfb, 90)), 3) if ttfb else None,
+    }
+
+def stream_audio_from_list(full_text: str, settings: dict, cancel: Optional[CancelToken] = None,
+                           start_index: int = 0, spoken_text: Optional[str] = None):
     """
-    Takes a LIST of sentences -> Generates Audio for each -> Yields chunks.
+    Splits the text into segments -> Generates Audio for each -> Yields chunks.
+    In progressive mode a sentence can span several chunks with the same
+    index. Indexes start at `start_index` (1 after a banked acknowledgement);
+    `spoken_text` overrides what is read aloud. Stops (and drops the
+    in-flight Murf request) once `cancel` is cancelled.
     """
+    cancel = cancel or CancelToken()
     # process and adjust first
-    full_text_new = process_speech(full_text)
-    text_list = smart_split(full_text_new)
-
+    full_text_new = process_speech(full_text if spoken_text is None else spoken_text)
+    text_list = _segments(full_text_new, int(TTS_FIRST_SEGMENT_SECONDS * TTS_CHARS_PER_SECOND))
 
     first_sentence = text_list[0] if text_list else ""
-    first_audio_b64 = None
-    
+
     try:
-        first_audio_b64 = generate_murf_speech(first_sentence, settings)
-    except Exception as e:
-        print(f"⚠️ Error generating first audio chunk: {e}")
-        
-    first_chunk_data = {
-        "full_text": full_text,
-        "audio_chunk": first_audio_b64,
-        "text_chunk": first_sentence,
-        "index": 0,
-        "status": "playing"
-    }
-    yield json.dumps(first_chunk_data) + "\n"
+        # the first chunk carries full_text even if there is no audio for it
+        first_fields = {"full_text": full_text, "text_chunk": first_sentence}
+        if first_sentence:
+            yield from _sentence_chunks(first_sentence, start_index, settings, cancel, first_fields=first_fields)
+        else:
+            yield json.dumps({"audio_chunk": None, "index": start_index, "status": "playing", **first_fields}) + "\n"
 
-    for idx, sentence in enumerate(text_list[1:]):
-        if not sentence.strip():
-            chunk_data = {
-                "audio_chunk": None,
-                "text_chunk": sentence, # Likely "\n"
-                "index": idx + 1,
-                "status": "playing"
-            }
-            yield json.dumps(chunk_data) + "\n"
-            continue
+        for idx, sentence in enumerate(text_list[1:]):
+            if cancel.cancelled:
+                return
 
-        # Handle text (Audio)
-        try:
-            audio_b64 = generate_murf_speech(sentence, settings)
+            if not sentence.strip():
+                chunk_data = {
+                    "audio_chunk": None,
+                    "text_chunk": sentence, # Likely "\n"
+                    "index": start_index + idx + 1,
+                    "status": "playing"
+                }
+                yield json.dumps(chunk_data) + "\n"
+                continue
+
+            # Handle text (Audio)
+            yield from _sentence_chunks(sentence, start_index + idx + 1, settings, cancel)
+    except TurnCancelled:
+        return
+
+    yield json.dumps({"status": "done"}) + "\n"
+
+def stream_audio_from_deltas(deltas: "queue.Queue", settings: dict, cancel: Optional[CancelToken] = None,
+                             start_index: int = 0):
+    """
+    Speaks reply text while the LLM is still writing it. Text deltas are
+    read from `deltas` until a None; whenever the text so far ends on a
+    complete sentence past the current segment size, that part is split and
+    packed as in stream_audio_from_list and synthesized right away. Each
+    part's text goes out as text_chunk on its first line. Returns the next
+    free index (no "done" line; the caller goes on with the rest of the
+    turn).
+    """
+    cancel = cancel or CancelToken()
+    index = start_index
+    limit = int(TTS_FIRST_SEGMENT_SECONDS * TTS_CHARS_PER_SECOND)
+    max_chars = int(TTS_SEGMENT_SECONDS * TTS_CHARS_PER_SECOND)
+    buf, done = "", False
+
+    try:
+        while not done:
+            try:
+                delta = deltas.get(timeout=0.1)
+            except queue.Empty:
+                if cancel.cancelled:
+                    return index
+                continue
+            # take whatever else has arrived in the meantime
+            while True:
+                if delta is None:
+                    done = True
+                    break
+                buf += delta
+                try:
+                    delta = deltas.get_nowait()
+                except queue.Empty:
+                    break
+
+            cut = len(buf) if done else complete_sentences_end(buf, limit)
+            if not cut:
+                continue
+            text, buf = buf[:cut], buf[cut:]
+            segments = _segments(process_speech(text), limit)
+            limit = min(max_chars, int(limit * TTS_SEGMENT_GROWTH))
+
+            if not segments:
+                if text.strip():
+                    # nothing to say (e.g. a code block), but show it
+                    yield json.dumps({"audio_chunk": None, "text_chunk": text, "index": index,
+                                      "status": "playing"}) + "\n"
+                    index += 1
+                continue
+            for i, segment in enumerate(segments):
+                if cancel.cancelled:
+                    return index
+                yield from _sentence_chunks(segment, index, settings, cancel,
+                                            first_fields={"text_chunk": text} if i == 0 else None)
+                index += 1
+    except TurnCancelled:
+        pass
+    return index
+
+def _segments(spoken: str, first_chars: int) -> List[str]:
+    """smart_split + coalesce_segments, counted in the stats."""
+    fragments = smart_split(spoken)
+    segments = coalesce_segments(
+        fragments,
+        first_chars=first_chars,
+        max_chars=int(TTS_SEGMENT_SECONDS * TTS_CHARS_PER_SECOND),
+        growth=TTS_SEGMENT_GROWTH,
+    )
+    with _stats_lock:
+        _stats["fragments"] += sum(1 for f in fragments if f.strip())
+        _stats["segments"] += len(segments)
+    return segments
+
+def _sentence_chunks(sentence: str, index: int, settings: dict, cancel: CancelToken, first_fields: Optional[dict] = None):
+    """NDJSON lines for one sentence; `first_fields` go on its first line, which is always sent."""
+    sent = 0
+    try:
+        for audio_b64 in _speech_parts(sentence, settings, cancel):
             chunk_data = {
                 "audio_chunk": audio_b64,
                 "text_chunk": "",
-                "index": idx + 1,
-                "status": "playing"
+                "index": index,
+                "part": sent,
+                "status": "playing",
+                **(first_fields if first_fields and not sent else {}),
             }
             yield json.dumps(chunk_data) + "\n"
-        except Exception as e:
-            print(f"⚠️ Error chunk {idx}: {e}")
-            continue
+            sent += 1
+        return
+    except TurnCancelled:
+        raise
+    except MurfUnavailable:
+        # fail fast: keep the sentence index moving without audio
+        fallback = {"tts": "unavailable"}
+    except Exception as e:
+        print(f"⚠️ Error chunk {index}: {e}")
+        if not first_fields:
+            return
+        fallback = {}
 
-    yield json.dumps({"status": "done"}) + "\n"
+    if not sent:
+        yield json.dumps({
+            "audio_chunk": None,
+            "text_chunk": "",
+            "index": index,
+            "status": "playing",
+            **fallback,
+            **(first_fields or {}),
+        }) + "\n"
+
+def _speech_parts(text: str, settings: dict, cancel: CancelToken):
+    """Base64 audio for one sentence: one piece when buffered, several as Murf streams when progressive."""
+    if MURF_STREAM_MODE == "progressive":
+        yield from stream_murf_speech(text, settings, cancel)
+    else:
+        yield generate_murf_speech(text, settings, cancel)
 
-def generate_murf_speech(text: List[str], settings):
+def generate_murf_speech(text: List[str], settings, cancel: Optional[CancelToken] = None):
     """
     Sends text to Murf Falcon API and returns the audio as a Base64 string.
+    The response is read incrementally so a cancelled turn can close the
+    connection mid-download (raises TurnCancelled). Slow requests are
+    hedged; raises MurfUnavailable while the circuit breaker is open.
+    """
+    cancel = cancel or CancelToken()
+    url, headers, payload = _murf_request(text, settings)
+    ticket = _admit()
+
+    try:
+        print(f"🎤 Sending to Murf Falcon: '{text[:20]}...'")
+        try:
+            audio_bytes, unlink = _synthesize_hedged(_post_murf, (url, headers, payload), cancel, _latencies)
+            unlink()
+        except TurnCancelled:
+            raise
+        except Exception as e:
+            _record_failure(e)
+            raise
+        _breaker.record(True)
+
+        # base64
+        audio_b64 = base64.b64encode(audio_bytes).decode("utf-8")
+        
+        print(f"Success! Received {len(audio_bytes)} bytes of audio.")
+        return audio_b64
+
+    except TurnCancelled:
+        raise
+    except Exception as e:
+        cancel.check()
+        print(f"Connection Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        _breaker.release(ticket)
+
+def stream_murf_speech(text: str, settings, cancel: Optional[CancelToken] = None):
+    """
+    Like generate_murf_speech, but yields Base64 audio pieces while Murf is
+    still generating: a small first piece, then MURF_STREAM_PART_BYTES ones,
+    each ending on an MP3 frame boundary. The pieces are consecutive parts
+    of one stream, not standalone clips. Hedging races on time to first
+    byte.
     """
+    cancel = cancel or CancelToken()
+    url, headers, payload = _murf_request(text, settings)
+    ticket = _admit()
+    try:
+        yield from _stream_admitted(url, headers, payload, cancel)
+    finally:
+        _breaker.release(ticket)
 
-    url = "https://global.api.murf.ai/v1/speech/stream"
+def _stream_admitted(url, headers, payload, cancel: CancelToken):
+    print(f"🎤 Streaming from Murf Falcon: '{payload['text'][:20]}...'")
+    try:
+        ((response, chunks), release), unlink = _synthesize_hedged(
+            _open_murf, (url, headers, payload), cancel, _ttfb, hold=True)
+    except TurnCancelled:
+        raise
+    except Exception as e:
+        _record_failure(e)
+        cancel.check()
+        print(f"Connection Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    total = 0
+    try:
+        for part in _split_frames(chunks, MURF_STREAM_FIRST_PART_BYTES, MURF_STREAM_PART_BYTES):
+            total += len(part)
+            _bump("stream_parts")
+            yield base64.b64encode(part).decode("utf-8")
+    except GeneratorExit:
+        # the consumer stopped early; Murf was delivering audio until then
+        _breaker.record(True)
+        raise
+    except Exception as e:
+        cancel.check()
+        _record_failure(e)
+        print(f"Connection Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        unlink()
+        response.close()
+        release()
+
+    _breaker.record(True)
+    print(f"Success! Streamed {total} bytes of audio.")
+
+def _murf_request(text, settings):
+    """(url, headers, payload) for one sentence."""
+    url = MURF_API_URL
 
     api_key = os.getenv("MURF_API_KEY")
     if not api_key:
@@ -104,23 +455,147 @@ def generate_murf_speech(text: List[str], settings):
     # }
     # COMMENT ===========================================================================
 
+    return url, headers, payload
+
+def _admit() -> int:
+    """Breaker ticket for a call that is about to be sent; raises MurfUnavailable while open."""
+    ticket = _breaker.allow()
+    if ticket is None:
+        _bump("short_circuited")
+        raise MurfUnavailable("Murf circuit breaker is open")
+    return ticket
+
+def _record_failure(e: Exception) -> None:
+    status = getattr(e, "status_code", None)
+    # bad input (4xx) says nothing about Murf's health
+    _breaker.record(status is not None and 400 <= status < 500 and status != 429)
+    _bump("failures")
+
+def _synthesize_hedged(attempt, args, cancel: CancelToken, window: deque, hold: bool = False):
+    """
+    Run `attempt(*args, token)`; if it is still pending after hedge_delay(),
+    fire a duplicate and keep whichever succeeds first. Losers are cancelled
+    (closing their connections). Returns (result, unlink): the winner stays
+    tied to `cancel` until the caller calls unlink(). With hold=True the
+    result is (value, release) and the winner keeps its upstream slot
+    until release().
+    """
+    attempts = []   # (future, token, unlink)
+    winner = None
+
+    def launch():
+        token = CancelToken()
+        unlink = cancel.on_cancel(lambda: token.cancel(cancel.reason or "cancelled"))
+        fut = _hedge_pool.submit(contextvars.copy_context().run, _timed_call, attempt, args, token, hold)
+        attempts.append((fut, token, unlink))
+        _bump("requests")
+
+    launch()
     try:
-        print(f"🎤 Sending to Murf Falcon: '{text[:20]}...'")
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code == 200:
-            audio_bytes = response.content
-            
-            # base64
-            audio_b64 = base64.b64encode(audio_bytes).decode("utf-8")
-            
-            print(f"Success! Received {len(audio_bytes)} bytes of audio.")
-            return audio_b64
-        else:
+        if MURF_HEDGE_ENABLED:
+            done, _ = wait([attempts[0][0]], timeout=hedge_delay(window))
+            if not done and not cancel.cancelled:
+                _bump("hedged")
+                launch()
+
+        pending = {a[0] for a in attempts}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                try:
+                    result, elapsed = fut.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if fut is not attempts[0][0]:
+                    _bump("hedge_wins")
+                with _stats_lock:
+                    window.append(elapsed)
+                winner = next(a for a in attempts if a[0] is fut)
+                return result, winner[2]
+
+        cancel.check()
+        raise error
+    finally:
+        for a in attempts:
+            if a is winner:
+                continue
+            fut, token, unlink = a
+            unlink()
+            # a loser that already opened a stream holds a connection too
+            if not fut.done() or fut.exception() is None:
+                token.cancel("hedge lost")
+
+def _timed_call(attempt, args, token: CancelToken, hold: bool = False):
+    start = time.monotonic()
+    result = upstream_call("murf", attempt, *args, token, cancel=token, hold=hold)
+    if hold:
+        # a lost or cancelled stream gives its slot back with its connection
+        token.on_cancel(result[1])
+    return result, time.monotonic() - start
+
+def _post_murf(url, headers, payload, cancel: CancelToken) -> bytes:
+    """One Murf request; non-200 responses raise HTTPException with Murf's status (so 429/5xx get retried)."""
+    response = requests.post(url, headers=headers, json=payload, stream=True)
+    unregister = cancel.on_cancel(response.close)
+    try:
+        if response.status_code != 200:
             # Error Handling
             print(f"Murf API Error: {response.status_code} - {response.text}")
             raise HTTPException(status_code=response.status_code, detail=f"Murf API Error: {response.text}")
+        try:
+            audio_bytes = b"".join(response.iter_content(chunk_size=16384))
+        except Exception:
+            cancel.check()
+            raise
+    finally:
+        unregister()
+        response.close()
+    cancel.check()
+    return audio_bytes
 
-    except Exception as e:
-        print(f"Connection Error: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+def _open_murf(url, headers, payload, cancel: CancelToken):
+    """
+    Start one streaming Murf request and wait for its first audio bytes.
+    Returns (response, chunk iterator); the response is closed when
+    `cancel` fires, so the caller owns it until then.
+    """
+    response = requests.post(url, headers=headers, json=payload, stream=True)
+    cancel.on_cancel(response.close)
+    try:
+        if response.status_code != 200:
+            print(f"Murf API Error: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=response.status_code, detail=f"Murf API Error: {response.text}")
+        chunks = response.iter_content(chunk_size=4096)
+        first = next(chunks, b"")
+        cancel.check()
+    except Exception:
+        response.close()
+        cancel.check()
+        raise
+    return response, _prepend(first, chunks)
+
+def _prepend(first: bytes, chunks):
+    if first:
+        yield first
+    yield from chunks
+
+def _split_frames(chunks, first_size: int, part_size: int):
+    """Regroup streamed bytes into pieces of at least `first_size`, then `part_size`, ending on MP3 frame boundaries."""
+    buf = b""
+    limit = first_size
+    for data in chunks:
+        buf += data
+        if len(buf) < limit:
+            continue
+        cut = complete_frames_end(buf)
+        if cut < 0:
+            cut = len(buf)   # not MP3 we can parse: plain byte ranges
+        if cut == 0:
+            continue
+        yield buf[:cut]
+        buf = buf[cut:]
+        limit = part_size
+    if buf:
+        yield buf
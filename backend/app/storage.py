@@ -1,12 +1,17 @@
 import os
 import json
-from datetime import datetime
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from typing import List, Dict, Optional, Any
 from dotenv import load_dotenv
 import chromadb
+import numpy as np
 
 from sqlalchemy import (
     create_engine,
+    inspect,
+    text,
     Column,
     String,
     Text,
@@ -18,6 +23,7 @@ from sqlalchemy.exc import SQLAlchemyError
 import google.generativeai as genai
 from dotenv import load_dotenv
 import os
+from app.upstream import upstream_call
 
 load_dotenv()
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
@@ -27,12 +33,31 @@ def embed_text(text: str) -> List[float]:
     Get an embedding vector from Gemini for the given text.
     Uses Google's text-embedding-004 model.
     """
-    result = genai.embed_content(
+    result = upstream_call(
+        "gemini",
+        genai.embed_content,
         model="models/text-embedding-004",  # or "models/gemini-embedding-001"
         content=text,
     )
     return result["embedding"]
 
+
+EMBED_BATCH_SIZE = 100   # Gemini's limit per batched embed_content call
+
+
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    """Embed several texts with as few Gemini calls as possible."""
+    vectors: List[List[float]] = []
+    for i in range(0, len(texts), EMBED_BATCH_SIZE):
+        result = upstream_call(
+            "gemini",
+            genai.embed_content,
+            model="models/text-embedding-004",
+            content=texts[i:i + EMBED_BATCH_SIZE],
+        )
+        vectors.extend(result["embedding"])
+    return vectors
+
 # ----------------------------
 # Database setup (SQLite)
 # ----------------------------
@@ -53,6 +78,7 @@ class Document(Base):
     id = Column(String, primary_key=True, index=True)
     title = Column(String)
     source = Column(String)                    # "arxiv", "pdf", "web", etc.
+    user_id = Column(String, nullable=True, index=True)  # None = shared by all users
     extra_meta = Column(Text, nullable=True)   # JSON string
     created_at = Column(DateTime, default=datetime.utcnow)
 
@@ -68,10 +94,32 @@ class Chunk(Base):
     faq = Column(Text)             # JSON string (list[{"q": str, "a": str}])
 
 
+class ToolResult(Base):
+    """Cached output of an external tool call (arXiv, web, patents)."""
+    __tablename__ = "tool_results"
+
+    key = Column(String, primary_key=True)     # "<tool>:<normalized query>"
+    tool = Column(String, index=True)
+    query = Column(Text)
+    result = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, index=True)
+
+
 def init_db() -> None:
     """Create tables if they do not exist."""
     Base.metadata.create_all(bind=engine)
 
+    # create_all() never alters existing tables, so add columns that were
+    # introduced after the first release by hand.
+    existing = {c["name"] for c in inspect(engine).get_columns("documents")}
+    if "user_id" not in existing:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE documents ADD COLUMN user_id VARCHAR"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_documents_user_id ON documents (user_id)"))
+
+    backfill_chunk_namespaces()
+
 
 # ----------------------------
 # Embeddings + Chroma
@@ -83,6 +131,85 @@ collection = chroma_client.get_or_create_collection(
     metadata={"hnsw:space": "cosine"},
 )
 
+# Retrieval tuning. Distances are cosine distances (0 = identical), so a hit
+# farther than KB_MAX_DISTANCE is treated as irrelevant and never reaches the
+# prompt. KB_MMR_LAMBDA trades relevance (1.0) against diversity (0.0).
+KB_MAX_DISTANCE = float(os.getenv("KB_MAX_DISTANCE", "0.55"))
+KB_MMR_LAMBDA = float(os.getenv("KB_MMR_LAMBDA", "0.7"))
+KB_MMR_FETCH_MULTIPLIER = int(os.getenv("KB_MMR_FETCH_MULTIPLIER", "3"))
+
+# Chroma metadata values cannot be None, so documents that belong to nobody
+# in particular (e.g. PDFs uploaded from the sidebar) live in this namespace.
+SHARED_NAMESPACE = "shared"
+
+
+CHROMA_PAGE_SIZE = 1000
+
+
+def check_user_id(user_id: Optional[str]) -> None:
+    """Raise ValueError for ids that would collide with the shared namespace."""
+    if user_id == SHARED_NAMESPACE:
+        raise ValueError(f"'{SHARED_NAMESPACE}' is a reserved user id")
+
+
+def namespace_for(user_id: Optional[str]) -> str:
+    """Chroma namespace a document owned by `user_id` is stored under."""
+    check_user_id(user_id)
+    return user_id or SHARED_NAMESPACE
+
+
+def backfill_chunk_namespaces() -> int:
+    """
+    Tag chunks stored before namespaces existed (no `user_id` metadata) as
+    shared, so the namespace filter doesn't hide them. Returns how many
+    chunks were updated; a no-op once everything is tagged.
+    """
+    updated = 0
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=CHROMA_PAGE_SIZE, offset=offset)
+        ids = page["ids"]
+        if not ids:
+            break
+
+        legacy = [
+            (chunk_id, {**(meta or {}), "user_id": SHARED_NAMESPACE})
+            for chunk_id, meta in zip(ids, page["metadatas"])
+            if not (meta or {}).get("user_id")
+        ]
+        if legacy:
+            collection.update(ids=[c for c, _ in legacy], metadatas=[m for _, m in legacy])
+            updated += len(legacy)
+        offset += len(ids)
+
+    if updated:
+        print(f"Tagged {updated} legacy chunks as '{SHARED_NAMESPACE}'")
+    return updated
+
+
+def build_namespace_filter(
+    user_id: Optional[str] = None,
+    sources: Optional[List[str]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Build a Chroma `where` filter restricting a search to the caller's own
+    documents plus the shared namespace, optionally limited to some sources.
+    Returns None when no restriction applies.
+    """
+    check_user_id(user_id)
+    clauses: List[Dict[str, Any]] = []
+
+    if user_id:
+        clauses.append({"user_id": {"$in": [user_id, SHARED_NAMESPACE]}})
+    if sources:
+        clauses.append({"source": {"$in": list(sources)}})
+
+    if not clauses:
+        return None
+    if len(clauses) == 1:
+        return clauses[0]
+    return {"$and": clauses}
+
 
 # ----------------------------
 # Generic store API
@@ -94,6 +221,7 @@ def store_document_chunks(
     source: str,
     chunks: List[Dict[str, Any]],
     extra_meta: Optional[Dict[str, Any]] = None,
+    user_id: Optional[str] = None,
 ) -> Dict[str, Any]:
     """
     Store a document and its chunks in SQLite and Chroma.
@@ -117,7 +245,12 @@ def store_document_chunks(
             }
     extra_meta : dict, optional
         Arbitrary metadata to store as JSON.
+    user_id : str, optional
+        Owner of the document. None stores it in the shared namespace,
+        visible to every user's searches.
     """
+    namespace = namespace_for(user_id)
+    pending = []   # (chunk id, embedding input, metadata, document)
     db = SessionLocal()
 
     try:
@@ -126,6 +259,7 @@ def store_document_chunks(
             id=doc_id,
             title=title,
             source=source,
+            user_id=user_id,
             extra_meta=json.dumps(extra_meta or {}),
         )
         db.merge(doc)
@@ -151,21 +285,20 @@ def store_document_chunks(
             db.merge(db_chunk)
             db.commit()
 
-            # Create embedding for retrieval
-            embed_input = conversational + "\n" + source_extract
-            vector = embed_text(embed_input)
-
-            collection.upsert(
-                ids=[chunk_id],
-                embeddings=[vector],
-                metadatas=[{
+            # Embedding input for retrieval
+            pending.append((
+                chunk_id,
+                conversational + "\n" + source_extract,
+                {
                     "doc_id": doc_id,
                     "title": title,
                     "source": source,
-                }],
-                documents=[conversational],
-            )
+                    "user_id": namespace,
+                },
+                conversational,
+            ))
 
+        _index_chunks(pending)
         return {"status": "ok", "chunks": len(chunks)}
 
     except SQLAlchemyError as e:
@@ -176,9 +309,66 @@ def store_document_chunks(
         db.close()
 
 
-def search_knowledge(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
+_deferred = threading.local()
+
+
+@contextmanager
+def deferred_indexing():
+    """
+    Collect the Chroma writes store_document_chunks makes in this thread and
+    do them on exit with batched embedding calls and a single upsert. The
+    exit raises if that write fails; nothing is written if the block raises.
     """
-    Semantic search over all stored chunks.
+    _deferred.items = []
+    try:
+        yield
+        items = _deferred.items
+    finally:
+        _deferred.items = None
+    _write_chunks(items)
+
+
+def _index_chunks(items) -> None:
+    buffer = getattr(_deferred, "items", None)
+    if buffer is not None:
+        buffer.extend(items)
+    else:
+        _write_chunks(items)
+
+
+def _write_chunks(items) -> None:
+    if not items:
+        return
+    # Chroma rejects repeated ids in one call; the last write of a chunk wins
+    items = list({item[0]: item for item in items}.values())
+    ids, texts, metadatas, documents = (list(x) for x in zip(*items))
+    collection.upsert(
+        ids=ids,
+        embeddings=embed_texts(texts),
+        metadatas=metadatas,
+        documents=documents,
+    )
+
+
+def search_knowledge(
+    query: str,
+    top_k: int = 5,
+    user_id: Optional[str] = None,
+    sources: Optional[List[str]] = None,
+    max_distance: Optional[float] = KB_MAX_DISTANCE,
+    mmr_lambda: float = KB_MMR_LAMBDA,
+) -> List[Dict[str, Any]]:
+    """
+    Semantic search over stored chunks.
+
+    If `user_id` is given, only that user's documents and the shared
+    namespace are searched. `sources` further limits the search to the
+    given source types ("arxiv", "pdf", "web", ...).
+
+    Hits whose cosine distance is above `max_distance` are dropped (pass None
+    to keep everything). The remaining candidates are re-ranked with
+    maximal marginal relevance so near-duplicate chunks don't crowd out
+    everything else; `mmr_lambda` = 1.0 is plain relevance order.
 
     Returns a list of dicts:
         {
@@ -186,6 +376,9 @@ def search_knowledge(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
             "doc_id": ...,
             "title": ...,
             "source": ...,
+            "user_id": ...,
+            "distance": float,   # cosine distance, lower is closer
+            "score": float,      # 1 - distance
             "conversational": ...,
             "source_extract": ...,
             "faq": [...],
@@ -193,19 +386,43 @@ def search_knowledge(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
         }
     """
     vec = embed_text(query)
-    result = collection.query(
-        query_embeddings=[vec],
-        n_results=top_k,
-    )
+    query_kwargs: Dict[str, Any] = {
+        "query_embeddings": [vec],
+        "n_results": max(top_k, top_k * KB_MMR_FETCH_MULTIPLIER),
+        "include": ["metadatas", "distances", "embeddings"],
+    }
+    where = build_namespace_filter(user_id, sources)
+    if where:
+        query_kwargs["where"] = where
+
+    result = collection.query(**query_kwargs)
 
     ids = result["ids"][0]
     metas = result["metadatas"][0]
+    distances = result["distances"][0]
+    embeddings = result["embeddings"][0]
+
+    candidates = [
+        i for i, d in enumerate(distances)
+        if max_distance is None or d <= max_distance
+    ]
+    if not candidates:
+        return []
+
+    selected = _mmr_select(
+        vec,
+        [embeddings[i] for i in candidates],
+        k=top_k,
+        mmr_lambda=mmr_lambda,
+    )
 
     db = SessionLocal()
     out: List[Dict[str, Any]] = []
 
     try:
-        for i, chunk_id in enumerate(ids):
+        for pos in selected:
+            i = candidates[pos]
+            chunk_id = ids[i]
             ch = db.query(Chunk).filter_by(id=chunk_id).first()
             if not ch:
                 continue
@@ -215,6 +432,9 @@ def search_knowledge(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
                 "doc_id": metas[i]["doc_id"],
                 "title": metas[i]["title"],
                 "source": metas[i]["source"],
+                "user_id": metas[i].get("user_id", SHARED_NAMESPACE),
+                "distance": float(distances[i]),
+                "score": 1.0 - float(distances[i]),
                 "conversational": ch.conversational,
                 "source_extract": ch.source_extract,
                 "faq": json.loads(ch.faq) if ch.faq else [],
@@ -225,6 +445,97 @@ def search_knowledge(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
 
     return out
 
+
+def _mmr_select(
+    query_vec: List[float],
+    candidate_vecs: List[List[float]],
+    k: int,
+    mmr_lambda: float = KB_MMR_LAMBDA,
+) -> List[int]:
+    """
+    Maximal marginal relevance: greedily pick candidates that are close to
+    the query but far from what has already been picked.
+    Returns indices into `candidate_vecs`, in pick order.
+    """
+    if not candidate_vecs or k <= 0:
+        return []
+
+    q = np.asarray(query_vec, dtype=np.float32)
+    cands = np.asarray(candidate_vecs, dtype=np.float32)
+
+    q = q / (np.linalg.norm(q) or 1.0)
+    norms = np.linalg.norm(cands, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    cands = cands / norms
+
+    relevance = cands @ q
+    pairwise = cands @ cands.T
+
+    selected = [int(np.argmax(relevance))]
+    remaining = set(range(len(cands))) - set(selected)
+
+    while remaining and len(selected) < k:
+        rest = np.fromiter(remaining, dtype=np.int64)
+        redundancy = pairwise[np.ix_(rest, selected)].max(axis=1)
+        mmr = mmr_lambda * relevance[rest] - (1 - mmr_lambda) * redundancy
+        best = int(rest[int(np.argmax(mmr))])
+        selected.append(best)
+        remaining.remove(best)
+
+    return selected
+
+# ----------------------------
+# Tool result cache
+# ----------------------------
+
+def document_exists(doc_id: str) -> bool:
+    db = SessionLocal()
+    try:
+        return db.query(Document.id).filter(Document.id == doc_id).first() is not None
+    except SQLAlchemyError as e:
+        print(f"⚠️ Document lookup failed: {e}")
+        return False
+    finally:
+        db.close()
+
+
+def get_tool_result(key: str) -> Optional[str]:
+    """Return a cached tool result, or None if missing or expired."""
+    db = SessionLocal()
+    try:
+        row = db.query(ToolResult).filter(ToolResult.key == key).first()
+        if not row or row.expires_at <= datetime.utcnow():
+            return None
+        return row.result
+    except SQLAlchemyError as e:
+        print(f"⚠️ Tool cache read failed: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def put_tool_result(key: str, tool: str, query: str, result: str, ttl_seconds: int) -> None:
+    """Store a tool result for `ttl_seconds`."""
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        db.merge(ToolResult(
+            key=key,
+            tool=tool,
+            query=query,
+            result=result,
+            created_at=now,
+            expires_at=now + timedelta(seconds=ttl_seconds),
+        ))
+        # opportunistically drop expired rows
+        db.query(ToolResult).filter(ToolResult.expires_at <= now).delete()
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        print(f"⚠️ Tool cache write failed: {e}")
+    finally:
+        db.close()
+
 # ----------------------------
 # Delete helpers
 # ----------------------------
@@ -0,0 +1,274 @@
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+# Shared layer for calls to third-party APIs (Groq, Gemini, Murf, Tavily,
+# Deepgram, arXiv): per-provider concurrency limits and token-bucket rate
+# limits, priority lanes, and jittered exponential retry on 429/5xx.
+#
+# Provider limits: UPSTREAM_<PROVIDER>_CONCURRENCY / _RPS / _BURST.
+_DEFAULT_LIMITS = {
+    #            concurrency, requests/s, burst
+    "groq":     (8, 5.0, 10),
+    "gemini":   (8, 10.0, 20),
+    "murf":     (6, 5.0, 10),
+    "tavily":   (4, 2.0, 4),
+    "deepgram": (4, 5.0, 10),
+    "arxiv":    (1, 0.34, 1),     # arXiv asks for one request every 3s
+}
+
+# Lanes, in priority order. Chat turns run "interactive"; ingestion, RAG
+# rewriting and summarisation run "background".
+LANES = {"interactive": 0, "background": 1}
+UPSTREAM_MAX_WAIT = {
+    "interactive": float(os.getenv("UPSTREAM_MAX_WAIT_INTERACTIVE", "15")),
+    "background": float(os.getenv("UPSTREAM_MAX_WAIT_BACKGROUND", "300")),
+}
+UPSTREAM_INTERACTIVE_RESERVE = int(os.getenv("UPSTREAM_INTERACTIVE_RESERVE", "1"))  # slots background can't take
+UPSTREAM_MAX_QUEUE = int(os.getenv("UPSTREAM_MAX_QUEUE", "200"))
+
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))   # seconds
+UPSTREAM_BACKOFF_CAP = float(os.getenv("UPSTREAM_BACKOFF_CAP", "8"))
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+_lane: ContextVar[str] = ContextVar("upstream_lane", default="interactive")
+
+
+class UpstreamBusy(Exception):
+    """Admission control rejected the call (queue full or waited too long)."""
+
+
+class _Provider:
+    def __init__(self, name: str, concurrency: int, rps: float, burst: int):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.rps = rps
+        self.burst = max(1, burst)
+
+        self._cond = threading.Condition()
+        self._waiters: list = []          # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self.in_flight = 0
+
+        self.stats = {
+            "calls": 0, "retries": 0, "throttled": 0, "errors": 0, "rejected": 0,
+            "wait_ms_total": 0.0, "queued_interactive": 0, "queued_background": 0,
+        }
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.rps > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rps)
+        self._refilled = now
+
+    def _has_token(self) -> bool:
+        return self.rps <= 0 or self._tokens >= 1
+
+    def _can_start(self, priority: int) -> bool:
+        limit = self.concurrency
+        if priority > 0 and self.concurrency > UPSTREAM_INTERACTIVE_RESERVE:
+            limit -= UPSTREAM_INTERACTIVE_RESERVE
+        return self.in_flight < limit
+
+    def acquire(self, lane: str) -> None:
+        priority = LANES.get(lane, 0)
+        start = time.monotonic()
+        deadline = start + UPSTREAM_MAX_WAIT.get(lane, UPSTREAM_MAX_WAIT["interactive"])
+        queued_key = f"queued_{lane}"
+
+        with self._cond:
+            if len(self._waiters) >= UPSTREAM_MAX_QUEUE:
+                self.stats["rejected"] += 1
+                raise UpstreamBusy(f"{self.name}: too many queued calls")
+
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            self.stats[queued_key] += 1
+            try:
+                while True:
+                    self._refill()
+                    if self._waiters[0] == entry and self._can_start(priority) and self._has_token():
+                        heapq.heappop(self._waiters)
+                        if self.rps > 0:
+                            self._tokens -= 1
+                        self.in_flight += 1
+                        self.stats["calls"] += 1
+                        self.stats["wait_ms_total"] += (time.monotonic() - start) * 1000
+                        return
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._waiters.remove(entry)
+                        heapq.heapify(self._waiters)
+                        self.stats["rejected"] += 1
+                        raise UpstreamBusy(f"{self.name}: no capacity after {UPSTREAM_MAX_WAIT.get(lane)}s ({lane})")
+
+                    timeout = remaining
+                    if not self._has_token():
+                        timeout = min(timeout, (1 - self._tokens) / self.rps)
+                    self._cond.wait(timeout)
+            finally:
+                self.stats[queued_key] -= 1
+                self._cond.notify_all()
+
+    def release(self) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def throttled(self) -> None:
+        """A 429 came back: empty the bucket so other callers back off too."""
+        with self._cond:
+            self.stats["throttled"] += 1
+            self._refill()
+            self._tokens = min(self._tokens, 0.0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            self._refill()
+            calls = self.stats["calls"]
+            return {
+                **{k: v for k, v in self.stats.items() if k != "wait_ms_total"},
+                "in_flight": self.in_flight,
+                "queue_depth": len(self._waiters),
+                "tokens": round(self._tokens, 2) if self.rps > 0 else None,
+                "avg_wait_ms": round(self.stats["wait_ms_total"] / calls, 1) if calls else 0.0,
+                "concurrency": self.concurrency,
+                "rps": self.rps,
+            }
+
+
+def _load_provider(name: str, defaults) -> _Provider:
+    concurrency, rps, burst = defaults
+    prefix = f"UPSTREAM_{name.upper()}_"
+    return _Provider(
+        name,
+        int(os.getenv(prefix + "CONCURRENCY", str(concurrency))),
+        float(os.getenv(prefix + "RPS", str(rps))),
+        int(os.getenv(prefix + "BURST", str(burst))),
+    )
+
+
+_providers: Dict[str, _Provider] = {name: _load_provider(name, d) for name, d in _DEFAULT_LIMITS.items()}
+
+
+@contextmanager
+def upstream_lane(lane: str):
+    """Run the enclosed upstream calls in `lane` (e.g. "background")."""
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def set_upstream_lane(lane: str) -> None:
+    """Set the lane for the rest of the current thread / task."""
+    _lane.set(lane)
+
+
+def _status_of(e: Exception) -> Optional[int]:
+    for attr in ("status_code", "code", "status"):
+        value = getattr(e, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(e, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def _is_transient(e: Exception) -> bool:
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    name = type(e).__name__
+    return "Connection" in name or "Timeout" in name
+
+
+def _retry_after(e: Exception) -> float:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _releaser(p: _Provider) -> Callable[[], None]:
+    lock = threading.Lock()
+    released = False
+
+    def release() -> None:
+        nonlocal released
+        with lock:
+            if released:
+                return
+            released = True
+        p.release()
+    return release
+
+
+def upstream_call(provider: str, fn: Callable[..., Any], *args, lane: Optional[str] = None,
+                  retries: int = UPSTREAM_MAX_RETRIES, cancel=None, hold: bool = False, **kwargs) -> Any:
+    """
+    Call `fn(*args, **kwargs)` under `provider`'s concurrency and rate
+    limits, in `lane` (defaults to the current context's lane). 429/5xx and
+    connection errors are retried with full-jitter exponential backoff,
+    honouring Retry-After up to the lane's max wait. Raises UpstreamBusy if
+    admission times out. With a `cancel` token (CancelToken), a cancelled
+    turn stops retrying and wakes from backoff right away.
+
+    With hold=True the concurrency slot outlives the call (for responses
+    that keep streaming after `fn` returns): returns (result, release) and
+    the caller must call release() once it is done with the response.
+    """
+    p = _providers[provider]
+    lane = lane or _lane.get()
+    max_delay = UPSTREAM_MAX_WAIT.get(lane, UPSTREAM_MAX_WAIT["interactive"])
+
+    for attempt in range(retries + 1):
+        if cancel is not None:
+            cancel.check()
+        p.acquire(lane)
+        held = False
+        try:
+            result = fn(*args, **kwargs)
+            if hold:
+                held = True
+                return result, _releaser(p)
+            return result
+        except Exception as e:
+            status = _status_of(e)
+            if status == 429:
+                p.throttled()
+            if (attempt >= retries or (cancel is not None and cancel.cancelled)
+                    or not (status in RETRYABLE_STATUS or (status is None and _is_transient(e)))):
+                with p._cond:
+                    p.stats["errors"] += 1
+                raise
+            delay = min(max_delay, max(
+                random.uniform(0, min(UPSTREAM_BACKOFF_CAP, UPSTREAM_BACKOFF_BASE * 2 ** attempt)),
+                _retry_after(e),
+            ))
+            with p._cond:
+                p.stats["retries"] += 1
+            print(f"🔁 {provider} call failed ({status or type(e).__name__}), retry {attempt + 1}/{retries} in {delay:.2f}s")
+        finally:
+            if not held:
+                p.release()
+        if cancel is not None:
+            if cancel.wait(delay):
+                cancel.check()
+        else:
+            time.sleep(delay)
+
+
+def get_upstream_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: p.snapshot() for name, p in _providers.items()}
@@ -0,0 +1,71 @@
+# murf_stub.py
+#
+# Local stand-in for Murf's /v1/speech/stream endpoint, for exercising TTS
+# hedging and the circuit breaker without calling Murf:
+#
+#   python murf_stub.py --latency 0.3 --tail 0.1 --tail-latency 3 --error-rate 0.2
+#   MURF_API_URL=http://127.0.0.1:8787/v1/speech/stream MURF_API_KEY=stub uvicorn app.main:app
+#
+# Each request sleeps `latency` seconds (or `tail-latency` with probability
+# `tail`), fails with a 503 with probability `error-rate`, and otherwise
+# streams silent MP3 frames (roughly proportional to the text length) in
+# `chunks` pieces, split mid-frame like a real stream.
+
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--port", type=int, default=8787)
+parser.add_argument("--latency", type=float, default=0.3)
+parser.add_argument("--tail", type=float, default=0.0)
+parser.add_argument("--tail-latency", type=float, default=3.0)
+parser.add_argument("--error-rate", type=float, default=0.0)
+parser.add_argument("--chunks", type=int, default=4)
+parser.add_argument("--chunk-interval", type=float, default=0.05)
+args = parser.parse_args()
+
+
+class MurfStub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        text = json.loads(body or b"{}").get("text", "")
+
+        time.sleep(args.tail_latency if random.random() < args.tail else args.latency)
+
+        if random.random() < args.error_rate:
+            msg = b'{"error": "stub: service unavailable"}'
+            self.send_response(503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(msg)))
+            self.end_headers()
+            self.wfile.write(msg)
+            return
+
+        # MPEG-2 layer III, 48 kbps, 24 kHz mono: 144-byte frames
+        frame = b"\xff\xf3\x64\xc4" + b"\x00" * 140
+        audio = frame * -(-200 * max(1, len(text)) // len(frame))
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        size = -(-len(audio) // max(1, args.chunks))
+        for i in range(0, len(audio), size):
+            part = audio[i:i + size]
+            self.wfile.write(f"{len(part):x}\r\n".encode() + part + b"\r\n")
+            self.wfile.flush()
+            time.sleep(args.chunk_interval)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, fmt, *a):
+        print(f"[murf-stub] {self.address_string()} {fmt % a}")
+
+
+if __name__ == "__main__":
+    print(f"Murf stub on http://127.0.0.1:{args.port}/v1/speech/stream")
+    ThreadingHTTPServer(("127.0.0.1", args.port), MurfStub).serve_forever()
@@ -9,6 +9,7 @@ for doc in db.query(Document).all():
     print(f"ID: {doc.id}")
     print(f"Title: {doc.title}")
     print(f"Source: {doc.source}")
+    print(f"User: {doc.user_id or 'shared'}")
     print(f"Extra Meta: {doc.extra_meta}")
     print(f"Created At: {doc.created_at}")
     print("-" * 40)
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# app.services builds its API clients at import time; the parser tests never
+# call them, so placeholder keys are enough when the real ones aren't set
+for key in ("GROQ_API_KEY", "GEMINI_API_KEY", "MURF_API_KEY", "DEEPGRAM_API_KEY", "TAVILY_API_KEY"):
+    os.environ.setdefault(key, "test")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
@@ -0,0 +1,82 @@
+import wave
+
+import numpy as np
+import pytest
+
+from app.services.audio_dsp import Resampler, process_wav
+
+
+def _tone(rate: int, seconds: float, freq: float = 440.0, level: float = 0.3) -> np.ndarray:
+    t = np.arange(int(rate * seconds)) / rate
+    return level * 32767 * np.sin(2 * np.pi * freq * t)
+
+
+def _pcm(samples: np.ndarray) -> bytes:
+    return np.clip(np.rint(samples), -32768, 32767).astype("<i2").tobytes()
+
+
+def _peak_hz(pcm: bytes, rate: int) -> float:
+    x = np.frombuffer(pcm, dtype="<i2").astype(np.float64)
+    spectrum = np.abs(np.fft.rfft(x * np.hanning(len(x))))
+    return np.fft.rfftfreq(len(x), 1 / rate)[np.argmax(spectrum)]
+
+
+@pytest.fixture
+def speech_wav(tmp_path):
+    """44.1 kHz mono WAV: 0.5 s silence, 1 s tone, 1 s silence, 0.5 s tone."""
+    rate = 44100
+    silence = lambda s: np.zeros(int(rate * s))
+    samples = np.concatenate([silence(0.5), _tone(rate, 1.0), silence(1.0), _tone(rate, 0.5)])
+    path = tmp_path / "speech_44k1.wav"
+    with wave.open(str(path), "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(rate)
+        wf.writeframes(_pcm(samples))
+    return path
+
+
+@pytest.mark.parametrize("in_rate", [48000, 44100, 22050, 8000])
+def test_resampler_keeps_length_and_pitch(in_rate):
+    out = Resampler(in_rate, 16000).process(_pcm(_tone(in_rate, 1.0)))
+    assert abs(len(out) // 2 - 16000) <= 1
+    assert abs(_peak_hz(out, 16000) - 440) < 2
+
+
+@pytest.mark.parametrize("in_rate", [48000, 44100])
+def test_resampler_frame_size_does_not_matter(in_rate):
+    pcm = _pcm(_tone(in_rate, 0.5))
+    whole = Resampler(in_rate, 16000).process(pcm)
+
+    resampler = Resampler(in_rate, 16000)
+    rng = np.random.default_rng(0)
+    parts, pos = [], 0
+    while pos < len(pcm):
+        step = 2 * int(rng.integers(1, 900))
+        parts.append(resampler.process(pcm[pos:pos + step]))
+        pos += step
+    assert b"".join(parts) == whole
+
+
+def test_resampler_rejects_aliasing():
+    # 10 kHz is above the 8 kHz output Nyquist and must not fold back in
+    out = Resampler(44100, 16000).process(_pcm(_tone(44100, 1.0, freq=10000)))
+    x = np.frombuffer(out, dtype="<i2").astype(np.float64)[500:]
+    assert np.sqrt(np.mean(x * x)) < 0.01 * 0.3 * 32767
+
+
+def test_process_wav_44k1(speech_wav, tmp_path):
+    out_path = tmp_path / "gated.wav"
+    report = process_wav(str(speech_wav), out_path=str(out_path))
+
+    with wave.open(str(out_path), "rb") as wf:
+        assert wf.getframerate() == 16000
+        sent = wf.readframes(wf.getnframes())
+    assert report["sent_bytes"] == len(sent)
+    assert report["sent_bytes"] < report["input_bytes"]
+
+    # both tone bursts are found, near where they are in the file
+    segments = report["speech_segments_ms"]
+    assert len(segments) == 2
+    assert abs(segments[0][0] - 500) <= 250
+    assert abs(segments[1][0] - 2500) <= 250
@@ -0,0 +1,146 @@
+import json
+import random
+import time
+
+import pytest
+
+from app.services.llm_json import EnvelopeParser, parse_llm_envelope
+
+# Replies as the model actually produced them when it broke the envelope,
+# with the envelope we expect back.
+MALFORMED = [
+    pytest.param(
+        '{"text": "The paper is called "Attention Is All You Need", by Vaswani et al.", '
+        '"config": {}, "tool": "NONE", "args": ""}',
+        {"text": 'The paper is called "Attention Is All You Need", by Vaswani et al.',
+         "config": {}, "tool": "NONE", "args": ""},
+        id="unescaped-quotes",
+    ),
+    pytest.param(
+        '{"text": "He said "done", "then" left.", "config": {}, "tool": "NONE", "args": ""}',
+        {"text": 'He said "done", "then" left.', "config": {}, "tool": "NONE", "args": ""},
+        id="quote-comma-quote-inside-text",
+    ),
+    pytest.param(
+        "{'text': 'Sure, speaking slower now.', 'config': {'rate': -10, 'style': 'Calm'}, "
+        "'tool': 'NONE', 'args': ''}",
+        {"text": "Sure, speaking slower now.", "config": {"rate": -10, "style": "Calm"},
+         "tool": "NONE", "args": ""},
+        id="single-quoted",
+    ),
+    pytest.param(
+        'Here is my answer:\n```json\n{"text": "Searching arXiv for you.", "config": {}, '
+        '"tool": "SEARCH_ARXIV", "args": "diffusion transformers"}\n```',
+        {"text": "Searching arXiv for you.", "config": {}, "tool": "SEARCH_ARXIV",
+         "args": "diffusion transformers"},
+        id="prose-and-fence",
+    ),
+    pytest.param(
+        '{"text": "Here is the flow.", "config": {}, "tool": "RENDER_MERMAID", '
+        '"args": "graph TD\\n  A[user\\_id] --> B["Chroma"]"}',
+        {"text": "Here is the flow.", "config": {}, "tool": "RENDER_MERMAID",
+         "args": 'graph TD\n  A[user\\_id] --> B["Chroma"]'},
+        id="mermaid-unknown-escape",
+    ),
+    pytest.param(
+        '{text: "Running the numbers.", config: {}, tool: "EXECUTE_CODE", args: "print(2**10)"}',
+        {"text": "Running the numbers.", "config": {}, "tool": "EXECUTE_CODE", "args": "print(2**10)"},
+        id="bare-keys",
+    ),
+    pytest.param(
+        '{"text": ["First part. ", "Second part."], "config": {}, "tool": "NONE", "args": ""}',
+        {"text": "First part. Second part.", "config": {}, "tool": "NONE", "args": ""},
+        id="text-as-list",
+    ),
+    pytest.param(
+        '{"text": "The integral of $x^2$ is $\\\\frac{x^3}{3}$ plus a constant',
+        {"text": "The integral of $x^2$ is $\\frac{x^3}{3}$ plus a constant",
+         "config": {}, "tool": "", "args": ""},
+        id="truncated-in-text",
+    ),
+    pytest.param(
+        '{"text": "Done.", "config": {"pitch": 5',
+        {"text": "Done.", "config": {}, "tool": "", "args": ""},
+        id="truncated-in-config",
+    ),
+    pytest.param(
+        '{"text": "Caf\\u00e9 and na\\u00efve.", "config": null, "tool": null, "args": null}',
+        {"text": "Café and naïve.", "config": {}, "tool": "", "args": ""},
+        id="unicode-escapes-and-nulls",
+    ),
+    pytest.param(
+        "I'm not sure what you mean, could you rephrase?",
+        {"text": "I'm not sure what you mean, could you rephrase?", "config": {}, "tool": "", "args": ""},
+        id="no-envelope",
+    ),
+]
+
+
+def _stream(response: str, rng: random.Random):
+    """Feed `response` in random-sized chunks; return (streamed text, envelope)."""
+    parser = EnvelopeParser()
+    streamed = []
+    pos = 0
+    while pos < len(response):
+        step = rng.randint(1, 12)
+        streamed.append(parser.feed(response[pos:pos + step]))
+        pos += step
+    envelope = parser.close()
+    streamed.append(parser.feed(""))
+    return "".join(streamed), envelope
+
+
+@pytest.mark.parametrize("response, expected", MALFORMED)
+def test_parses_malformed_reply(response, expected):
+    assert parse_llm_envelope(response) == expected
+
+
+@pytest.mark.parametrize("response, expected", MALFORMED)
+def test_chunking_does_not_change_result(response, expected):
+    rng = random.Random(response)
+    for _ in range(50):
+        streamed, envelope = _stream(response, rng)
+        assert envelope == expected
+        assert streamed == expected["text"]
+
+
+def test_well_formed_json_fast_path():
+    reply = {"text": 'Quote: "hi"', "config": {"rate": 5}, "tool": "NONE", "args": ""}
+    assert parse_llm_envelope(json.dumps(reply)) == reply
+
+
+@pytest.mark.parametrize("response, expected", MALFORMED)
+def test_fuzz_truncation_and_noise(response, expected):
+    # any prefix, or the reply with a character dropped / duplicated, must
+    # parse without raising and still give all four keys
+    rng = random.Random(len(response))
+    variants = [response[:i] for i in range(len(response) + 1)]
+    for _ in range(200):
+        i = rng.randrange(len(response))
+        variants.append(response[:i] + response[i + 1:])
+        variants.append(response[:i] + response[i] + response[i:])
+    for variant in variants:
+        envelope = parse_llm_envelope(variant)
+        assert set(envelope) == {"text", "config", "tool", "args"}
+        assert isinstance(envelope["text"], str)
+        assert isinstance(envelope["config"], dict)
+
+
+def test_benchmark_long_malformed_reply_is_linear():
+    # ~200 KB of text with stray quotes, streamed in small chunks as Groq
+    # would. Parsing has to stay linear in the reply length.
+    sentence = 'The model said "yes", then "no". '
+    body = sentence * 6000
+    response = '{"text": "' + body + '", "config": {}, "tool": "NONE", "args": ""}'
+
+    start = time.perf_counter()
+    parser = EnvelopeParser()
+    streamed = []
+    for i in range(0, len(response), 16):
+        streamed.append(parser.feed(response[i:i + 16]))
+    envelope = parser.close()
+    elapsed = time.perf_counter() - start
+
+    assert envelope["text"] == body
+    assert "".join(streamed) == body
+    assert elapsed < 2.0, f"parsing took {elapsed:.2f}s"
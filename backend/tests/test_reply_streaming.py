@@ -0,0 +1,106 @@
+import json
+import queue
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import llm, tts
+from app.services.cancellation import CancelToken
+
+REPLY = {
+    "text": 'Sure. The paper "Attention Is All You Need" came out in 2017. '
+            "It costs $O(n^2)$ in the sequence length. That is the short version!",
+    "config": {},
+    "tool": "NONE",
+    "args": "",
+}
+
+
+class FakeStream:
+    """Groq-style stream of content deltas."""
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.closed = False
+
+    def __iter__(self):
+        for piece in self.pieces:
+            delta = SimpleNamespace(content=piece)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], x_groq=None, usage=None)
+
+    def close(self):
+        self.closed = True
+
+
+def _chunked(text: str, rng: random.Random):
+    pieces, pos = [], 0
+    while pos < len(text):
+        step = rng.randint(1, 9)
+        pieces.append(text[pos:pos + step])
+        pos += step
+    return pieces
+
+
+@pytest.fixture
+def fake_groq(monkeypatch):
+    def install(pieces):
+        stream = FakeStream(pieces)
+        create = lambda **kwargs: stream
+        monkeypatch.setattr(llm, "client", SimpleNamespace(
+            chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+        return stream
+    return install
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_stream_completion_forwards_text_as_it_arrives(fake_groq, seed):
+    response = json.dumps(REPLY)
+    stream = fake_groq(_chunked(response, random.Random(seed)))
+    deltas = []
+
+    content, usage = llm._stream_completion([], 0.5, CancelToken(), on_text=deltas.append)
+
+    assert content == response
+    assert stream.closed
+    assert len(deltas) > 1
+    assert "".join(deltas) == REPLY["text"]
+
+
+def test_stream_completion_without_envelope_sends_text_at_the_end(fake_groq):
+    fake_groq(["I'm not ", "sure what ", "you mean."])
+    deltas = []
+    llm._stream_completion([], 0.5, CancelToken(), on_text=deltas.append)
+    assert deltas == ["I'm not sure what you mean."]
+
+
+def test_streamed_reply_is_spoken_by_sentence(fake_groq, monkeypatch):
+    spoken = []
+
+    def speech_parts(text, settings, cancel):
+        spoken.append(text)
+        yield "audio"
+
+    monkeypatch.setattr(tts, "_speech_parts", speech_parts)
+    monkeypatch.setattr(tts, "TTS_FIRST_SEGMENT_SECONDS", 1)
+    monkeypatch.setattr(tts, "TTS_CHARS_PER_SECOND", 10)
+
+    deltas = queue.Queue()
+    fake_groq(_chunked(json.dumps(REPLY), random.Random(0)))
+    llm._stream_completion([], 0.5, CancelToken(), on_text=deltas.put)
+    deltas.put(None)
+
+    speech = tts.stream_audio_from_deltas(deltas, {}, start_index=1)
+    lines = []
+    while True:
+        try:
+            lines.append(json.loads(next(speech)))
+        except StopIteration as stop:
+            next_index = stop.value
+            break
+
+    assert len(spoken) > 1
+    assert "".join(line["text_chunk"] for line in lines) == REPLY["text"]
+    assert [line["index"] for line in lines] == list(range(1, next_index))
+    # the $...$ span is never cut
+    assert all(line["text_chunk"].count("$") % 2 == 0 for line in lines)
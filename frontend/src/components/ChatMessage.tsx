@@ -11,10 +11,27 @@ import Mermaid from '@/components/Mermaid';
 interface ChatMessageProps {
   role: 'user' | 'agent' | 'system';
   content: string;
+  data?: any;
   className?: string;
 }
 
-export const ChatMessage: React.FC<ChatMessageProps> = ({ role, content, className }) => {
+// Python result arrays: JSON values are shown, base64 ones only described
+const renderResultData = (data: any) => {
+  if (data?.type !== "python_result") return null;
+  const shape = Array.isArray(data.shape) ? data.shape.join(" × ") : "";
+  return (
+    <div className="rounded-lg border border-accent/20 bg-accent/5 p-3 text-xs">
+      <div className="mb-1 opacity-70">
+        Result array {shape} ({data.dtype})
+      </div>
+      {data.encoding === "json" && (
+        <pre className="max-h-48 overflow-auto">{JSON.stringify(data.values)}</pre>
+      )}
+    </div>
+  );
+};
+
+export const ChatMessage: React.FC<ChatMessageProps> = ({ role, content, data, className }) => {
   const isUser = role === 'user';
 
   // SYSTEM MESSAGE (no bubble)
@@ -125,6 +142,7 @@ export const ChatMessage: React.FC<ChatMessageProps> = ({ role, content, classNa
       >
         <div className="space-y-4 break-words whitespace-pre-wrap">
           {parseContent(content)}
+          {renderResultData(data)}
         </div>
       </div>
     </div>
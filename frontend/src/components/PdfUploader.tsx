@@ -6,6 +6,21 @@ import { toast } from "@/hooks/use-toast";
 
 type UploadStatus = "idle" | "uploading" | "success" | "error";
 
+const API_BASE = "http://localhost:8000";
+const INGEST_POLL_MS = 1500;
+
+// Uploads are ingested in the background; wait until the job is done or failed
+async function waitForIngest(ingestId: string): Promise<any> {
+  while (true) {
+    const res = await fetch(`${API_BASE}/api/ingest/${ingestId}`);
+    const job = await res.json();
+    if (!res.ok) throw new Error(job.detail || "Failed to check ingestion status.");
+    if (job.status === "done") return job;
+    if (job.status === "error") throw new Error(job.error || "Failed to process document.");
+    await new Promise((resolve) => setTimeout(resolve, INGEST_POLL_MS));
+  }
+}
+
 export default function PdfUploader({ onUploadComplete }: { onUploadComplete?: () => void }) {
   const [file, setFile] = useState<File | null>(null);
   const [status, setStatus] = useState<UploadStatus>("idle");
@@ -33,14 +48,18 @@ export default function PdfUploader({ onUploadComplete }: { onUploadComplete?: (
       const formData = new FormData();
       formData.append("file", file);
 
-      const res = await fetch("http://localhost:8000/api/upload_pdf", {
+      const res = await fetch(`${API_BASE}/api/upload_pdf`, {
         method: "POST",
         body: formData,
       });
 
       const json = await res.json();
 
-      if (res.ok) {
+      if (res.ok && json.ingest_id && json.status !== "ok") {
+        await waitForIngest(json.ingest_id);
+      }
+
+      if (res.ok && !json.error) {
         setStatus("success");
         toast({
           title: "Upload complete",
@@ -53,7 +72,7 @@ export default function PdfUploader({ onUploadComplete }: { onUploadComplete?: (
         setStatus("error");
         toast({
           title: "Upload failed",
-          description: json.detail || "Failed to process document.",
+          description: json.detail || json.error || "Failed to process document.",
           variant: "destructive",
         });
       }
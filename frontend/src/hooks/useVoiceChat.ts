@@ -5,10 +5,31 @@ interface Message {
   id: string;
   role: "user" | "agent" | "system";
   content: string;
+  // structured tool output (e.g. a Python result array)
+  data?: any;
 }
 
 const API_BASE_URL = "http://localhost:8000";
 
+// Sent with every /api/chat call. The backend keys chat memory, turn
+// cancellation and speculative replies by user_id, so any client streaming
+// to /ws/transcribe for this user must pass the same id (its default,
+// like /api/chat's, is "default_user").
+const USER_ID = import.meta.env.VITE_USER_ID || "default_user";
+
+// Reply audio is MP3. In progressive mode a sentence arrives as several
+// pieces of one MP3 stream (same index, increasing "part") that only play
+// back cleanly when appended to one stream, so where MediaSource takes MP3
+// every piece of a reply goes, in order, into one SourceBuffer.
+const STREAM_AUDIO_MIME = "audio/mpeg";
+const CAN_STREAM_AUDIO =
+  typeof window !== "undefined" &&
+  "MediaSource" in window &&
+  MediaSource.isTypeSupported(STREAM_AUDIO_MIME);
+
+const decodeBase64 = (b64: string) =>
+  Uint8Array.from(atob(b64), (c) => c.charCodeAt(0));
+
 interface VoiceChatOptions {
   // Called after each user message completes its /api/chat round-trip
   onAfterUserMessage?: () => void;
@@ -29,36 +50,76 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
   const audioChunksRef = useRef<Blob[]>([]);
 
   const audioElementRef = useRef<HTMLAudioElement | null>(null);
-  const audioQueueRef = useRef<string[]>([]);
+  const audioQueueRef = useRef<Blob[]>([]);
   const isPlayingAudioRef = useRef(false);
 
+  // MediaSource playback of the current reply
+  const mediaSourceRef = useRef<MediaSource | null>(null);
+  const sourceBufferRef = useRef<SourceBuffer | null>(null);
+  const pendingAudioRef = useRef<Uint8Array[]>([]);
+  const audioStreamEndedRef = useRef(false);
+  // bumped per reply, so an aborted reply can't end the next one's audio
+  const audioGenerationRef = useRef(0);
+  // without MediaSource: the pieces of the sentence being received
+  const clipPartsRef = useRef<{ index: number; parts: Uint8Array[] } | null>(
+    null
+  );
+
   const abortControllerRef = useRef<AbortController | null>(null);
 
+  const cancelReply = useCallback(() => {
+    fetch(`${API_BASE_URL}/api/chat/cancel`, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify({ user_id: USER_ID }),
+      keepalive: true,
+    }).catch((error) => {
+      console.error("Error cancelling reply:", error);
+    });
+  }, []);
+
+  const releaseAudio = useCallback(() => {
+    const audio = audioElementRef.current;
+    if (audio) {
+      audio.pause();
+      if (audio.src.startsWith("blob:")) {
+        URL.revokeObjectURL(audio.src);
+      }
+      audioElementRef.current = null;
+    }
+    mediaSourceRef.current = null;
+    sourceBufferRef.current = null;
+    pendingAudioRef.current = [];
+    audioStreamEndedRef.current = false;
+  }, []);
+
   // ------------------------------------------------------
   // STOP SPEAKING: interrupt LLM stream + TTS playback
   // ------------------------------------------------------
   const stopSpeaking = useCallback(() => {
-    // Abort current /api/chat streaming fetch if any
+    // Abort current /api/chat streaming fetch if any, and tell the server
+    // to stop that turn's LLM, tool and TTS work right away
     if (abortControllerRef.current) {
       abortControllerRef.current.abort();
       abortControllerRef.current = null;
+      cancelReply();
     }
 
     // Stop audio playback
-    if (audioElementRef.current) {
-      audioElementRef.current.pause();
-      audioElementRef.current = null;
-    }
+    releaseAudio();
 
     // Clear queue
     audioQueueRef.current = [];
+    clipPartsRef.current = null;
     isPlayingAudioRef.current = false;
 
     // Reset flags
     setIsAgentSpeaking(false);
     setIsPlaying(false);
     setCurrentSentenceIndex(-1);
-  }, []);
+  }, [cancelReply, releaseAudio]);
 
   // ------------------------------------------------------
   // RECORDING: non-streaming STT via /api/transcribe
@@ -129,7 +190,6 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
     let buffer = "";
     const agentMessageId = (Date.now() + 1).toString();
     let agentContent = "";
-    let isFirstChunk = true;
 
     // Add initial empty agent message
     const agentMessage: Message = {
@@ -138,6 +198,7 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
       content: "",
     };
     setMessages((prev) => [...prev, agentMessage]);
+    const audioGeneration = openAudioStream();
 
     try {
       while (true) {
@@ -158,8 +219,9 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
           try {
             const chunk = JSON.parse(line);
 
-            // First chunk may contain full_text
-            if (isFirstChunk && chunk.full_text) {
+            // full_text replaces what we have: it comes first, or after
+            // text_chunks that were spoken while the reply was being written
+            if (chunk.full_text) {
               agentContent = chunk.full_text;
               setMessages((prev) =>
                 prev.map((msg) =>
@@ -168,7 +230,6 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
                     : msg
                 )
               );
-              isFirstChunk = false;
             }
 
             // Fallback: incremental text_chunk
@@ -190,10 +251,19 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
 
             // Audio chunks to play
             if (chunk.audio_chunk) {
-              if (!isFirstChunk) {
-                setIsAgentSpeaking(true);
-              }
-              queueAudio(chunk.audio_chunk);
+              setIsAgentSpeaking(true);
+              appendAudio(chunk.audio_chunk, chunk.index);
+            }
+
+            // Structured tool output, shown with the reply
+            if (chunk.status === "data" && chunk.data) {
+              setMessages((prev) =>
+                prev.map((msg) =>
+                  msg.id === agentMessageId
+                    ? { ...msg, data: chunk.data }
+                    : msg
+                )
+              );
             }
 
             // Completion
@@ -220,6 +290,7 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
         toast.error("Error while streaming response");
       }
     } finally {
+      closeAudioStream(audioGeneration);
       setIsAgentSpeaking(false);
       setCurrentSentenceIndex(-1);
     }
@@ -264,7 +335,9 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
       };
       setMessages((prev) => [...prev, userMessage]);
 
-      // 3) Send to /api/chat (streaming)
+      // 3) Send to /api/chat (streaming). The server cancels the previous
+      // turn itself when this one starts, so no /api/chat/cancel here: it
+      // could arrive after this turn has begun and cancel it instead.
       if (abortControllerRef.current) {
         abortControllerRef.current.abort();
       }
@@ -278,7 +351,7 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
         },
         body: JSON.stringify({
           user_message: transcription,
-          user_id: "user_1",
+          user_id: USER_ID,
         }),
         signal: controller.signal,
       });
@@ -288,6 +361,9 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
       }
 
       await handleStreamingResponse(chatResponse, userMessage.id);
+      if (abortControllerRef.current === controller) {
+        abortControllerRef.current = null;
+      }
 
       // 🔥 after voice message round-trip completes
       onAfterUserMessage?.();
@@ -304,8 +380,120 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
   };
 
   // ------------------------------------------------------
-  // AUDIO PLAYBACK QUEUE
+  // AUDIO PLAYBACK
   // ------------------------------------------------------
+  // One MediaSource per reply: pieces are appended as they arrive and
+  // playback starts with the first. Without MediaSource, the pieces of each
+  // sentence are joined into one clip once the next sentence (or the end of
+  // the reply) arrives, and the clips are played in turn.
+  const pumpAudio = () => {
+    const mediaSource = mediaSourceRef.current;
+    const sourceBuffer = sourceBufferRef.current;
+    if (!mediaSource || !sourceBuffer || sourceBuffer.updating) return;
+
+    const next = pendingAudioRef.current.shift();
+    if (next) {
+      sourceBuffer.appendBuffer(next);
+    } else if (
+      audioStreamEndedRef.current &&
+      mediaSource.readyState === "open"
+    ) {
+      mediaSource.endOfStream();
+    }
+  };
+
+  const finishPlayback = () => {
+    releaseAudio();
+    isPlayingAudioRef.current = false;
+    setIsPlaying(false);
+    setCurrentSentenceIndex(-1);
+  };
+
+  const openAudioStream = () => {
+    // a new reply replaces whatever was still playing
+    releaseAudio();
+    audioQueueRef.current = [];
+    clipPartsRef.current = null;
+    isPlayingAudioRef.current = false;
+    const generation = ++audioGenerationRef.current;
+    if (!CAN_STREAM_AUDIO) return generation;
+
+    const mediaSource = new MediaSource();
+    const audio = new Audio();
+    audio.src = URL.createObjectURL(mediaSource);
+
+    mediaSource.addEventListener("sourceopen", () => {
+      if (mediaSourceRef.current !== mediaSource) return;
+      const sourceBuffer = mediaSource.addSourceBuffer(STREAM_AUDIO_MIME);
+      // place pieces back to back, whatever timestamps they carry
+      sourceBuffer.mode = "sequence";
+      sourceBuffer.addEventListener("updateend", pumpAudio);
+      sourceBufferRef.current = sourceBuffer;
+      pumpAudio();
+    });
+
+    audio.onended = () => {
+      if (audioElementRef.current === audio) finishPlayback();
+    };
+    audio.onerror = (error) => {
+      console.error("Error playing audio:", error);
+      if (audioElementRef.current === audio) finishPlayback();
+    };
+
+    mediaSourceRef.current = mediaSource;
+    audioElementRef.current = audio;
+    return generation;
+  };
+
+  const appendAudio = (audioBase64: string, index: number) => {
+    const bytes = decodeBase64(audioBase64);
+
+    if (mediaSourceRef.current) {
+      pendingAudioRef.current.push(bytes);
+      pumpAudio();
+      const audio = audioElementRef.current;
+      if (audio && !isPlayingAudioRef.current) {
+        isPlayingAudioRef.current = true;
+        setIsPlaying(true);
+        audio.play().catch((error) => {
+          console.error("Error starting audio playback:", error);
+        });
+      }
+      return;
+    }
+
+    if (clipPartsRef.current && clipPartsRef.current.index !== index) {
+      flushClip();
+    }
+    if (!clipPartsRef.current) {
+      clipPartsRef.current = { index, parts: [] };
+    }
+    clipPartsRef.current.parts.push(bytes);
+  };
+
+  const closeAudioStream = (generation: number) => {
+    if (generation !== audioGenerationRef.current) return;
+    if (mediaSourceRef.current) {
+      if (!isPlayingAudioRef.current) {
+        // no audio in this reply
+        releaseAudio();
+        return;
+      }
+      audioStreamEndedRef.current = true;
+      pumpAudio();
+      return;
+    }
+    flushClip();
+  };
+
+  const flushClip = () => {
+    const clip = clipPartsRef.current;
+    clipPartsRef.current = null;
+    if (clip) {
+      queueAudio(new Blob(clip.parts, { type: STREAM_AUDIO_MIME }));
+    }
+  };
+
   const playNext = () => {
     if (audioQueueRef.current.length === 0) {
       isPlayingAudioRef.current = false;
@@ -314,27 +502,24 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
       return;
     }
 
-    const audioBase64 = audioQueueRef.current.shift()!;
+    const clip = audioQueueRef.current.shift()!;
     isPlayingAudioRef.current = true;
     setIsPlaying(true);
 
     try {
-      if (audioElementRef.current) {
-        audioElementRef.current.pause();
-        audioElementRef.current = null;
-      }
+      releaseAudio();
 
-      const audio = new Audio(`data:audio/mp3;base64,${audioBase64}`);
+      const audio = new Audio(URL.createObjectURL(clip));
       audioElementRef.current = audio;
 
       audio.onended = () => {
-        audioElementRef.current = null;
+        releaseAudio();
         playNext();
       };
 
       audio.onerror = (error) => {
         console.error("Error playing audio:", error);
-        audioElementRef.current = null;
+        releaseAudio();
         playNext();
       };
 
@@ -350,8 +535,8 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
     }
   };
 
-  const queueAudio = (audioBase64: string) => {
-    audioQueueRef.current.push(audioBase64);
+  const queueAudio = (clip: Blob) => {
+    audioQueueRef.current.push(clip);
     if (!isPlayingAudioRef.current) {
       playNext();
     }
@@ -373,7 +558,8 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
       };
       setMessages((prev) => [...prev, userMessage]);
 
-      // Abort any previous stream
+      // Abort any previous stream (the server cancels its turn when this
+      // one starts; see processAudio)
       if (abortControllerRef.current) {
         abortControllerRef.current.abort();
       }
@@ -387,7 +573,7 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
         },
         body: JSON.stringify({
           user_message: text.trim(),
-          user_id: "user_1",
+          user_id: USER_ID,
         }),
         signal: controller.signal,
       });
@@ -397,6 +583,9 @@ export const useVoiceChat = (options?: VoiceChatOptions) => {
       }
 
       await handleStreamingResponse(chatResponse, userMessage.id);
+      if (abortControllerRef.current === controller) {
+        abortControllerRef.current = null;
+      }
 
       // 🔥 after text message round-trip completes
       onAfterUserMessage?.();
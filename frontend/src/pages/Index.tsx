@@ -287,6 +287,7 @@ const Index = () => {
                       key={message.id}
                       role={message.role}
                       content={message.content}
+                      data={message.data}
                     />
                   );
                 })}